@@ -0,0 +1,99 @@
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CGROUP_MEMORY_LIMIT_FILES = [
+    "/sys/fs/cgroup/memory.max",  # cgroup v2
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+]
+# Share of the container memory which objects being processed may use, the
+# rest being left to the interpreters, libraries and allocator overhead
+MEMORY_BUDGET_RATIO = 0.75
+# Rough ratio between the memory used to rewrite an object and its size
+PARQUET_EXPANSION_RATIO = 3
+# JSON objects are streamed, so their working set is bounded by the read
+# chunks and the compression buffers rather than by the object size
+JSON_WORKING_SET = 64 * 1024 * 1024
+
+
+def get_memory_limit():
+    """
+    Returns the memory limit of the container in bytes as enforced by the
+    cgroup, or None if the container has no limit or it can't be read
+    """
+    for limit_file in CGROUP_MEMORY_LIMIT_FILES:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        # Unlimited cgroups report "max" (v2) or a huge number (v1)
+        if limit.isdigit() and int(limit) < 2 ** 60:
+            return int(limit)
+        return None
+    return None
+
+
+def estimate_working_set(content_length, file_format, compressed):
+    """
+    Estimates the peak memory needed to rewrite an object from its size,
+    format and compression
+    """
+    if file_format == "json":
+        return min(content_length * (10 if compressed else 1), JSON_WORKING_SET)
+    return content_length * PARQUET_EXPANSION_RATIO
+
+
+class AdmissionController:
+    """
+    Schedules received objects so that the sum of the estimated working sets
+    of the objects being processed stays within the memory budget. Objects
+    estimated to need more than a worker's fair share of the budget are
+    large objects, of which only one is processed at a time. Objects are
+    admitted in the order they were received, except that small objects can
+    overtake a large object waiting for the large object slot.
+    """
+
+    def __init__(self, memory_budget, processes):
+        self._memory_budget = memory_budget
+        self._large_object_size = memory_budget / processes
+        self._waiting = deque()
+        self._admitted = {}
+
+    def add(self, task_id, estimate):
+        self._waiting.append((task_id, estimate))
+
+    def complete(self, task_id):
+        self._admitted.pop(task_id, None)
+
+    def _is_large(self, estimate):
+        return estimate > self._large_object_size
+
+    def admit(self):
+        """
+        Returns the ids of the waiting objects which can be processed now
+        """
+        admitted = []
+        large_in_progress = any(
+            self._is_large(estimate) for estimate in self._admitted.values()
+        )
+        used = sum(self._admitted.values())
+        skipped = deque()
+        while self._waiting:
+            task_id, estimate = self._waiting[0]
+            large = self._is_large(estimate)
+            if large and large_in_progress:
+                skipped.append(self._waiting.popleft())
+                continue
+            # An object is always admitted when nothing else is in progress,
+            # even if its estimate exceeds the whole budget
+            if self._admitted and used + estimate > self._memory_budget:
+                break
+            self._waiting.popleft()
+            self._admitted[task_id] = estimate
+            admitted.append(task_id)
+            used += estimate
+            large_in_progress = large_in_progress or large
+        self._waiting.extendleft(reversed(skipped))
+        return admitted
@@ -1,20 +1,78 @@
 from gzip import GzipFile
-from io import BytesIO
 import json
+import os
+import re
 from collections import Counter
+from io import BytesIO
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pj
+from pyarrow import BufferOutputStream, input_stream
+from pyarrow.lib import ArrowException
 
-from pyarrow import BufferOutputStream, CompressedOutputStream
+from match_index import get_match_index
+
+STRING_DELIMITER = b'"'
+# JSON whitespace which may precede a value
+VALUE_PREFIX = rb"[:,\[][ \t\r\n]*"
+# Integers and decimals found in value position, without trailing zero decimals
+NUMBER_VALUE = re.compile(VALUE_PREFIX + rb"(-?\d+(?:\.\d*[1-9])?)\.?0*(?![\w.])")
+# Numbers whose token may differ from that of an equal MatchId: numbers with
+# an exponent, and decimals with more digits than a float holds, which may be
+# rounded to a MatchId once parsed (for instance 123.0000000000000001)
+UNNORMALISED_VALUE = re.compile(
+    VALUE_PREFIX + rb"-?(?:\d+(?:\.\d+)?[eE]|(?=[\d.]{17})\d+\.\d+)"
+)
+ESCAPE = re.compile(rb"\\")
+ANY_LINE = re.compile(rb"[^\n]")
+MAX_COMPILED_MATCH_IDS = 10000
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+# Engine finding the candidate lines to delete: "arrow" parses them in bulk
+# with pyarrow.json, falling back to "python" for blocks it can't handle
+JSON_ENGINE = os.getenv("JSON_ENGINE", "arrow")
+# Below this number of candidate lines in a block, parsing them one by one
+# is faster than parsing them in bulk
+MIN_ARROW_CANDIDATES = 100
+# Maximum number of object layouts for which resolved keys are cached
+MAX_CACHED_KEY_LAYOUTS = 4096
+INT64_RANGE = (-(2 ** 63), 2 ** 63 - 1)
 
 
 def initialize(input_file, out_stream, compressed):
-    if compressed:
-        bytestream = BytesIO(input_file.read())
-        input_file = GzipFile(None, "rb", fileobj=bytestream)
-    gzip_stream = CompressedOutputStream(out_stream, "gzip") if compressed else None
-    writer = gzip_stream if compressed else out_stream
+    # The input is buffered so that compressed objects are also read in large chunks
+    input_file = input_stream(
+        input_file,
+        compression="gzip" if compressed else None,
+        buffer_size=READ_CHUNK_SIZE if compressed else None,
+    )
+    # Unlike the Arrow compressed streams, GzipFile leaves the sink open on close
+    writer = GzipFile(None, "wb", 6, out_stream) if compressed else out_stream
     return input_file, writer
 
 
+def read_blocks(input_file):
+    """
+    Generates blocks of complete lines read from the input in chunks, so that
+    only the current chunk and the line spanning the chunk boundary are held
+    in memory. The last block may not end with a newline.
+    """
+    pending = []
+    while True:
+        chunk = input_file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        last_newline = chunk.rfind(b"\n")
+        if last_newline == -1:
+            pending.append(chunk)
+            continue
+        yield b"".join(pending) + chunk[: last_newline + 1]
+        pending = [chunk[last_newline + 1 :]]
+    remainder = b"".join(pending)
+    if remainder:
+        yield remainder
+
+
 def find_key(key, obj):
     """
     Athena openx SerDe is case insensitive, and converts by default each object's key
@@ -30,41 +88,391 @@ def find_key(key, obj):
             return found_key
 
 
-def delete_matches_from_json_file(input_file, to_delete, compressed=False):
-    deleted_rows = 0
-    with BufferOutputStream() as out_stream:
-        input_file, writer = initialize(input_file, out_stream, compressed)
-        content = input_file.read().decode("utf-8")
-        lines = content.split("\n")
-        if lines[-1] == "":
-            lines.pop()
-        total_rows = len(lines)
-        for i, line in enumerate(lines):
+class KeyResolver:
+    """
+    Resolves a column identifier to the value of a parsed JSON object with
+    the same semantics as find_key. The key found for a segment only depends
+    on the segment and on the keys of the object in order, and lines written
+    by the same producer share the same keys, so resolved keys are cached by
+    the keys of the object they were found in. Keys are then only lowercased
+    the first time a layout is seen, which counts as a miss.
+    """
+
+    def __init__(self, column_name):
+        self.segments = column_name.split(".")
+        self.lookups = 0
+        self.misses = 0
+        self._cache = {}
+
+    def resolve(self, parsed):
+        record = parsed
+        for depth, segment in enumerate(self.segments):
+            if not record:
+                return None
+            layout = (depth, tuple(record.keys()))
+            self.lookups += 1
             try:
-                parsed = json.loads(line)
-            except (json.JSONDecodeError) as e:
-                raise ValueError(
-                    "Serialization error when processing JSON object: {}".format(
-                        str(e).replace("line 1", "line {}".format(i + 1))
-                    )
-                )
-            should_delete = False
-            for column in to_delete:
-                record = parsed
-                for segment in column["Column"].split("."):
-                    current_key = find_key(segment, record)
-                    if not current_key:
-                        record = None
-                        break
-                    record = record[current_key]
-                if record and record in column["MatchIds"]:
-                    should_delete = True
-                    break
-            if should_delete:
-                deleted_rows += 1
+                current_key = self._cache[layout]
+            except KeyError:
+                self.misses += 1
+                current_key = find_key(segment, record)
+                if len(self._cache) < MAX_CACHED_KEY_LAYOUTS:
+                    self._cache[layout] = current_key
+            if not current_key:
+                return None
+            record = record[current_key]
+        return record
+
+
+def compile_key_resolvers(columns):
+    return [
+        {**column, "KeyResolver": KeyResolver(column["Column"])} for column in columns
+    ]
+
+
+def should_delete(parsed, columns):
+    for column in columns:
+        record = column["KeyResolver"].resolve(parsed)
+        if record and is_match(record, column):
+            return True
+    return False
+
+
+def is_match(record, column):
+    try:
+        return record in column["MatchIdSet"]
+    except TypeError:
+        # Objects and arrays are unhashable and never match
+        return False
+
+
+def get_number_token(match_id):
+    """
+    Returns the shortest JSON representation of a numeric MatchId, or None
+    if the number can only be represented with an exponent
+    """
+    if isinstance(match_id, float):
+        if match_id.is_integer():
+            return str(int(match_id)).encode("utf-8")
+        token = repr(match_id)
+        return None if "e" in token or "n" in token else token.encode("utf-8")
+    return str(match_id).encode("utf-8")
+
+
+def build_trie_pattern(tokens):
+    """
+    Builds a regex alternation of the given tokens structured as a trie, so
+    that the regex engine compares each position in the input against all
+    tokens at once rather than trying every token in turn
+    """
+    trie = {}
+    for token in tokens:
+        node = trie
+        for char in token:
+            node = node.setdefault(char, {})
+        node[None] = {}
+
+    def to_pattern(node):
+        alternatives = [
+            re.escape(bytes([char])) + to_pattern(child)
+            for char, child in node.items()
+            if char is not None
+        ]
+        if not alternatives:
+            return b""
+        if len(alternatives) == 1 and None not in node:
+            return alternatives[0]
+        return b"(?:" + b"|".join(alternatives) + b")" + (b"?" if None in node else b"")
+
+    return to_pattern(trie)
+
+
+def compile_patterns(strings, numbers):
+    patterns = []
+    if strings:
+        patterns.append(
+            re.compile(STRING_DELIMITER + build_trie_pattern(strings) + STRING_DELIMITER)
+        )
+    integers = {token for token in numbers if b"." not in token}
+    decimals = numbers - integers
+    alternatives = []
+    if integers:
+        alternatives.append(build_trie_pattern(integers) + rb"(?:\.0*)?")
+    if decimals:
+        alternatives.append(build_trie_pattern(decimals) + b"0*")
+    if alternatives:
+        patterns.append(
+            re.compile(
+                VALUE_PREFIX + rb"(?:" + b"|".join(alternatives) + rb")(?![\w.])"
+            )
+        )
+    return patterns
+
+
+def build_prefilter(columns):
+    """
+    Compiles the MatchIds into patterns matching the raw bytes of the JSON
+    lines which may contain them, so that only those lines need to be parsed.
+    String MatchIds are matched as complete unescaped string tokens and
+    numeric MatchIds as number tokens in any notation. Returns a function
+    generating the patterns for a block of lines, or None if any of the
+    MatchIds cannot be searched for, in which case every line is parsed.
+
+    Up to MAX_COMPILED_MATCH_IDS, the patterns are compiled once for all
+    blocks. Above that compiling is too expensive, so the tokens of each
+    block are intersected with the MatchIds first and the patterns are
+    compiled for the MatchIds found in the block only.
+    """
+    strings = set()
+    numbers = set()
+    for column in columns:
+        for match_id in column["MatchIdSet"]:
+            if isinstance(match_id, str):
+                strings.add(match_id.encode("utf-8"))
+            elif isinstance(match_id, (int, float)) and not isinstance(
+                match_id, bool
+            ):
+                token = get_number_token(match_id)
+                if token is None:
+                    return None
+                numbers.add(token)
+                if match_id == 1:
+                    # JSON true is equal to 1 in Python
+                    numbers.add(b"true")
             else:
-                writer.write(bytes(line + "\n", "utf-8"))
-        if compressed:
-            writer.close()
-        stats = Counter({"ProcessedRows": total_rows, "DeletedRows": deleted_rows})
-        return out_stream, stats
+                return None
+    # Lines containing numbers which can't be compared by token are parsed
+    extra_patterns = [UNNORMALISED_VALUE] if numbers else []
+    if len(strings) + len(numbers) <= MAX_COMPILED_MATCH_IDS:
+        patterns = compile_patterns(strings, numbers) + extra_patterns
+        return lambda block: patterns
+
+    def compile_block_patterns(block):
+        number_tokens = set(NUMBER_VALUE.findall(block))
+        number_tokens.add(b"true")
+        return (
+            compile_patterns(
+                strings.intersection(block.split(STRING_DELIMITER)),
+                numbers.intersection(number_tokens),
+            )
+            + extra_patterns
+        )
+
+    return compile_block_patterns
+
+
+def find_candidate_lines(block, prefilter):
+    """
+    Generates the (start, end) offsets of the lines in the block which may
+    contain a match. Lines containing escape sequences are always candidates
+    as their raw bytes may differ from the decoded values.
+    """
+    patterns = [ANY_LINE] if prefilter is None else prefilter(block) + [ESCAPE]
+    starts = set()
+    for pattern in patterns:
+        pos = 0
+        found = pattern.search(block, pos)
+        while found:
+            starts.add(block.rfind(b"\n", 0, found.start()) + 1)
+            # Skip any further occurrence in the same line
+            pos = block.find(b"\n", found.end())
+            found = pattern.search(block, pos + 1) if pos != -1 else None
+    for start in sorted(starts):
+        end = block.find(b"\n", start)
+        yield start, len(block) if end == -1 else end
+
+
+class UnsupportedBlockError(Exception):
+    """
+    Raised when the arrow engine can't reproduce the matching of the python
+    engine for a block
+    """
+
+
+def get_json_column(table, column_name):
+    """
+    Lookup a column parsed by pyarrow.json by its identifier, matching each
+    segment with the field names case insensitively like find_key. Returns
+    None if no line contains the column. As pyarrow.json gives each casing of
+    a key its own field and can't tell which one find_key would pick when a
+    line has several, finding more than one field raises UnsupportedBlockError.
+    """
+    column = None
+    for segment in column_name.split("."):
+        if column is None:
+            names, children = table.column_names, table.columns
+        elif pa.types.is_struct(column.type):
+            names = [field.name for field in column.type]
+            children = column.flatten()
+        else:
+            raise UnsupportedBlockError("{} is not an object".format(segment))
+        found = [i for i, name in enumerate(names) if name.lower() == segment.lower()]
+        if not found:
+            return None
+        if len(found) > 1:
+            raise UnsupportedBlockError("Ambiguous key {}".format(segment))
+        column = children[found[0]]
+    return column
+
+
+def get_value_set(value_type, match_ids):
+    """
+    Returns the MatchIds which Python considers equal to values of the given
+    Arrow type as an array of that type, or None if none can match. Falsy
+    values, objects and arrays never match. Raises UnsupportedBlockError for
+    types inferred by pyarrow.json which don't exist in JSON, such as
+    timestamps.
+    """
+    match_ids = [i for i in match_ids if i]
+    if pa.types.is_string(value_type):
+        values = [i for i in match_ids if isinstance(i, str)]
+    elif pa.types.is_integer(value_type):
+        values = [
+            int(i)
+            for i in match_ids
+            if isinstance(i, (int, float))
+            and float(i).is_integer()
+            and INT64_RANGE[0] <= i <= INT64_RANGE[1]
+        ]
+    elif pa.types.is_floating(value_type):
+        values = [float(i) for i in match_ids if isinstance(i, (int, float))]
+    elif pa.types.is_boolean(value_type):
+        # True is equal to 1 in Python
+        values = [True] if 1 in match_ids else []
+    elif pa.types.is_null(value_type) or pa.types.is_nested(value_type):
+        values = []
+    else:
+        raise UnsupportedBlockError("Unsupported type {}".format(value_type))
+    return pa.array(values, type=value_type) if values else None
+
+
+def find_lines_to_delete_with_arrow(block, spans, columns):
+    """
+    Parses the candidate lines in bulk with pyarrow.json and finds the lines
+    with matches using vectorised lookups. Lines matched on floating point
+    columns are confirmed by parsing them with the python engine, as
+    pyarrow.json loses the precision of large integers mixed with floats.
+    Returns the indexes of the spans to delete, or None if the block must be
+    processed by the python engine instead, for instance because of lines
+    pyarrow.json can't parse.
+    """
+    view = memoryview(block)
+    try:
+        table = pj.read_json(BytesIO(b"\n".join(view[s:e] for s, e in spans)))
+    except ArrowException:
+        return None
+    if table.num_rows != len(spans):
+        # Blank lines are skipped by pyarrow.json
+        return None
+    to_delete = set()
+    to_confirm = set()
+    try:
+        for column in columns:
+            if not column["MatchIds"]:
+                continue
+            values = get_json_column(table, column["Column"])
+            if values is None:
+                continue
+            value_set = get_value_set(values.type, column["MatchIdSet"])
+            if value_set is None:
+                continue
+            mask = pc.is_in(values, value_set=value_set)
+            found = to_confirm if pa.types.is_floating(values.type) else to_delete
+            found.update(i for i, match in enumerate(mask.to_pylist()) if match)
+    except UnsupportedBlockError:
+        return None
+    return to_delete | {
+        i
+        for i in to_confirm - to_delete
+        if should_delete(json.loads(block[spans[i][0] : spans[i][1]]), columns)
+    }
+
+
+def find_lines_to_delete(block, spans, columns, first_line):
+    """
+    Parses the candidate lines one by one and returns the indexes of the
+    spans to delete
+    """
+    to_delete = set()
+    counted_until = 0
+    line_number = first_line
+    for i, (start, end) in enumerate(spans):
+        line_number += block.count(b"\n", counted_until, start)
+        counted_until = start
+        try:
+            parsed = json.loads(block[start:end])
+        except (json.JSONDecodeError) as e:
+            raise ValueError(
+                "Serialization error when processing JSON object: {}".format(
+                    str(e).replace("line 1", "line {}".format(line_number))
+                )
+            )
+        if should_delete(parsed, columns):
+            to_delete.add(i)
+    return to_delete
+
+
+def delete_matches_from_block(
+    block, columns, prefilter, writer, first_line, engine="python"
+):
+    """
+    Writes the lines of the block which don't contain any matches to the
+    writer and returns the number of rows processed and deleted
+    """
+    spans = list(find_candidate_lines(block, prefilter))
+    to_delete = None
+    if engine == "arrow" and len(spans) >= MIN_ARROW_CANDIDATES:
+        to_delete = find_lines_to_delete_with_arrow(block, spans, columns)
+    if to_delete is None:
+        to_delete = find_lines_to_delete(block, spans, columns, first_line)
+    missing_newline = not block.endswith(b"\n")
+    copied_until = 0
+    for i in sorted(to_delete):
+        start, end = spans[i]
+        # Lines which cannot contain matches are copied through unparsed
+        writer.write(block[copied_until:start])
+        copied_until = end + 1
+    writer.write(block[copied_until:])
+    if missing_newline and copied_until < len(block):
+        writer.write(b"\n")
+    total_rows = block.count(b"\n") + (1 if missing_newline else 0)
+    return total_rows, len(to_delete)
+
+
+def delete_matches_from_json_file(
+    input_file, to_delete, compressed=False, out_stream=None, engine=None
+):
+    if out_stream is None:
+        with BufferOutputStream() as out_stream:
+            _, stats = delete_matches_from_json_file(
+                input_file, to_delete, compressed, out_stream, engine
+            )
+            return out_stream, stats
+    stats = Counter({"ProcessedRows": 0, "DeletedRows": 0})
+    input_file, writer = initialize(input_file, out_stream, compressed)
+    match_index = get_match_index(to_delete)
+    prefilter = match_index.get_compiled("json_prefilter", build_prefilter)
+    # Resolvers are shared by the files processed against the same index
+    columns = match_index.get_compiled("json_key_resolvers", compile_key_resolvers)
+    resolvers = [column["KeyResolver"] for column in columns]
+    lookups = sum(resolver.lookups for resolver in resolvers)
+    misses = sum(resolver.misses for resolver in resolvers)
+    for block in read_blocks(input_file):
+        total_rows, deleted_rows = delete_matches_from_block(
+            block,
+            columns,
+            prefilter,
+            writer,
+            stats["ProcessedRows"] + 1,
+            engine or JSON_ENGINE,
+        )
+        stats.update({"ProcessedRows": total_rows, "DeletedRows": deleted_rows})
+    stats.update(
+        {
+            "KeyLookups": sum(resolver.lookups for resolver in resolvers) - lookups,
+            "KeyLookupMisses": sum(resolver.misses for resolver in resolvers) - misses,
+        }
+    )
+    if compressed:
+        writer.close()
+    return out_stream, stats
@@ -5,22 +5,37 @@ import sys
 import signal
 import time
 import logging
-from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from multiprocessing import cpu_count
 from operator import itemgetter
 
 import boto3
-import pyarrow as pa
-import s3fs
-from boto_utils import parse_s3_url, get_session
-from botocore.exceptions import ClientError
+from boto_utils import batch_sqs_msgs, parse_s3_url, get_session
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from pyarrow.lib import ArrowException
 
+from admission import (
+    AdmissionController,
+    MEMORY_BUDGET_RATIO,
+    estimate_working_set,
+    get_memory_limit,
+)
 from events import sanitize_message, emit_failure_event, emit_deletion_event
 from json_handler import delete_matches_from_json_file
+from match_index import MatchIndex
 from parquet_handler import delete_matches_from_parquet_file
+from payload_cache import read_payload
+from spill import open_input
+from worker_pool import WorkerPool, get_available_memory
 from s3 import (
+    DOWNLOAD_CONCURRENCY,
+    UPLOAD_CONCURRENCY,
+    RangedObjectReader,
+    get_requester_payment,
     validate_bucket_versioning,
-    save,
+    save_stream,
     verify_object_versions_integrity,
     delete_old_versions,
     IntegrityCheckFailedError,
@@ -38,6 +53,35 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 s3_client = boto3.resource("s3")
 
+MATCH_INDEX_CACHE_SIZE = 4
+# Memory watermark in MB past which a worker process is replaced
+MAX_WORKER_RSS = 1024
+# Seconds for which sessions are reused by a worker, well within the
+# validity of assumed role credentials
+SESSION_TTL = 15 * 60
+sessions = {}
+# Sessions used by the parent process to size the messages received. They
+# are kept apart from those of the workers, so that workers forked by the
+# parent never reuse the pooled connections of its clients.
+estimate_sessions = {}
+# Messages received at once are sized concurrently
+ESTIMATE_CONCURRENCY = 10
+# Seconds waited for messages or completed tasks on each iteration of the main
+# loop while messages are in flight
+POLL_INTERVAL = 1
+SHUTDOWN_ERROR = "SIGINT/SIGTERM received during processing"
+
+
+class ShutdownRequested(BaseException):
+    """
+    Raised in a worker processing grouped objects when the task is stopped.
+    Like KeyboardInterrupt, it isn't caught by the handling of object errors.
+    """
+
+
+def raise_shutdown(*_):
+    raise ShutdownRequested()
+
 
 def handle_error(
     sqs_msg,
@@ -56,14 +100,58 @@ def handle_error(
     except ClientError as e:
         logger.error("Unable to emit failure event: %s", str(e))
 
-    if change_msg_visibility:
-        try:
-            sqs_msg.change_visibility(VisibilityTimeout=0)
-        except (
-            sqs_msg.meta.client.exceptions.MessageNotInflight,
-            sqs_msg.meta.client.exceptions.ReceiptHandleIsInvalid,
-        ) as e:
-            logger.error("Unable to change message visibility: %s", str(e))
+    # Messages grouping several objects are completed by the caller
+    if change_msg_visibility and sqs_msg is not None:
+        reset_visibility(sqs_msg)
+
+
+def reset_visibility(sqs_msg):
+    try:
+        sqs_msg.change_visibility(VisibilityTimeout=0)
+    except (
+        sqs_msg.meta.client.exceptions.MessageNotInflight,
+        sqs_msg.meta.client.exceptions.ReceiptHandleIsInvalid,
+    ) as e:
+        logger.error("Unable to change message visibility: %s", str(e))
+
+
+def get_match_index(query_bucket, query_key):
+    """
+    Returns the compiled MatchIds of a query payload. Consecutive messages of
+    a job share the same payload, so it is only downloaded and compiled again
+    if its ETag changes
+    """
+    etag = s3_client.Object(query_bucket, query_key).e_tag
+    return compile_payload(query_bucket, query_key, etag)
+
+
+@lru_cache(maxsize=MATCH_INDEX_CACHE_SIZE)
+def compile_payload(query_bucket, query_key, etag):
+    raw_data = read_payload(s3_client, query_bucket, query_key, etag)
+    data = json.loads(raw_data.decode("utf-8"))
+    return MatchIndex(data["Columns"])
+
+
+def get_session_client(role_arn, cache=None):
+    """
+    Returns a session for the given role and its S3 client. Long lived
+    workers reuse them across messages, which also keeps the caches in s3.py
+    keyed by client warm
+    """
+    if cache is None:
+        cache = sessions
+    session, client, created_at = cache.get(role_arn, (None, None, 0))
+    if time.time() - created_at > SESSION_TTL:
+        session = get_session(role_arn)
+        # Sized for the concurrent ranged GETs and part uploads of an object
+        client = session.client(
+            "s3",
+            config=Config(
+                max_pool_connections=DOWNLOAD_CONCURRENCY + UPLOAD_CONCURRENCY
+            ),
+        )
+        cache[role_arn] = session, client, time.time()
+    return session, client
 
 
 def validate_message(message):
@@ -74,59 +162,170 @@ def validate_message(message):
             raise ValueError("Malformed message. Missing key: %s", k)
 
 
-def delete_matches_from_file(input_file, to_delete, file_format, compressed=False):
+def delete_matches_from_file(
+    input_file, to_delete, file_format, compressed=False, out_stream=None
+):
     logger.info("Generating new file without matches")
     if file_format == "json":
-        return delete_matches_from_json_file(input_file, to_delete, compressed)
-    return delete_matches_from_parquet_file(input_file, to_delete)
+        return delete_matches_from_json_file(
+            input_file, to_delete, compressed, out_stream
+        )
+    return delete_matches_from_parquet_file(input_file, to_delete, out_stream)
+
+
+def validate_deletions(object_path, stats):
+    if stats["DeletedRows"] == 0:
+        raise ValueError(
+            "The object {} was processed successfully but no rows required deletion".format(
+                object_path
+            )
+        )
+
+
+def get_grouped_objects(message_body):
+    """
+    Returns the objects of a message grouping several small objects, or None
+    if the message is for a single object
+    """
+    try:
+        return json.loads(message_body).get("Objects")
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def get_object_body(group_body, obj):
+    """
+    Returns the body of a single object message for an object of a group
+    """
+    body = {k: v for k, v in group_body.items() if k != "Objects"}
+    return json.dumps({**body, "Object": obj["Object"]})
+
+
+def handle_group_error(group_body, objects, err_message):
+    """
+    Emits the failure event of each of the given objects of a group, as the
+    events of the job always refer to a single object
+    """
+    for obj in objects:
+        handle_error(None, get_object_body(group_body, obj), err_message)
 
 
 def execute(queue_url, message_body, receipt_handle):
     logger.info("Message received")
     queue = get_queue(queue_url)
     msg = queue.Message(receipt_handle)
+    objects = get_grouped_objects(message_body)
+    if objects is None:
+        process_object(msg, message_body)
+    else:
+        process_group(queue, msg, message_body, objects)
+
+
+def process_group(queue, msg, message_body, objects):
+    """
+    Processes the objects of a message one after the other, sharing the
+    session and compiled query payload. Each object is processed as if it had
+    its own message and emits its own events. The objects which failed are
+    then sent back to the queue as messages of their own and the message is
+    deleted, so that the objects already processed are never processed again.
+    If the task is stopped, the objects not processed yet are sent back too.
+    Where any object can't be sent back, the message is made visible again
+    instead so that no object is dropped from the job.
+    """
+    body = json.loads(message_body)
+    failed = []
+    remaining = list(objects)
+    shutdown = False
+    previous_handler = signal.signal(signal.SIGTERM, raise_shutdown)
+    try:
+        try:
+            match_index = get_match_index(body["QueryBucket"], body["QueryKey"])
+        except Exception as e:
+            err_message = "Unable to retrieve query payload: {}".format(str(e))
+            handle_group_error(body, remaining, err_message)
+            failed, remaining = remaining, []
+        while remaining:
+            object_body = get_object_body(body, remaining[0])
+            if not process_object(None, object_body, match_index):
+                failed.append(remaining[0])
+            remaining.pop(0)
+    except ShutdownRequested:
+        shutdown = True
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+    if shutdown:
+        handle_group_error(body, remaining, SHUTDOWN_ERROR)
+        failed += remaining
+    if failed:
+        logger.error("%s of %s objects failed", str(len(failed)), str(len(objects)))
+    if return_to_queue(queue, body, failed):
+        msg.delete()
+    else:
+        reset_visibility(msg)
+    if shutdown:
+        sys.exit(1)
+
+
+def return_to_queue(queue, group_body, objects):
+    """
+    Sends the given objects of a group back to the queue as messages of their
+    own. Returns whether every object was sent.
+    """
+    if not objects:
+        return True
+    try:
+        failed = batch_sqs_msgs(
+            queue, [json.loads(get_object_body(group_body, obj)) for obj in objects]
+        )
+    except ClientError as e:
+        logger.error("Unable to return failed objects to the queue: %s", str(e))
+        return False
+    if failed:
+        logger.error(
+            "Unable to return %s failed objects to the queue: %s",
+            str(len(failed)),
+            ", ".join(f.get("Message", f.get("Code", "")) for f in failed),
+        )
+        return False
+    return True
+
+
+def process_object(msg, message_body, match_index=None):
+    """
+    Rewrites the object of a message without the matches of its query
+    payload. Where msg is None, the object is part of a group and the
+    message is left to the caller. Returns whether the object was processed.
+    """
     try:
         # Parse and validate incoming message
         validate_message(message_body)
         body = json.loads(message_body)
-        session = get_session(body.get("RoleArn"))
-        client = session.client("s3")
+        _, client = get_session_client(body.get("RoleArn"))
         query_bucket, query_key, object_path, job_id, file_format = itemgetter(
             "QueryBucket", "QueryKey", "Object", "JobId", "Format"
         )(body)
-        obj = s3_client.Object(query_bucket, query_key)
-        raw_data = obj.get()['Body'].read().decode('utf-8')
-        data = json.loads(raw_data)
-        cols = data["Columns"]
+        if match_index is None:
+            match_index = get_match_index(query_bucket, query_key)
         input_bucket, input_key = parse_s3_url(object_path)
         validate_bucket_versioning(client, input_bucket)
-        creds = session.get_credentials().get_frozen_credentials()
-        s3 = s3fs.S3FileSystem(
-            key=creds.access_key,
-            secret=creds.secret_key,
-            token=creds.token,
-            default_cache_type="none",
-            requester_pays=True,
-            default_fill_cache=False,
-            version_aware=True,
-        )
-        # Download the object in-memory and convert to PyArrow NativeFile
-        logger.info("Downloading and opening %s object in-memory", object_path)
-        with s3.open(object_path, "rb") as f:
+        # Stream the object, rewriting it in chunks straight back to S3
+        logger.info("Opening %s object", object_path)
+        with RangedObjectReader(client, input_bucket, input_key) as f:
             source_version = f.version_id
             logger.info("Using object version %s as source", source_version)
-            # Write new file in-memory
             compressed = object_path.endswith(".gz")
-            out_sink, stats = delete_matches_from_file(f, cols, file_format, compressed)
-        if stats["DeletedRows"] == 0:
-            raise ValueError(
-                "The object {} was processed successfully but no rows required deletion".format(
-                    object_path
-                )
-            )
-        with pa.BufferReader(out_sink.getvalue()) as output_buf:
-            new_version = save(
-                s3, client, output_buf, input_bucket, input_key, source_version
+
+            # Raising inside the write function aborts the upload
+            def write_new_object(out_stream):
+                with open_input(f, f.size) as input_file:
+                    _, stats = delete_matches_from_file(
+                        input_file, match_index, file_format, compressed, out_stream
+                    )
+                validate_deletions(object_path, stats)
+                return stats
+
+            new_version, stats = save_stream(
+                client, write_new_object, input_bucket, input_key, source_version
             )
         logger.info("New object version: %s", new_version)
         verify_object_versions_integrity(
@@ -139,8 +338,10 @@ def execute(queue_url, message_body, receipt_handle):
                 )
             )
             delete_old_versions(client, input_bucket, input_key, new_version)
-        msg.delete()
+        if msg is not None:
+            msg.delete()
         emit_deletion_event(body, stats)
+        return True
     except (KeyError, ArrowException) as e:
         err_message = "Apache Arrow processing error: {}".format(str(e))
         handle_error(msg, message_body, err_message)
@@ -181,14 +382,23 @@ def execute(queue_url, message_body, receipt_handle):
     except Exception as e:
         err_message = "Unknown error during message processing: {}".format(str(e))
         handle_error(msg, message_body, err_message)
+    return False
 
 
 def kill_handler(msgs, process_pool):
     logger.info("Received shutdown signal. Cleaning up %s messages", str(len(msgs)))
+    # Grouped messages being processed are cleaned up by their worker, which
+    # knows which of the objects were processed
+    running = process_pool.get_running()
     process_pool.terminate()
     for msg in msgs:
         try:
-            handle_error(msg, msg.body, "SIGINT/SIGTERM received during processing")
+            objects = get_grouped_objects(msg.body)
+            if objects is None:
+                handle_error(msg, msg.body, SHUTDOWN_ERROR)
+            elif msg.message_id not in running:
+                handle_group_error(json.loads(msg.body), objects, SHUTDOWN_ERROR)
+                reset_visibility(msg)
         except (ClientError, ValueError) as e:
             logger.error("Unable to gracefully cleanup message: %s", str(e))
     sys.exit(1 if len(msgs) > 0 else 0)
@@ -213,25 +423,191 @@ def get_queue(queue_url, **resource_kwargs):
     return sqs.Queue(queue_url)
 
 
-def main(queue_url, max_messages, wait_time, sleep_time):
+def get_max_in_flight(processes, max_worker_rss):
+    """
+    Sizes how many messages are held at once: one being processed and one
+    prefetched for each worker, so that workers never wait for SQS. Fewer
+    messages are prefetched if the available memory can't accommodate them
+    up to the worker memory watermark.
+    """
+    available_memory = get_available_memory()
+    if available_memory is None:
+        return 2 * processes
+    return max(processes, min(2 * processes, available_memory // max_worker_rss))
+
+
+def get_memory_budget():
+    """
+    Memory which the objects being processed may use, based on the container
+    memory limit or, without one, on the memory available at startup
+    """
+    memory = get_memory_limit() or get_available_memory()
+    return memory * MEMORY_BUDGET_RATIO if memory else float("inf")
+
+
+def estimate_message(message_body):
+    """
+    Estimates the working set needed to process the object of a message
+    using its size, or the largest of the objects grouped in a message.
+    Messages whose object can't be inspected are estimated to need no
+    memory, as processing them reports the error
+    """
+    try:
+        body = json.loads(message_body)
+        if "Objects" in body:
+            # Grouped objects are processed one at a time
+            return max(
+                estimate_working_set(
+                    obj["Size"], body.get("Format"), obj["Object"].endswith(".gz")
+                )
+                for obj in body["Objects"]
+            )
+        object_path = body["Object"]
+        bucket, key = parse_s3_url(object_path)
+        _, client = get_session_client(body.get("RoleArn"), estimate_sessions)
+        object_info = client.head_object(
+            Bucket=bucket, Key=key, **get_requester_payment(client, bucket)[0]
+        )
+        return estimate_working_set(
+            object_info["ContentLength"],
+            body.get("Format"),
+            object_path.endswith(".gz"),
+        )
+    except (BotoCoreError, ClientError, KeyError, ValueError) as e:
+        logger.warning("Unable to estimate object memory usage: %s", str(e))
+        return 0
+
+
+def get_estimate_roles(message_bodies):
+    """
+    Returns the roles needed to inspect the objects of the given messages
+    """
+    roles = set()
+    for message_body in message_bodies:
+        try:
+            body = json.loads(message_body)
+            if "Object" in body:
+                roles.add(body.get("RoleArn"))
+        except (TypeError, ValueError, AttributeError):
+            pass
+    return roles
+
+
+def estimate_messages(message_bodies):
+    """
+    Estimates the working sets of the given messages. The sessions of the
+    roles involved are created first, then the objects inspected, both
+    concurrently so that sizing a batch of messages doesn't hold up the
+    admission of work for one request after the other.
+    """
+    with ThreadPoolExecutor(ESTIMATE_CONCURRENCY) as executor:
+        list(executor.map(get_estimate_session, get_estimate_roles(message_bodies)))
+        return list(executor.map(estimate_message, message_bodies))
+
+
+def get_estimate_session(role_arn):
+    try:
+        get_session_client(role_arn, estimate_sessions)
+    except (BotoCoreError, ClientError) as e:
+        # Reported by the estimates of the messages using the role
+        logger.warning("Unable to create session: %s", str(e))
+
+
+def extend_visibility(queue, in_flight, visibility_timeout):
+    """
+    Extends the visibility timeout of the messages being processed or waiting
+    for a worker once half of it has elapsed, so that they are not received
+    again while still in progress
+    """
+    now = time.time()
+    due = [
+        (message_id, msg)
+        for message_id, (msg, extended_at) in in_flight.items()
+        if now - extended_at > visibility_timeout / 2
+    ]
+    for i in range(0, len(due), 10):
+        batch = due[i : i + 10]
+        try:
+            resp = queue.change_message_visibility_batch(
+                Entries=[
+                    {
+                        "Id": message_id,
+                        "ReceiptHandle": msg.receipt_handle,
+                        "VisibilityTimeout": visibility_timeout,
+                    }
+                    for message_id, msg in batch
+                ]
+            )
+            for failure in resp.get("Failed", []):
+                # Messages completed in the meantime are expected to fail
+                logger.warning(
+                    "Unable to extend message visibility: %s", failure["Message"]
+                )
+        except ClientError as e:
+            logger.error("Unable to extend message visibility: %s", str(e))
+        for message_id, msg in batch:
+            in_flight[message_id] = msg, now
+
+
+def main(
+    queue_url,
+    max_messages,
+    wait_time,
+    sleep_time,
+    max_worker_rss=MAX_WORKER_RSS,
+    max_in_flight=None,
+):
     logger.info("CPU count for system: %s", cpu_count())
-    messages = []
+    max_worker_rss = max_worker_rss * 1024 * 1024
+    if not max_in_flight:
+        max_in_flight = get_max_in_flight(cpu_count(), max_worker_rss)
+    logger.info("Processing up to %s messages at once", str(max_in_flight))
+    # Messages received and not completed yet, by message ID
+    in_flight = {}
     queue = get_queue(queue_url)
-    with Pool(maxtasksperchild=1) as pool:
-        signal.signal(signal.SIGINT, lambda *_: kill_handler(messages, pool))
-        signal.signal(signal.SIGTERM, lambda *_: kill_handler(messages, pool))
+    visibility_timeout = int(queue.attributes["VisibilityTimeout"])
+    memory_budget = get_memory_budget()
+    logger.info("Memory budget for objects: %s bytes", str(memory_budget))
+    admission = AdmissionController(memory_budget, cpu_count())
+    with WorkerPool(cpu_count(), max_worker_rss) as pool:
+        signal.signal(
+            signal.SIGINT,
+            lambda *_: kill_handler([m for m, _ in in_flight.values()], pool),
+        )
+        signal.signal(
+            signal.SIGTERM,
+            lambda *_: kill_handler([m for m, _ in in_flight.values()], pool),
+        )
         while 1:
-            logger.info("Fetching messages...")
-            messages = queue.receive_messages(
-                WaitTimeSeconds=wait_time, MaxNumberOfMessages=max_messages
-            )
-            if len(messages) == 0:
-                logger.info("No messages. Sleeping")
-                time.sleep(sleep_time)
-            else:
-                processes = [(queue_url, m.body, m.receipt_handle) for m in messages]
-                pool.starmap(execute, processes)
-                messages = []
+            free_slots = max_in_flight - len(in_flight)
+            completion_wait = POLL_INTERVAL
+            if free_slots > 0:
+                logger.debug("Fetching messages...")
+                # While messages are in flight, the long poll is capped so that
+                # completed tasks are still collected every POLL_INTERVAL
+                poll_wait = min(wait_time, POLL_INTERVAL) if in_flight else wait_time
+                completion_wait = max(POLL_INTERVAL - poll_wait, 0)
+                messages = queue.receive_messages(
+                    WaitTimeSeconds=poll_wait,
+                    MaxNumberOfMessages=min(max_messages, free_slots),
+                )
+                estimates = estimate_messages([m.body for m in messages])
+                for m, estimate in zip(messages, estimates):
+                    in_flight[m.message_id] = m, time.time()
+                    admission.add(m.message_id, estimate)
+                if len(in_flight) == 0:
+                    logger.info("No messages. Sleeping")
+                    time.sleep(sleep_time)
+                    continue
+            for message_id in admission.admit():
+                m, _ = in_flight[message_id]
+                pool.submit(
+                    message_id, execute, (queue_url, m.body, m.receipt_handle)
+                )
+            for message_id in pool.get_completed(timeout=completion_wait):
+                in_flight.pop(message_id, None)
+                admission.complete(message_id)
+            extend_visibility(queue, in_flight, visibility_timeout)
 
 
 def parse_args(args):
@@ -239,14 +615,29 @@ def parse_args(args):
         description="Read and process new deletion tasks from a deletion queue"
     )
     parser.add_argument("--wait_time", type=int, default=5)
-    parser.add_argument("--max_messages", type=int, default=1)
+    parser.add_argument("--max_messages", type=int, default=10)
     parser.add_argument("--sleep_time", type=int, default=30)
     parser.add_argument(
         "--queue_url", type=str, default=os.getenv("DELETE_OBJECTS_QUEUE")
     )
+    parser.add_argument(
+        "--max_worker_rss",
+        type=int,
+        default=int(os.getenv("MAX_WORKER_RSS", MAX_WORKER_RSS)),
+    )
+    parser.add_argument(
+        "--max_in_flight", type=int, default=os.getenv("MAX_IN_FLIGHT")
+    )
     return parser.parse_args(args)
 
 
 if __name__ == "__main__":
     opts = parse_args(sys.argv[1:])
-    main(opts.queue_url, opts.max_messages, opts.wait_time, opts.sleep_time)
+    main(
+        opts.queue_url,
+        opts.max_messages,
+        opts.wait_time,
+        opts.sleep_time,
+        opts.max_worker_rss,
+        opts.max_in_flight,
+    )
@@ -0,0 +1,89 @@
+import pyarrow as pa
+
+
+def compile_column(column):
+    """
+    Compiles the MatchIds of a column into a hash set for row by row lookups
+    and a sorted list for comparisons against min/max statistics. MatchIds are
+    already converted to the Glue column type when the query payload is
+    generated. The sorted list is None when the MatchIds cannot be sorted.
+    """
+    match_id_set = frozenset(column["MatchIds"])
+    try:
+        sorted_match_ids = sorted(match_id_set)
+    except TypeError:
+        sorted_match_ids = None
+    return {
+        **column,
+        "MatchIdSet": match_id_set,
+        "SortedMatchIds": sorted_match_ids,
+    }
+
+
+def to_value_set(match_ids, arrow_type):
+    """
+    Converts MatchIds to an Arrow array of the given type, or of the value
+    type of dictionary encoded columns. MatchIds which can't be represented
+    exactly in that type, such as strings for an integer column or integers
+    out of the range of the column, can't match any value and are left out.
+    """
+    if pa.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    try:
+        array = pa.array(match_ids, type=arrow_type)
+        if array.to_pylist() == list(match_ids):
+            return array
+    except (pa.ArrowException, OverflowError):
+        pass
+    values = []
+    for match_id in match_ids:
+        try:
+            value = pa.array([match_id], type=arrow_type)[0].as_py()
+        except (pa.ArrowException, OverflowError):
+            continue
+        # Conversions may truncate, for instance floats to integers
+        if value == match_id:
+            values.append(match_id)
+    return pa.array(values, type=arrow_type)
+
+
+class MatchIndex:
+    """
+    Compiled form of the columns and MatchIds of a query payload. It is built
+    once per payload and shared by every object processed against it, so that
+    the structures used for matching are not rebuilt for every object.
+    """
+
+    def __init__(self, to_delete):
+        self.columns = [compile_column(column) for column in to_delete]
+        self._arrays = {}
+        self._compiled = {}
+
+    def get_array(self, column, arrow_type):
+        """
+        Returns the MatchIds of a column as an Arrow array of the given type,
+        converting them only the first time a type is requested
+        """
+        key = (column["Column"], arrow_type)
+        if key not in self._arrays:
+            self._arrays[key] = to_value_set(column["MatchIds"], arrow_type)
+        return self._arrays[key]
+
+    def get_compiled(self, name, compile_fn):
+        """
+        Returns a format specific structure compiled from the columns,
+        invoking compile_fn only the first time it is requested
+        """
+        if name not in self._compiled:
+            self._compiled[name] = compile_fn(self.columns)
+        return self._compiled[name]
+
+
+def get_match_index(to_delete):
+    """
+    Handlers accept either a MatchIndex or the raw list of columns of a
+    query payload, which is compiled on the fly
+    """
+    if isinstance(to_delete, MatchIndex):
+        return to_delete
+    return MatchIndex(to_delete)
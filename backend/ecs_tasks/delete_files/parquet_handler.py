@@ -1,33 +1,62 @@
 import logging
+from bisect import bisect_left
 from collections import Counter
 
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 
+from match_index import get_match_index
+
 logger = logging.getLogger(__name__)
 
+# Codecs of the Parquet format mapped to the names used by ParquetWriter.
+# Codecs pyarrow can't write, such as LZO, fall back to its default (snappy).
+# So do LZ4 and LZ4_RAW, as pyarrow writes LZ4 with a framing which older
+# Athena, Hive and Spark readers can't read reliably
+WRITER_CODECS = {
+    "UNCOMPRESSED": "none",
+    "SNAPPY": "snappy",
+    "GZIP": "gzip",
+    "BROTLI": "brotli",
+    "ZSTD": "zstd",
+}
+
 
 def load_parquet(f):
     return pq.ParquetFile(f, memory_map=False)
 
 
-def get_row_count(df):
-    return len(df.index)
+def get_column(table, column_name):
+    """
+    Lookup a column by its identifier. Columns nested inside structs are
+    identified using dot notation (for instance, foo.bar), in which case the
+    struct's child array is returned. Child arrays are zero-copy views of the
+    parent's data, so unlike flattening the whole table this only touches
+    the columns needed to identify the rows to delete.
+    """
+    segments = column_name.split(".")
+    column = table.column(segments[0])
+    for segment in segments[1:]:
+        column = column.flatten()[column.type.get_field_index(segment)]
+    return column
 
 
-def needs_flattening(to_delete):
+def get_deletion_mask(table, match_index):
     """
-    Lookup the columns to identify if any are nested inside structs
-    (and therefore represented in a form like foo.bar).
-
-    Operating on flattened columns is necessary when operating with 
-    complex column types but it impacts performance during write as
-    we need to re-allocate the data in-memory as unflattened to 
-    preserve the initial schema's hierarchy after figuring out which rows
-    need deletion. This is why we check first: it allows to do the
-    re-allocation only if necessary.
+    Generates a boolean mask which is true for every row where any of the
+    MatchIds is found as value in the corresponding column. MatchIds which
+    don't fit the type of the column can't match and are ignored.
     """
-    return any("." in x["Column"] for x in to_delete)
+    mask = None
+    for column in match_index.columns:
+        if not column["MatchIds"]:
+            continue
+        values = get_column(table, column["Column"])
+        value_set = match_index.get_array(column, values.type)
+        matches = pc.is_in(values, value_set=value_set)
+        mask = matches if mask is None else pc.or_(mask, matches)
+    return mask
 
 
 def delete_from_table(table, to_delete, schema):
@@ -35,45 +64,195 @@ def delete_from_table(table, to_delete, schema):
     Deletes rows from a Arrow Table where any of the MatchIds is found as
     value in any of the columns
     """
-    needs_flattened_columns = needs_flattening(to_delete)
-    df = (table.flatten() if needs_flattened_columns else table).to_pandas()
-    initial_rows = get_row_count(df)
-    indexes_to_delete = []
-    for column in to_delete:
-        indexes = df[column["Column"]].isin(column["MatchIds"])
-        indexes_to_delete.append(indexes)
-        df = df[~indexes]
-    if needs_flattened_columns:
-        df = table.to_pandas()
-        for indexes in indexes_to_delete:
-            df = df[~indexes]
-    deleted_rows = initial_rows - get_row_count(df)
-    table = pa.Table.from_pandas(
-        df, schema=schema, preserve_index=True
+    mask = get_deletion_mask(table, get_match_index(to_delete))
+    filtered = table if mask is None else table.filter(pc.invert(mask))
+    deleted_rows = table.num_rows - filtered.num_rows
+    table = pa.Table.from_arrays(
+        filtered.columns, schema=schema
     ).replace_schema_metadata()
     return table, deleted_rows
 
 
-def delete_matches_from_parquet_file(input_file, to_delete):
+def column_chunk_may_contain_matches(column_chunk, sorted_match_ids):
+    """
+    Uses the statistics of a column chunk to identify whether any of its
+    values can be one of the MatchIds. Returns True whenever the statistics
+    are not sufficient to rule it out.
+    """
+    if sorted_match_ids is None or not column_chunk.is_stats_set:
+        return True
+    stats = column_chunk.statistics
+    if stats.has_null_count and stats.num_values == 0:
+        # Only nulls in the column chunk
+        return False
+    if not stats.has_min_max:
+        return True
+    try:
+        i = bisect_left(sorted_match_ids, stats.min)
+        return i < len(sorted_match_ids) and sorted_match_ids[i] <= stats.max
+    except TypeError:
+        return True
+
+
+def row_group_may_contain_matches(row_group_metadata, to_delete):
+    """
+    Identifies whether any row of a row group may need deletion. A row is
+    deleted when any of its columns contains a match, therefore a row group
+    can only be skipped if none of its column chunks can contain a match.
+    """
+    column_chunks = {}
+    for i in range(row_group_metadata.num_columns):
+        column_chunk = row_group_metadata.column(i)
+        column_chunks[column_chunk.path_in_schema] = column_chunk
+    for column in get_match_index(to_delete).columns:
+        if not column["MatchIds"]:
+            continue
+        column_chunk = column_chunks.get(column["Column"])
+        if column_chunk is None or column_chunk_may_contain_matches(
+            column_chunk, column["SortedMatchIds"]
+        ):
+            return True
+    return False
+
+
+def get_writer_properties(metadata):
+    """
+    Derives the ParquetWriter properties from the metadata of the source file,
+    so that the rewritten file is encoded as the original: the format version,
+    the codec, dictionary encoding and statistics of each column, and INT96
+    timestamps as commonly written by Hive and Spark. The settings of the
+    column chunks of the first row group are used for the whole file. The
+    compression level and data page size are not recorded in the metadata,
+    so the writer defaults are used for those.
+    """
+    properties = {"version": metadata.format_version}
+    if metadata.num_row_groups == 0:
+        return properties
+    row_group = metadata.row_group(0)
+    column_chunks = [row_group.column(i) for i in range(row_group.num_columns)]
+    properties.update(
+        {
+            "compression": {
+                c.path_in_schema: WRITER_CODECS.get(c.compression, "snappy")
+                for c in column_chunks
+            },
+            "use_dictionary": [
+                c.path_in_schema for c in column_chunks if c.has_dictionary_page
+            ],
+            "write_statistics": [
+                c.path_in_schema for c in column_chunks if c.is_stats_set
+            ],
+            "use_deprecated_int96_timestamps": any(
+                c.physical_type == "INT96" for c in column_chunks
+            ),
+        }
+    )
+    return properties
+
+
+def get_column_chunk_ranges(row_group_metadata, columns=None):
+    """
+    Returns the (start, end) byte ranges of the column chunks of a row group,
+    optionally only those of the given columns and of their nested fields
+    """
+    ranges = []
+    for i in range(row_group_metadata.num_columns):
+        column_chunk = row_group_metadata.column(i)
+        path = column_chunk.path_in_schema
+        if columns is not None and not any(
+            path == column or path.startswith(column + ".") for column in columns
+        ):
+            continue
+        start = column_chunk.data_page_offset
+        if column_chunk.has_dictionary_page:
+            start = min(start, column_chunk.dictionary_page_offset)
+        ranges.append((start, start + column_chunk.total_compressed_size))
+    return ranges
+
+
+def find_row_groups_with_matches(parquet_file, match_index, prefetch=None):
+    """
+    Identifies the row groups containing at least one match by reading only
+    the identifier columns of the row groups which statistics don't exclude.
+    For nested identifiers, only the identifier field of the struct is read.
+    """
+    columns = [
+        column["Column"] for column in match_index.columns if column["MatchIds"]
+    ]
+    with_matches = set()
+    if not columns:
+        return with_matches
+    for row_group in range(parquet_file.num_row_groups):
+        row_group_metadata = parquet_file.metadata.row_group(row_group)
+        if not row_group_may_contain_matches(row_group_metadata, match_index):
+            continue
+        if prefetch:
+            prefetch(get_column_chunk_ranges(row_group_metadata, columns))
+        table = parquet_file.read_row_group(row_group, columns=columns)
+        mask = get_deletion_mask(table, match_index)
+        if mask is not None and (pc.sum(mask).as_py() or 0) > 0:
+            with_matches.add(row_group)
+    return with_matches
+
+
+def delete_matches_from_parquet_file(input_file, to_delete, out_stream=None):
     """
     Deletes matches from Parquet file where to_delete is a list of dicts where
     each dict contains a column to search and the MatchIds to search for in
-    that particular column
+    that particular column.
+
+    The file is read in two phases. The first reads only the identifier
+    columns to find the row groups containing matches, and if there are none
+    nothing is written. The second reads whole row groups, only filtering
+    those containing matches.
+
+    Row groups are written to out_stream as soon as they have been processed,
+    so when out_stream is backed by a multipart upload only one row group at
+    a time is held in memory. When no out_stream is given, the new file is
+    buffered in memory.
     """
+    if out_stream is None:
+        with pa.BufferOutputStream() as out_stream:
+            return delete_matches_from_parquet_file(input_file, to_delete, out_stream)
     parquet_file = load_parquet(input_file)
     schema = parquet_file.metadata.schema.to_arrow_schema().remove_metadata()
     total_rows = parquet_file.metadata.num_rows
-    stats = Counter({"ProcessedRows": total_rows, "DeletedRows": 0})
-    with pa.BufferOutputStream() as out_stream:
-        with pq.ParquetWriter(out_stream, schema) as writer:
-            for row_group in range(parquet_file.num_row_groups):
-                logger.info(
-                    "Row group %s/%s",
-                    str(row_group + 1),
-                    str(parquet_file.num_row_groups),
-                )
-                table = parquet_file.read_row_group(row_group)
-                table, deleted_rows = delete_from_table(table, to_delete, schema)
-                writer.write_table(table)
-                stats.update({"DeletedRows": deleted_rows})
+    stats = Counter(
+        {
+            "ProcessedRows": total_rows,
+            "DeletedRows": 0,
+            "ProcessedRowGroups": parquet_file.num_row_groups,
+            "SkippedRowGroups": 0,
+        }
+    )
+    match_index = get_match_index(to_delete)
+    # Readers able to prefetch byte ranges fetch each row group concurrently
+    prefetch = getattr(input_file, "prefetch", None)
+    with_matches = find_row_groups_with_matches(parquet_file, match_index, prefetch)
+    if not with_matches:
+        logger.info("No row group contains matches")
+        stats.update({"SkippedRowGroups": parquet_file.num_row_groups})
         return out_stream, stats
+    writer_properties = get_writer_properties(parquet_file.metadata)
+    with pq.ParquetWriter(out_stream, schema, **writer_properties) as writer:
+        for row_group in range(parquet_file.num_row_groups):
+            logger.info(
+                "Row group %s/%s",
+                str(row_group + 1),
+                str(parquet_file.num_row_groups),
+            )
+            row_group_metadata = parquet_file.metadata.row_group(row_group)
+            if prefetch:
+                prefetch(get_column_chunk_ranges(row_group_metadata))
+            table = parquet_file.read_row_group(row_group)
+            if row_group in with_matches:
+                table, deleted_rows = delete_from_table(table, match_index, schema)
+                stats.update({"DeletedRows": deleted_rows})
+            else:
+                # pyarrow can't copy column chunks as they are, so a row
+                # group without matches is still decoded and re-encoded
+                logger.info("Row group contains no matches. Skipping")
+                stats.update({"SkippedRowGroups": 1})
+            # Each source row group is written as a single row group
+            writer.write_table(table, row_group_size=max(table.num_rows, 1))
+    return out_stream, stats
@@ -0,0 +1,77 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv(
+    "PAYLOAD_CACHE_DIR", os.path.join(tempfile.gettempdir(), "s3f2-query-payloads")
+)
+MAX_CACHE_SIZE = int(os.getenv("PAYLOAD_CACHE_SIZE", 256 * 1024 * 1024))
+
+
+def get_cache_path(bucket, key, etag):
+    digest = hashlib.sha256("\n".join([bucket, key, etag]).encode("utf-8"))
+    return os.path.join(CACHE_DIR, digest.hexdigest())
+
+
+def read_payload(s3_resource, bucket, key, etag):
+    """
+    Reads the raw content of a query payload. Payloads are stored on disk the
+    first time they are downloaded, so that the workers processing the
+    following messages of the job don't need to download them again. As the
+    ETag is part of the cache key, a modified payload is never read from disk.
+    """
+    cache_path = get_cache_path(bucket, key, etag)
+    try:
+        with open(cache_path, "rb") as f:
+            raw_data = f.read()
+        # The modification time tracks the last use for eviction
+        os.utime(cache_path)
+        return raw_data
+    except FileNotFoundError:
+        pass
+    obj = s3_resource.Object(bucket, key)
+    raw_data = obj.get(IfMatch=etag)["Body"].read()
+    store_payload(cache_path, raw_data)
+    return raw_data
+
+
+def store_payload(cache_path, raw_data):
+    """
+    Atomically writes a payload to the cache, then evicts the least recently
+    used payloads until the cache fits in MAX_CACHE_SIZE. Failing to write to
+    the cache is not an error as the payload can always be downloaded again.
+    """
+    if len(raw_data) > MAX_CACHE_SIZE:
+        return
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, delete=False) as f:
+            f.write(raw_data)
+        os.replace(f.name, cache_path)
+        evict_payloads(keep=cache_path)
+    except OSError as e:
+        logger.warning("Unable to cache query payload: %s", str(e))
+
+
+def evict_payloads(keep):
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        try:
+            entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+        except FileNotFoundError:
+            # Evicted concurrently by another worker
+            pass
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if cache_size <= MAX_CACHE_SIZE:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
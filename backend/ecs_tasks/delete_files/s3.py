@@ -1,5 +1,11 @@
+import base64
+import hashlib
+import io
 import logging
-from functools import lru_cache
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, wraps
 from urllib.parse import urlencode, quote_plus
 
 from boto_utils import paginate
@@ -11,27 +17,381 @@ logger = logging.getLogger(__name__)
 # TODO:: This module should be placed in a directory which is shared between ecs_tasks and lambdas
 #  stream_processor uses it to rollback corrupted files. currently created a duplication.
 
+# Size of the ranged GETs issued by RangedObjectReader
+DOWNLOAD_PART_SIZE = 4 * 1024 * 1024
+# Number of ranged GETs issued concurrently, within the default connection
+# pool size of the boto3 client
+DOWNLOAD_CONCURRENCY = 8
+# Size of the tail fetched when opening an object, which holds the footer
+# of a Parquet file in most cases
+FOOTER_SIZE = 256 * 1024
+# Ranges closer than this are fetched as one range
+RANGE_COALESCE_GAP = 64 * 1024
+# Objects whose settings are gathered concurrently. The object level settings
+# of each are fetched concurrently on a pool of their own, as waiting on calls
+# queued to the same pool could leave no thread free to run them
+OBJECT_SETTINGS_CONCURRENCY = 8
+OBJECT_SETTINGS_GETTERS = 3
+# Size of the parts of multipart uploads. 10,000 parts of 16MB allow objects of
+# up to 156GB to be rewritten
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", 16 * 1024 * 1024))
+# Number of parts uploaded concurrently per object
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 4))
+
+settings_executor = ThreadPoolExecutor(OBJECT_SETTINGS_CONCURRENCY)
+getter_executor = ThreadPoolExecutor(
+    OBJECT_SETTINGS_CONCURRENCY * OBJECT_SETTINGS_GETTERS
+)
+
+
+def save_stream(client, write_fn, bucket, key, source_version=None):
+    """
+    Stream a new version of an object to S3, preserving any existing properties on the object.
+    write_fn is called with a writable file object backed by a multipart upload, so
+    parts are uploaded as soon as they are written and the object is never held in memory
+    as a whole. If write_fn raises, the upload is aborted and no new version is created
+    The settings of the object are gathered while write_fn runs, as they are only
+    needed once the first part is uploaded
+    :returns tuple containing the new version id and the value returned by write_fn
+    """
+    extra_args = settings_executor.submit(
+        get_object_settings, client, bucket, key, source_version
+    )
+    logger.info("Streaming updated object to s3://%s/%s", bucket, key)
+    f = MultipartUploadWriter(client, bucket, key, extra_args)
+    try:
+        result = write_fn(f)
+    except BaseException:
+        logger.info("Aborting upload of s3://%s/%s", bucket, key)
+        f.discard()
+        raise
+    f.close()
+    new_version_id = f.version_id
+    logger.info("Object uploaded to S3")
+    restore_write_grants(client, bucket, key, source_version, new_version_id)
+    logger.info("Processing of file s3://%s/%s complete", bucket, key)
+    return new_version_id, result
+
+
+class MultipartUploadWriter:
+    """
+    Write only file object backed by a multipart upload. Parts of
+    UPLOAD_PART_SIZE are uploaded as soon as they are written, up to
+    UPLOAD_CONCURRENCY at a time, so writes only block when that many parts are
+    already in flight. Each part is sent with its MD5 so that S3 rejects parts
+    corrupted in transit, and the ETag of the completed object is checked
+    against the one expected from the parts. Unlike io classes, it is never
+    closed implicitly, as closing completes the upload.
+
+    The upload is only created when the first part is uploaded, so extra_args
+    can be a Future resolving to the args of CreateMultipartUpload while the
+    new content is being generated.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket,
+        key,
+        extra_args,
+        part_size=None,
+        concurrency=None,
+    ):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._extra_args = extra_args
+        self._part_size = part_size or UPLOAD_PART_SIZE
+        self._concurrency = concurrency or UPLOAD_CONCURRENCY
+        self._args = None
+        self._verify_etag = True
+        self._executor = ThreadPoolExecutor(self._concurrency)
+        self._buffer = bytearray()
+        self._digests = []
+        self._uploads = deque()
+        self._parts = []
+        self._position = 0
+        self.closed = False
+        self.version_id = None
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def _create_upload(self):
+        extra_args = self._extra_args
+        if isinstance(extra_args, Future):
+            extra_args = extra_args.result()
+        args = {"Bucket": self._bucket, "Key": self._key}
+        if "RequestPayer" in extra_args:
+            args["RequestPayer"] = extra_args["RequestPayer"]
+        resp = self._client.create_multipart_upload(**{**extra_args, **args})
+        self._args = {**args, "UploadId": resp["UploadId"]}
+        # The ETag of objects encrypted with KMS or customer keys isn't the MD5
+        # of their content
+        self._verify_etag = (
+            not resp.get("ServerSideEncryption", "").startswith("aws:kms")
+            and "SSECustomerAlgorithm" not in resp
+        )
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        view = memoryview(data).cast("B")
+        self._position += len(view)
+        # Whole parts are sliced straight from the written data
+        if not self._buffer:
+            while len(view) >= self._part_size:
+                self._upload_part(view[: self._part_size])
+                view = view[self._part_size :]
+        self._buffer += view
+        while len(self._buffer) >= self._part_size:
+            self._upload_part(self._buffer[: self._part_size])
+            del self._buffer[: self._part_size]
+        return len(data)
+
+    def _upload_part(self, data):
+        if self._args is None:
+            self._create_upload()
+        # Bound the parts held in memory by waiting for the oldest upload
+        if len(self._uploads) >= self._concurrency:
+            self._parts.append(self._uploads.popleft().result())
+        data = bytes(data)
+        part_number = len(self._digests) + 1
+        digest = hashlib.md5(data).digest()
+        self._digests.append(digest)
+        self._uploads.append(
+            self._executor.submit(
+                self._client.upload_part,
+                Body=data,
+                PartNumber=part_number,
+                ContentMD5=base64.b64encode(digest).decode("ascii"),
+                **self._args
+            )
+        )
+
+    def discard(self):
+        """
+        Aborts the upload, so that no new version of the object is created
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for upload in self._uploads:
+            upload.cancel()
+        self._executor.shutdown(wait=True)
+        self._buffer = bytearray()
+        if self._args is not None:
+            self._client.abort_multipart_upload(**self._args)
+
+    def close(self):
+        """
+        Uploads the last part and completes the upload. The upload is aborted if
+        it can't be completed
+        """
+        if self.closed:
+            return
+        try:
+            # An empty object is uploaded as a single empty part
+            if self._buffer or not self._digests:
+                self._upload_part(self._buffer)
+            while self._uploads:
+                self._parts.append(self._uploads.popleft().result())
+            resp = self._client.complete_multipart_upload(
+                MultipartUpload={
+                    "Parts": [
+                        {"ETag": part["ETag"], "PartNumber": i + 1}
+                        for i, part in enumerate(self._parts)
+                    ]
+                },
+                **self._args
+            )
+        except BaseException:
+            self.discard()
+            raise
+        self.closed = True
+        self._executor.shutdown(wait=True)
+        self.version_id = resp.get("VersionId")
+        expected_etag = '"{}-{}"'.format(
+            hashlib.md5(b"".join(self._digests)).hexdigest(), len(self._digests)
+        )
+        if self._verify_etag and resp["ETag"] != expected_etag:
+            raise IntegrityCheckFailedError(
+                "Uploaded object ETag {} doesn't match expected ETag {}".format(
+                    resp["ETag"], expected_etag
+                ),
+                self._client,
+                self._bucket,
+                self._key,
+                self.version_id,
+            )
+
+
+class RangedObjectReader(io.RawIOBase):
+    """
+    Seekable read only file object over an S3 object, pinned to the version
+    which was the latest when it was opened. Reads are served with ranged
+    GETs, split into parts which are fetched concurrently. Byte ranges known
+    to be needed next can be prefetched, after which reads within them are
+    served from memory.
+    """
+
+    def __init__(self, client, bucket, key, version_id=None):
+        super().__init__()
+        self._client = client
+        self._args = {
+            "Bucket": bucket,
+            "Key": key,
+            **get_requester_payment(client, bucket)[0],
+        }
+        if version_id:
+            self._args["VersionId"] = version_id
+        self._executor = ThreadPoolExecutor(DOWNLOAD_CONCURRENCY)
+        self._position = 0
+        # The tail is fetched first: its response also provides the size of
+        # the object and the version which all the later requests are pinned to
+        try:
+            resp = client.get_object(
+                Range="bytes=-{}".format(FOOTER_SIZE), **self._args
+            )
+            tail = resp["Body"].read()
+            self.size = int(resp["ContentRange"].rsplit("/", 1)[1])
+        except ClientError as e:
+            # Ranges can't be satisfied for empty objects
+            if e.response.get("Error", {}).get("Code") != "InvalidRange":
+                raise
+            resp = client.head_object(**self._args)
+            tail = b""
+            self.size = resp["ContentLength"]
+        self.version_id = resp.get("VersionId")
+        self._args["VersionId"] = self.version_id
+        self._tail = (self.size - len(tail), tail)
+        self._buffers = [self._tail]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._position = offset
+        return self._position
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._buffers = []
+        super().close()
+
+    def _get_part(self, start, end):
+        resp = self._client.get_object(
+            Range="bytes={}-{}".format(start, end - 1), **self._args
+        )
+        return resp["Body"].read()
+
+    def _fetch(self, start, end):
+        """
+        Fetches a byte range with concurrent ranged GETs of DOWNLOAD_PART_SIZE
+        """
+        parts = self._executor.map(
+            lambda part_start: self._get_part(
+                part_start, min(part_start + DOWNLOAD_PART_SIZE, end)
+            ),
+            range(start, end, DOWNLOAD_PART_SIZE),
+        )
+        return b"".join(parts)
+
+    def prefetch(self, ranges):
+        """
+        Fetches the given (start, end) byte ranges, coalescing those which are
+        close to each other, and keeps them in memory in place of any range
+        prefetched previously. The tail of the object is always kept.
+        """
+        coalesced = []
+        for start, end in sorted(ranges):
+            if coalesced and start <= coalesced[-1][1] + RANGE_COALESCE_GAP:
+                coalesced[-1][1] = max(coalesced[-1][1], end)
+            else:
+                coalesced.append([start, end])
+        # Release the previous ranges before fetching the next ones
+        self._buffers = [self._tail]
+        self._buffers.extend(
+            (start, self._fetch(start, min(end, self.size)))
+            for start, end in coalesced
+        )
+
+    def read(self, size=-1):
+        self._checkClosed()
+        start = self._position
+        end = self.size if size is None or size < 0 else min(self.size, start + size)
+        chunks = []
+        position = start
+        while position < end:
+            for buffer_start, data in self._buffers:
+                if buffer_start <= position < buffer_start + len(data):
+                    chunk_end = min(end, buffer_start + len(data))
+                    chunks.append(
+                        data[position - buffer_start : chunk_end - buffer_start]
+                    )
+                    break
+            else:
+                # Fetch up to the next buffered range, if any
+                chunk_end = min(
+                    [end] + [b for b, _ in self._buffers if position < b < end]
+                )
+                chunks.append(self._fetch(position, chunk_end))
+            position = chunk_end
+        self._position = max(start, end)
+        return b"".join(chunks)
+
+    def readall(self):
+        return self.read()
 
-def save(s3, client, buf, bucket, key, source_version=None):
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+
+def get_object_settings(client, bucket, key, source_version=None):
     """
-    Save a buffer to S3, preserving any existing properties on the object
+    Generates a dict containing all the args which need to be supplied when writing
+    a new version of an object in order to preserve the existing object's properties.
+    The object level settings are fetched concurrently
     """
-    # Get Object Settings
     request_payer_args, _ = get_requester_payment(client, bucket)
-    object_info_args, _ = get_object_info(client, bucket, key, source_version)
-    tagging_args, _ = get_object_tags(client, bucket, key, source_version)
-    acl_args, acl_resp = get_object_acl(client, bucket, key, source_version)
+    object_info, tagging, acl = [
+        getter_executor.submit(getter, client, bucket, key, source_version)
+        for getter in [get_object_info, get_object_tags, get_object_acl]
+    ]
+    object_info_args, _ = object_info.result()
+    tagging_args, _ = tagging.result()
+    acl_args, _ = acl.result()
     extra_args = {**request_payer_args, **object_info_args, **tagging_args, **acl_args}
     logger.info("Object settings: %s", extra_args)
-    # Write Object Back to S3
-    logger.info("Saving updated object to s3://%s/%s", bucket, key)
-    contents = buf.read()
-    with s3.open("s3://{}/{}".format(bucket, key), "wb", **extra_args) as f:
-        f.write(contents)
-    s3.invalidate_cache()  # TODO: remove once https://github.com/dask/s3fs/issues/294 is resolved
-    new_version_id = f.version_id
-    logger.info("Object uploaded to S3")
-    # GrantWrite cannot be set whilst uploading therefore ACLs need to be restored separately
+    return extra_args
+
+
+def restore_write_grants(client, bucket, key, source_version, new_version_id):
+    """
+    GrantWrite cannot be set whilst uploading therefore ACLs need to be restored separately
+    """
+    request_payer_args, _ = get_requester_payment(client, bucket)
+    acl_args, acl_resp = get_object_acl(client, bucket, key, source_version)
     write_grantees = ",".join(get_grantees(acl_resp, "WRITE"))
     if write_grantees:
         logger.info("WRITE grant found. Restoring additional grantees for object")
@@ -41,15 +401,32 @@ def save(s3, client, buf, bucket, key, source_version=None):
             VersionId=new_version_id,
             **{**request_payer_args, **acl_args, "GrantWrite": write_grantees,}
         )
-    logger.info("Processing of file s3://%s/%s complete", bucket, key)
-    return new_version_id
 
 
-@lru_cache()
+def cache_per_bucket(fn):
+    """
+    Caches the result of fn(client, bucket) per bucket for the life of the
+    process. Bucket level settings don't depend on the client used to read
+    them, and clients are renewed with their session, so unlike lru_cache
+    the cache is not keyed on the client.
+    """
+    cache = {}
+
+    @wraps(fn)
+    def wrapper(client, bucket):
+        if bucket not in cache:
+            cache[bucket] = fn(client, bucket)
+        return cache[bucket]
+
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+
+@cache_per_bucket
 def get_requester_payment(client, bucket):
     """
     Generates a dict containing the request payer args supported when calling S3.
-    GetBucketRequestPayment call will be cached
+    GetBucketRequestPayment call will be cached per bucket
     :returns tuple containing the info formatted for ExtraArgs and the raw response
     """
     request_payer = client.get_bucket_request_payment(Bucket=bucket)
@@ -168,7 +545,7 @@ def get_grantees(acl, grant_type):
     return grantees
 
 
-@lru_cache()
+@cache_per_bucket
 def validate_bucket_versioning(client, bucket):
     resp = client.get_bucket_versioning(Bucket=bucket)
     versioning_enabled = resp.get("Status") == "Enabled"
@@ -0,0 +1,67 @@
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+SPILL_DIR = os.getenv(
+    "SPILL_DIR", os.path.join(tempfile.gettempdir(), "s3f2-spilled-objects")
+)
+# Objects larger than this are copied to the ephemeral storage of the task
+# before being processed
+SPILL_THRESHOLD = int(os.getenv("SPILL_THRESHOLD", 1024 * 1024 * 1024))
+# Size of the reads copying objects to disk. Ranged readers split them into
+# concurrent ranged GETs
+SPILL_CHUNK_SIZE = 32 * 1024 * 1024
+
+
+def should_spill(size):
+    """
+    Objects are spilled to disk when larger than SPILL_THRESHOLD, provided the
+    ephemeral storage of the task has room for them
+    """
+    if size <= SPILL_THRESHOLD:
+        return False
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    free = shutil.disk_usage(SPILL_DIR).free
+    if free < size:
+        logger.warning(
+            "Insufficient ephemeral storage to spill object of %s bytes (%s bytes free)",
+            str(size),
+            str(free),
+        )
+        return False
+    return True
+
+
+@contextmanager
+def spill_to_disk(input_file):
+    """
+    Copies the content of input_file to a temporary file and yields the file
+    memory-mapped. Unlike buffers holding downloaded data, the pages of a
+    memory-mapped file are backed by the file, so the kernel can reclaim them
+    under memory pressure. The temporary file is deleted on exit.
+    """
+    with tempfile.NamedTemporaryFile(dir=SPILL_DIR) as f:
+        logger.info("Spilling object to %s", f.name)
+        shutil.copyfileobj(input_file, f, SPILL_CHUNK_SIZE)
+        f.flush()
+        with pa.memory_map(f.name) as mapped:
+            yield mapped
+
+
+@contextmanager
+def open_input(input_file, size):
+    """
+    Yields the file to process the object from: input_file itself, or a
+    memory-mapped copy on disk for objects which should be spilled
+    """
+    if should_spill(size):
+        with spill_to_disk(input_file) as spilled:
+            yield spilled
+    else:
+        yield input_file
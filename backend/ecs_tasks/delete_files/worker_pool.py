@@ -0,0 +1,168 @@
+import logging
+import os
+import resource
+import signal
+from collections import deque
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+
+logger = logging.getLogger(__name__)
+
+
+def get_rss():
+    """
+    Returns the resident set size of the current process in bytes. Where
+    /proc is not available, the peak resident set size is returned instead.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_available_memory():
+    """
+    Returns the memory available for new processes in bytes, or None where
+    /proc is not available
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def work(conn, max_rss):
+    """
+    Worker process loop. Processes the tasks sent over conn until the
+    resident memory of the worker exceeds max_rss, at which point it exits
+    to be replaced by a fresh process, releasing any memory lost to
+    fragmentation.
+    """
+    # Shutdown is handled by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True:
+        try:
+            task_id, fn, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error("Unhandled error in worker: %s", str(e))
+        rss = get_rss()
+        recycle = rss > max_rss
+        if recycle:
+            logger.info(
+                "Worker memory usage %s exceeds %s bytes. Recycling worker",
+                str(rss),
+                str(max_rss),
+            )
+        conn.send((task_id, recycle))
+        if recycle:
+            return
+
+
+class WorkerPool:
+    """
+    Pool of long lived worker processes. Unlike a multiprocessing Pool with
+    maxtasksperchild, workers process many tasks, keeping imported modules,
+    clients and caches warm, and are only replaced when they exceed the
+    memory watermark or exit unexpectedly. The pool dispatches tasks to idle
+    workers itself, so the task of a worker exiting unexpectedly is known.
+    """
+
+    def __init__(self, processes, max_rss):
+        self._max_rss = max_rss
+        self._queued = deque()
+        self._workers = [self._start_worker() for _ in range(processes)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.terminate()
+
+    def _start_worker(self):
+        conn, worker_conn = Pipe()
+        process = Process(target=work, args=(worker_conn, self._max_rss))
+        process.daemon = True
+        process.start()
+        worker_conn.close()
+        return {"Process": process, "Conn": conn, "TaskId": None}
+
+    def _replace_worker(self, i):
+        worker = self._workers[i]
+        worker["Conn"].close()
+        worker["Process"].join()
+        if worker["Process"].exitcode != 0:
+            logger.error(
+                "Worker exited with code %s", str(worker["Process"].exitcode)
+            )
+        self._workers[i] = self._start_worker()
+
+    def _dispatch(self):
+        for i, worker in enumerate(self._workers):
+            if not self._queued:
+                return
+            if worker["TaskId"] is not None:
+                continue
+            if not worker["Process"].is_alive():
+                self._replace_worker(i)
+                worker = self._workers[i]
+            task = self._queued.popleft()
+            worker["Conn"].send(task)
+            worker["TaskId"] = task[0]
+
+    def submit(self, task_id, fn, args):
+        """
+        Queues fn to be invoked with args by the first idle worker
+        """
+        self._queued.append((task_id, fn, args))
+        self._dispatch()
+
+    def get_completed(self, timeout):
+        """
+        Waits up to timeout seconds for tasks to complete and returns the ids
+        of the completed tasks, including those interrupted by their worker
+        exiting unexpectedly
+        """
+        busy = [w for w in self._workers if w["TaskId"] is not None]
+        ready = wait(
+            [w["Conn"] for w in busy] + [w["Process"].sentinel for w in busy],
+            timeout,
+        )
+        completed = []
+        for i, worker in enumerate(self._workers):
+            if worker["TaskId"] is None or (
+                worker["Conn"] not in ready and worker["Process"].sentinel not in ready
+            ):
+                continue
+            completed.append(worker["TaskId"])
+            worker["TaskId"] = None
+            try:
+                _, recycled = worker["Conn"].recv()
+            except (EOFError, OSError):
+                # The worker exited before completing the task
+                recycled = True
+            if recycled:
+                self._replace_worker(i)
+        self._dispatch()
+        return completed
+
+    def get_running(self):
+        """
+        Returns the ids of the tasks being processed by a worker
+        """
+        return {w["TaskId"] for w in self._workers if w["TaskId"] is not None}
+
+    def terminate(self):
+        for worker in self._workers:
+            worker["Process"].terminate()
+        for worker in self._workers:
+            worker["Process"].join()
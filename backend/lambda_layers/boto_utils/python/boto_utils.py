@@ -89,7 +89,12 @@ def read_queue(queue, number_to_read=10):
 
 
 def batch_sqs_msgs(queue, messages, **kwargs):
+    """
+    Sends the messages in batches, returning the entries which SQS failed to
+    send
+    """
     chunks = [messages[x : x + batch_size] for x in range(0, len(messages), batch_size)]
+    failed = []
     for chunk in chunks:
         entries = [
             {
@@ -104,7 +109,8 @@ def batch_sqs_msgs(queue, messages, **kwargs):
             }
             for m in chunk
         ]
-        queue.send_messages(Entries=entries)
+        failed += queue.send_messages(Entries=entries).get("Failed", [])
+    return failed
 
 
 def emit_event(job_id, event_name, event_data, emitter_id=None, created_at=None):
@@ -26,7 +26,7 @@ def handler(event, context):
 def make_query(query_data):
     """
     Returns a query which will look like
-    SELECT DISTINCT $path
+    SELECT DISTINCT $path, $file_size
     FROM "db"."table"
     WHERE col1 in (matchid1, matchid2) OR col1 in (matchid1, matchid2) AND partition_key = value"
 
@@ -35,11 +35,12 @@ def make_query(query_data):
       "Database":"db",
       "Table": "table",
       "Columns": [{"Column": "col, "MatchIds": ["match"]}],
-      "PartitionKeys": [{"Key":"k", "Value":"val"}]
+      "PartitionKeys": [{"Key":"k", "Value":"val"}],
+      "Partitions": [[{"Key":"k", "Value":"val1"}], [{"Key":"k", "Value":"val2"}]]
     }
     """
     template = """
-    SELECT DISTINCT(t."$path")
+    SELECT DISTINCT t."$path", t."$file_size"
     FROM "{db}"."{table}" t
     INNER JOIN "{deletion_queue_db}"."{deletion_queue_table}" dq on ({join_part})
     {partitions_part}
@@ -57,10 +58,19 @@ def make_query(query_data):
         columns_match.append(' t.{col_name} = dq.{col_name} '.format(col_name=col_name))
     join_part = 'AND'.join(columns_match)
 
-    for partition in partitions:
-        partitions_list.append("{key} = {value}"
-                               .format(key=escape_column(partition["Key"]), value=escape_item(partition["Value"])))
-    partitions_part = "WHERE " + " AND ".join(partitions_list) if len(partitions) > 0 else ''
+    # Coalesced queries match any of several partitions
+    for partition_keys in query_data.get("Partitions") or [partitions]:
+        if len(partition_keys) > 0:
+            partitions_list.append(" AND ".join(
+                "{key} = {value}".format(key=escape_column(p["Key"]), value=escape_item(p["Value"]))
+                for p in partition_keys
+            ))
+    if len(partitions_list) == 1:
+        partitions_part = "WHERE " + partitions_list[0]
+    elif len(partitions_list) > 1:
+        partitions_part = "WHERE " + " OR ".join("({})".format(p) for p in partitions_list)
+    else:
+        partitions_part = ''
 
     return template.format(db=db,
                            table=table,
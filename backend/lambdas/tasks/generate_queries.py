@@ -4,6 +4,7 @@ Task for generating Athena queries from glue catalogs
 import os
 import boto3
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 from boto_utils import paginate, batch_sqs_msgs, deserialize_item
 from decorators import with_logging
@@ -17,6 +18,16 @@ queue = sqs.Queue(os.getenv("QueryQueue"))
 jobs_table = ddb.Table(os.getenv("JobTable", "S3F2_Jobs"))
 data_mapper_table_name = os.getenv("DataMapperTable", "S3F2_DataMappers")
 s3 = boto3.resource("s3")
+# Clients, unlike resources, can be shared by the threads generating queries
+s3_client = boto3.client("s3")
+
+# Data mappers for which queries are generated concurrently
+DATA_MAPPER_CONCURRENCY = int(os.getenv("DataMapperConcurrency", 8))
+# Partitions coalesced into a single query, bounded by count and by the size
+# of their data where recorded in the partition parameters by Glue crawlers.
+# Setting MaxPartitionsPerQuery to 1 generates a query per partition.
+MAX_PARTITIONS_PER_QUERY = int(os.getenv("MaxPartitionsPerQuery", 100))
+MAX_QUERY_DATA_SIZE = int(os.getenv("MaxQueryDataSize", 100 * 1024 ** 3))
 
 ARRAYSTRUCT = "array<struct>"
 ARRAYSTRUCT_PREFIX = "array<struct<"
@@ -42,14 +53,21 @@ ALLOWED_TYPES = [
 def handler(event, context):
     job_id = event['ExecutionName']
     bucket, deletion_items = get_deletion_queue(job_id)
-    for data_mapper in get_data_mappers():
-        query_executor = data_mapper["QueryExecutor"]
-        if query_executor == "athena":
-            queries = generate_athena_queries(data_mapper, deletion_items, bucket, job_id)
-        else:
-            raise NotImplementedError("Unsupported data mapper query executor: '{}'".format(query_executor))
+    with ThreadPoolExecutor(DATA_MAPPER_CONCURRENCY) as executor:
+        futures = [
+            executor.submit(generate_queries, data_mapper, deletion_items, bucket, job_id)
+            for data_mapper in get_data_mappers()
+        ]
+        # Queries are submitted in the order of the data mappers
+        for future in futures:
+            batch_sqs_msgs(queue, future.result())
+
 
-        batch_sqs_msgs(queue, queries)
+def generate_queries(data_mapper, deletion_items, bucket, job_id):
+    query_executor = data_mapper["QueryExecutor"]
+    if query_executor == "athena":
+        return generate_athena_queries(data_mapper, deletion_items, bucket, job_id)
+    raise NotImplementedError("Unsupported data mapper query executor: '{}'".format(query_executor))
 
 
 def generate_athena_queries(data_mapper, deletion_items, bucket, job_id):
@@ -89,15 +107,18 @@ def generate_athena_queries(data_mapper, deletion_items, bucket, job_id):
         # For every partition combo of every table, create a query
         # TODO:: make sure  get_partitions() works as expected, in some cases it didn't return all partition combos
         partitions = get_partitions(db, table_name)
-        for partition in partitions:
-            values = partition["Values"]
-            queries.append({
-                **msg,
-                "PartitionKeys": [
+        for group in coalesce_partitions(partitions):
+            group_keys = [
+                [
                     {"Key": partition_keys[i]["Name"], "Value": convert_to_partition_type(v, partition_keys[i]["Name"], partition_keys)}
-                    for i, v in enumerate(values)
-                ],
-            })
+                    for i, v in enumerate(partition["Values"])
+                ]
+                for partition in group
+            ]
+            if len(group_keys) == 1:
+                queries.append({**msg, "PartitionKeys": group_keys[0]})
+            else:
+                queries.append({**msg, "Partitions": group_keys})
     # Workout which deletion items should be included in this query
     filtered = []
     applicable_match_ids = [
@@ -105,22 +126,24 @@ def generate_athena_queries(data_mapper, deletion_items, bucket, job_id):
         if data_mapper["DataMapperId"] in item.get("DataMappers", []) or len(item.get("DataMappers", [])) == 0
     ]
     if len(applicable_match_ids) > 0:
+        # The table schema is parsed once and MatchIds are converted in bulk
+        schema = get_table_schema(table)
         payload = {
             "Columns": [
                 {
                     "Column": c,
-                    "MatchIds": [convert_to_col_type(mid, c, table) for mid in applicable_match_ids]
+                    "MatchIds": list(map(get_column_converter(c, schema), applicable_match_ids))
                 } for c in columns
             ]
         }
         # save data to jobs deletion queue
-        obj = s3.Object(bucket, key)
-        obj.put(Body=json.dumps(payload))
+        s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(payload))
 
         # send data to Athena deletion queue
-        deletion_queue_object = s3.Object(mapper_deletion_queue_bucket, mapper_deletion_queue_key)
         dq_pl = "{}\n".format(",".join(columns)) + "\n".join(applicable_match_ids)
-        deletion_queue_object.put(Body=dq_pl)
+        s3_client.put_object(
+            Bucket=mapper_deletion_queue_bucket, Key=mapper_deletion_queue_key, Body=dq_pl
+        )
 
         filtered = queries
     return filtered
@@ -152,6 +175,37 @@ def get_partitions(db, table_name):
     return paginate(glue_client, glue_client.get_partitions, ["Partitions"], DatabaseName=db, TableName=table_name)
 
 
+def get_partition_size(partition):
+    """
+    Function to get the size of the data of a partition as recorded by Glue
+    crawlers, or 0 where it isn't recorded
+    """
+    try:
+        return int(partition.get("Parameters", {}).get("sizeKey", 0))
+    except ValueError:
+        return 0
+
+
+def coalesce_partitions(partitions):
+    """
+    Function to group partitions to be queried together, bounding the number
+    of partitions and the size of their data per query
+    """
+    group, group_size = [], 0
+    for partition in partitions:
+        size = get_partition_size(partition)
+        if group and (
+            len(group) == MAX_PARTITIONS_PER_QUERY
+            or group_size + size > MAX_QUERY_DATA_SIZE
+        ):
+            yield group
+            group, group_size = [], 0
+        group.append(partition)
+        group_size += size
+    if group:
+        yield group
+
+
 def get_inner_children(str, prefix, suffix):
     """
     Function to get inner children from complex type string
@@ -302,10 +356,16 @@ def column_mapper(col):
     return result
 
 
-def get_column_info(col, table):
-    table_columns = table["StorageDescriptor"]["Columns"]
+def get_table_schema(table):
+    """
+    Function to map all the Columns of an AWS Glue table to trees
+    """
+    return list(map(column_mapper, table["StorageDescriptor"]["Columns"]))
+
+
+def get_column_info(col, table, schema=None):
+    serialized_cols = schema if schema is not None else get_table_schema(table)
     col_array = col.split(".")
-    serialized_cols = list(map(column_mapper, table_columns))
     found = None
     for col_segment in col_array:
         found = next((x for x in serialized_cols if x["Name"] == col_segment), None)
@@ -331,8 +391,12 @@ def convert_to_partition_type(val, col, col_descriptor):
     raise ValueError("Column {} is type {} which is not a supported column type for querying")
 
 
-def convert_to_col_type(val, col, table):
-    col_type, can_be_identifier = get_column_info(col, table)
+def get_column_converter(col, schema):
+    """
+    Function to get the function converting MatchIds to the type of a column
+    from the trees of a table schema
+    """
+    col_type, can_be_identifier = get_column_info(col, None, schema)
     if not col_type:
         raise ValueError("Column {} not found".format(col))
     elif not can_be_identifier:
@@ -341,8 +405,12 @@ def convert_to_col_type(val, col, table):
         )
 
     if col_type in ("bigint", "int", "smallint", "tinyint"):
-        return int(val)
+        return int
     if col_type in ("double", "float"):
-        return float(val)
+        return float
 
-    return str(val)
+    return str
+
+
+def convert_to_col_type(val, col, table):
+    return get_column_converter(col, get_table_schema(table))(val)
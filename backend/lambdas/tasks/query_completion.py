@@ -0,0 +1,88 @@
+"""
+Query completion handlers. Rather than polling the status of its query, an
+Athena state machine execution waits on a task token which is returned once
+Athena emits the state change event of the query.
+"""
+import json
+import logging
+import os
+
+import boto3
+from botocore.exceptions import ClientError
+
+from decorators import with_logging
+
+logger = logging.getLogger()
+
+athena_client = boto3.client("athena")
+sf_client = boto3.client("stepfunctions")
+s3 = boto3.resource("s3")
+
+bucket = os.getenv("StateBucket")
+TOKEN_PREFIX = "query-tokens"
+TERMINAL_STATES = ["SUCCEEDED", "FAILED", "CANCELLED"]
+# Errors returned when the task of a token has already been completed
+COMPLETED_TASK_ERRORS = ["TaskTimedOut", "TaskDoesNotExist", "InvalidToken"]
+
+
+@with_logging
+def wait_handler(event, context):
+    """
+    Stores the task token of a query so that it can be returned when the
+    query completes
+    """
+    query_id = event["QueryId"]
+    token = event["TaskToken"]
+    s3.Object(bucket, get_token_key(query_id)).put(Body=token.encode("utf-8"))
+    # The query may have completed before the token was stored, in which case
+    # its state change event found no token to return
+    status = get_query_status(query_id)
+    if status["State"] in TERMINAL_STATES:
+        complete_task(query_id, token, status)
+
+
+@with_logging
+def event_handler(event, context):
+    """
+    Returns the status of a completed query to the execution waiting on it
+    """
+    detail = event["detail"]
+    if detail["currentState"] not in TERMINAL_STATES:
+        return
+    query_id = detail["queryExecutionId"]
+    try:
+        token_object = s3.Object(bucket, get_token_key(query_id)).get()
+    except ClientError as e:
+        # Queries not started by a job, or whose task is already completed
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return
+        raise
+    token = token_object["Body"].read().decode("utf-8")
+    complete_task(query_id, token, get_query_status(query_id))
+
+
+def get_token_key(query_id):
+    return "{}/{}".format(TOKEN_PREFIX, query_id)
+
+
+def get_query_status(query_id):
+    execution_details = athena_client.get_query_execution(QueryExecutionId=query_id)[
+        "QueryExecution"
+    ]
+    return {
+        "State": execution_details["Status"]["State"],
+        "Reason": execution_details["Status"].get("StateChangeReason", "n/a"),
+        "Statistics": execution_details.get("Statistics", {}),
+    }
+
+
+def complete_task(query_id, token, status):
+    try:
+        sf_client.send_task_success(taskToken=token, output=json.dumps(status))
+    except ClientError as e:
+        # The token is returned by both handlers when the query completes
+        # whilst it is being stored
+        if e.response["Error"]["Code"] not in COMPLETED_TASK_ERRORS:
+            raise
+        logger.info("Task for query %s already completed", query_id)
+    s3.Object(bucket, get_token_key(query_id)).delete()
@@ -1,52 +1,122 @@
 """
 Submits results from Athena queries to the Fargate deletion queue
 """
+import codecs
+import csv
 import os
 
 import boto3
 
 from decorators import with_logging
-from boto_utils import paginate, batch_sqs_msgs
+from boto_utils import paginate, batch_sqs_msgs, parse_s3_url
 
 athena = boto3.client("athena")
+s3 = boto3.resource("s3")
 sqs = boto3.resource("sqs")
 queue = sqs.Queue(os.getenv("QueueUrl"))
 
 NUM_OF_MESSAGES_IN_BATCH = 200
+# Read the results from the CSV file written by Athena rather than paginating
+# through GetQueryResults
+STREAM_QUERY_RESULTS = os.getenv("StreamQueryResults", "true").lower() == "true"
+# Objects up to this size are grouped with others in a single message, so
+# that the Fargate task shares the fixed cost of a message between them
+SMALL_OBJECT_SIZE = 16 * 1024 * 1024
+# Bounds on the objects of a group, keeping messages well within the SQS
+# message size limit and the processing time of a message reasonable
+MAX_OBJECTS_PER_GROUP = 50
+MAX_GROUP_SIZE = 128 * 1024 * 1024
 
-@with_logging
-def handler(event, context):
-    query_id = event["QueryId"]
+
+def stream_query_results(query_id):
+    """
+    Yields the rows of the CSV file written by Athena to the query result
+    location as they are downloaded, header row included
+    """
+    execution = athena.get_query_execution(QueryExecutionId=query_id)
+    output_location = execution["QueryExecution"]["ResultConfiguration"][
+        "OutputLocation"
+    ]
+    bucket, key = parse_s3_url(output_location)
+    body = s3.Object(bucket, key).get()["Body"]
+    yield from csv.reader(codecs.getreader("utf-8")(body))
+
+
+def paginate_query_results(query_id):
+    """
+    Yields the rows returned by GetQueryResults, header row included
+    """
     results = paginate(
         athena, athena.get_query_results, ["ResultSet.Rows"], QueryExecutionId=query_id
     )
-    rows = [result for result in results]
-    header_row = rows.pop(0)
-    path_field_index = next(
-        (
-            index
-            for (index, d) in enumerate(header_row["Data"])
-            if d["VarCharValue"] == "$path"
-        ),
-        None,
+    for row in results:
+        yield [d.get("VarCharValue") for d in row["Data"]]
+
+
+def get_objects(rows):
+    """
+    Yields the path and size of the objects found by a query. The size is
+    None for queries not selecting it.
+    """
+    header_row = next(rows)
+    path_field_index = header_row.index("$path")
+    size_field_index = (
+        header_row.index("$file_size") if "$file_size" in header_row else None
     )
+    for row in rows:
+        size = row[size_field_index] if size_field_index is not None else None
+        yield row[path_field_index], int(size) if size else None
+
+
+def group_objects(objects):
+    """
+    Groups small objects into lists of objects to be processed by a single
+    message. Objects of unknown or large size get a group of their own.
+    """
+    group, group_size = [], 0
+    for path, size in objects:
+        if size is None or size > SMALL_OBJECT_SIZE:
+            yield [(path, size)]
+            continue
+        if len(group) == MAX_OBJECTS_PER_GROUP or group_size + size > MAX_GROUP_SIZE:
+            yield group
+            group, group_size = [], 0
+        group.append((path, size))
+        group_size += size
+    if group:
+        yield group
+
+
+@with_logging
+def handler(event, context):
+    query_id = event["QueryId"]
+    if STREAM_QUERY_RESULTS:
+        rows = stream_query_results(query_id)
+    else:
+        rows = paginate_query_results(query_id)
 
-    paths = [row["Data"][path_field_index]["VarCharValue"] for row in rows]
+    # Messages are sent as results are read, so that memory usage doesn't
+    # grow with the number of objects found
     messages = []
-    for p in paths:
+    for group in group_objects(get_objects(rows)):
         msg = {
             "AllFiles": event["AllFiles"],
             "JobId": event["JobId"],
-            "Object": p,
             "QueryBucket": event["Bucket"],
             "QueryKey": event["Key"],
             "RoleArn": event.get("RoleArn", None),
             "DeleteOldVersions": event.get("DeleteOldVersions", True),
             "Format": event.get("Format"),
         }
+        if len(group) == 1:
+            msg["Object"] = group[0][0]
+        else:
+            msg["Objects"] = [{"Object": p, "Size": size} for p, size in group]
         messages.append({k: v for k, v in msg.items() if v is not None})
-    btached_msgs = [messages[i:i + NUM_OF_MESSAGES_IN_BATCH] for i in range(0, len(messages), NUM_OF_MESSAGES_IN_BATCH)]
-    for batch in btached_msgs:
-        batch_sqs_msgs(queue, batch)
+        if len(messages) == NUM_OF_MESSAGES_IN_BATCH:
+            batch_sqs_msgs(queue, messages)
+            messages = []
+    if messages:
+        batch_sqs_msgs(queue, messages)
 
     return None
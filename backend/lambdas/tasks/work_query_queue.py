@@ -1,9 +1,11 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 
 from decorators import with_logging, s3_state_store
-from boto_utils import read_queue
+from boto_utils import batch_size, paginate, read_queue
 import time
 queue_url = os.getenv("QueueUrl")
 state_machine_arn = os.getenv("StateMachineArn")
@@ -12,6 +14,10 @@ queue = sqs.Queue(queue_url)
 sf_client = boto3.client("stepfunctions")
 s3 = boto3.resource("s3")
 
+# Executions no longer listed as running are described concurrently, as
+# Step Functions has no batch API to describe executions
+DESCRIBE_CONCURRENCY = int(os.getenv("DescribeConcurrency", 10))
+
 @with_logging
 @s3_state_store(offload_keys=["Data"])
 def handler(event, context):
@@ -20,7 +26,7 @@ def handler(event, context):
     execution_id = event["ExecutionId"]
     job_id = event["ExecutionName"]
     previously_started = event.get("RunningExecutions", {"Data": [], "Total": 0})
-    executions = [load_execution(execution) for execution in previously_started["Data"]]
+    executions = load_executions(previously_started["Data"])
     succeeded = [
         execution for execution in executions if execution["status"] == "SUCCEEDED"
     ]
@@ -68,6 +74,8 @@ def handler(event, context):
                 "Table": body["Table"],
                 "Database": body["Database"]
             }
+            if "Partitions" in body:
+                payload["Partitions"] = body["Partitions"]
             if query_executor == "athena":
                 resp = sf_client.start_execution(
                     stateMachineArn=state_machine_arn, input=json.dumps(payload)
@@ -89,6 +97,37 @@ def handler(event, context):
     }
 
 
+def load_executions(executions):
+    """
+    Loads the status of the given executions. The executions still running are
+    found by listing the running executions of the state machine, a page of up
+    to 1000 at a time, so that only the executions which have stopped since
+    the last loop need to be described.
+    """
+    if not executions:
+        return []
+    running = {
+        e["executionArn"]: e
+        for e in paginate(
+            sf_client,
+            sf_client.list_executions,
+            ["executions"],
+            stateMachineArn=state_machine_arn,
+            statusFilter="RUNNING",
+            PaginationConfig={"PageSize": 1000},
+        )
+    }
+    stopped = [e for e in executions if e["ExecutionArn"] not in running]
+    with ThreadPoolExecutor(DESCRIBE_CONCURRENCY) as executor:
+        described = iter(list(executor.map(load_execution, stopped)))
+    return [
+        {**running[e["ExecutionArn"]], "ReceiptHandle": e["ReceiptHandle"]}
+        if e["ExecutionArn"] in running
+        else next(described)
+        for e in executions
+    ]
+
+
 def load_execution(execution):
     resp = sf_client.describe_execution(executionArn=execution["ExecutionArn"])
     resp["ReceiptHandle"] = execution["ReceiptHandle"]
@@ -96,9 +135,18 @@ def load_execution(execution):
 
 
 def clear_completed(executions):
-    for e in executions:
-        message = sqs.Message(queue.url, e["ReceiptHandle"])
-        message.delete()
+    for i in range(0, len(executions), batch_size):
+        entries = [
+            {"Id": str(j), "ReceiptHandle": e["ReceiptHandle"]}
+            for j, e in enumerate(executions[i : i + batch_size])
+        ]
+        resp = queue.delete_messages(Entries=entries)
+        if resp.get("Failed"):
+            raise RuntimeError(
+                "Unable to delete query messages: {}".format(
+                    ", ".join([f.get("Message", f["Code"]) for f in resp["Failed"]])
+                )
+            )
 
 
 def abandon_execution(failed):
@@ -0,0 +1,7 @@
+import sys
+from os import path
+
+# The Fargate task modules import each other as top level modules
+sys.path.append(
+    path.join(path.dirname(__file__), "..", "..", "backend", "ecs_tasks", "delete_files")
+)
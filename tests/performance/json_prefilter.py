@@ -0,0 +1,118 @@
+"""
+Benchmark comparing the JSON deletion engine used by the Fargate task, which
+only parses lines containing a MatchId, with the previous implementation
+parsing every line.
+
+Run from the repository root with:
+    python -m tests.performance.json_prefilter
+"""
+import json
+import timeit
+from io import BytesIO
+
+from pyarrow import BufferOutputStream
+
+from backend.ecs_tasks.delete_files.json_handler import (
+    delete_matches_from_json_file,
+    find_key,
+)
+
+ROW_COUNTS = [10000, 100000, 500000]
+MATCH_RATIO = 0.001
+MATCH_IDS_COUNT = 1000
+REPEAT = 3
+
+
+def delete_matches_from_json_file_legacy(input_file, to_delete):
+    """
+    Previous implementation, parsing every line of the object
+    """
+    deleted_rows = 0
+    with BufferOutputStream() as out_stream:
+        lines = input_file.read().decode("utf-8").split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        for line in lines:
+            parsed = json.loads(line)
+            should_delete = False
+            for column in to_delete:
+                record = parsed
+                for segment in column["Column"].split("."):
+                    current_key = find_key(segment, record)
+                    if not current_key:
+                        record = None
+                        break
+                    record = record[current_key]
+                if record and record in column["MatchIds"]:
+                    should_delete = True
+                    break
+            if should_delete:
+                deleted_rows += 1
+            else:
+                out_stream.write(bytes(line + "\n", "utf-8"))
+        return out_stream, deleted_rows
+
+
+def make_content(rows):
+    step = int(1 / MATCH_RATIO)
+    lines = [
+        json.dumps(
+            {
+                "customerId": "{:010d}".format(i),
+                "user": {"id": i, "name": "user{}".format(i), "tags": ["a", "b"]},
+                "score": i / 3,
+                "createdAt": "2020-01-01T00:00:00Z",
+            }
+        )
+        for i in range(rows)
+    ]
+    match_ids = ["{:010d}".format(i) for i in range(0, rows, step)]
+    # Pad the deletion queue with MatchIds which are not in the object
+    match_ids += ["x{:09d}".format(i) for i in range(MATCH_IDS_COUNT)]
+    return ("\n".join(lines) + "\n").encode("utf-8"), match_ids
+
+
+def run():
+    print(
+        "{:>10} {:>16} {:>12} {:>12} {:>8}".format(
+            "rows", "column", "legacy (s)", "current (s)", "speedup"
+        )
+    )
+    for rows in ROW_COUNTS:
+        content, match_ids = make_content(rows)
+        for column in ["customerid", "user.id"]:
+            ids = match_ids
+            if column == "user.id":
+                ids = [int(m) for m in match_ids if m.isdigit()]
+            to_delete = [{"Column": column, "MatchIds": ids}]
+            expected, expected_deleted = delete_matches_from_json_file_legacy(
+                BytesIO(content), to_delete
+            )
+            actual, stats = delete_matches_from_json_file(BytesIO(content), to_delete)
+            assert expected_deleted == stats["DeletedRows"]
+            assert expected.getvalue() == actual.getvalue()
+            legacy_time = min(
+                timeit.repeat(
+                    lambda: delete_matches_from_json_file_legacy(
+                        BytesIO(content), to_delete
+                    ),
+                    number=1,
+                    repeat=REPEAT,
+                )
+            )
+            current_time = min(
+                timeit.repeat(
+                    lambda: delete_matches_from_json_file(BytesIO(content), to_delete),
+                    number=1,
+                    repeat=REPEAT,
+                )
+            )
+            print(
+                "{:>10} {:>16} {:>12.4f} {:>12.4f} {:>7.1f}x".format(
+                    rows, column, legacy_time, current_time, legacy_time / current_time
+                )
+            )
+
+
+if __name__ == "__main__":
+    run()
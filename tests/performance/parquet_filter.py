@@ -0,0 +1,99 @@
+"""
+Benchmark comparing the Arrow compute based row filtering used by the
+Fargate task with the previous pandas based implementation.
+
+Run from the repository root with:
+    python -m tests.performance.parquet_filter
+"""
+import timeit
+
+import pyarrow as pa
+
+from backend.ecs_tasks.delete_files.parquet_handler import delete_from_table
+
+ROW_GROUP_SIZES = [1000, 10000, 100000, 1000000]
+MATCH_IDS_COUNT = 1000
+REPEAT = 3
+
+
+def delete_from_table_pandas(table, to_delete, schema):
+    """
+    Previous implementation, converting each row group to a pandas DataFrame
+    """
+    needs_flattened_columns = any("." in x["Column"] for x in to_delete)
+    df = (table.flatten() if needs_flattened_columns else table).to_pandas()
+    initial_rows = len(df.index)
+    indexes_to_delete = []
+    for column in to_delete:
+        indexes = df[column["Column"]].isin(column["MatchIds"])
+        indexes_to_delete.append(indexes)
+        df = df[~indexes]
+    if needs_flattened_columns:
+        df = table.to_pandas()
+        for indexes in indexes_to_delete:
+            df = df[~indexes]
+    deleted_rows = initial_rows - len(df.index)
+    table = pa.Table.from_pandas(
+        df, schema=schema, preserve_index=True
+    ).replace_schema_metadata()
+    return table, deleted_rows
+
+
+def make_table(rows):
+    ids = ["{:010d}".format(i) for i in range(rows)]
+    return pa.Table.from_pydict(
+        {
+            "customer_id": ids,
+            "score": [float(i) for i in range(rows)],
+            "user_info": [{"id": i, "email": "{}@test.com".format(i)} for i in ids],
+        }
+    )
+
+
+def make_to_delete(rows, column):
+    step = max(rows // MATCH_IDS_COUNT, 1)
+    return [
+        {
+            "Column": column,
+            "MatchIds": ["{:010d}".format(i) for i in range(0, rows, step)],
+        }
+    ]
+
+
+def run():
+    print(
+        "{:>10} {:>16} {:>12} {:>12} {:>8}".format(
+            "rows", "column", "pandas (s)", "arrow (s)", "speedup"
+        )
+    )
+    for rows in ROW_GROUP_SIZES:
+        table = make_table(rows)
+        for column in ["customer_id", "user_info.id"]:
+            to_delete = make_to_delete(rows, column)
+            expected = delete_from_table_pandas(table, to_delete, table.schema)
+            actual = delete_from_table(table, to_delete, table.schema)
+            assert expected[1] == actual[1]
+            assert expected[0].equals(actual[0])
+            pandas_time = min(
+                timeit.repeat(
+                    lambda: delete_from_table_pandas(table, to_delete, table.schema),
+                    number=1,
+                    repeat=REPEAT,
+                )
+            )
+            arrow_time = min(
+                timeit.repeat(
+                    lambda: delete_from_table(table, to_delete, table.schema),
+                    number=1,
+                    repeat=REPEAT,
+                )
+            )
+            print(
+                "{:>10} {:>16} {:>12.4f} {:>12.4f} {:>7.1f}x".format(
+                    rows, column, pandas_time, arrow_time, pandas_time / arrow_time
+                )
+            )
+
+
+if __name__ == "__main__":
+    run()
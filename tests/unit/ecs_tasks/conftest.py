@@ -1,6 +1,29 @@
 import json
+import sys
 
 import pytest
+from mock import patch, MagicMock
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_configure(config):
+    """
+    The Fargate task imports its s3 module by its top level name, which on the
+    test path is the jobs module of the same name. main is imported with the
+    top level name bound to the Fargate module, then the binding is restored
+    so that the jobs code keeps importing its own module.
+    """
+    from backend.ecs_tasks.delete_files import s3
+
+    previous = sys.modules.get("s3")
+    sys.modules["s3"] = s3
+    try:
+        import backend.ecs_tasks.delete_files.main  # noqa: F401
+    finally:
+        if previous is None:
+            del sys.modules["s3"]
+        else:
+            sys.modules["s3"] = previous
 
 
 @pytest.fixture
@@ -10,7 +33,9 @@ def message_stub():
             {
                 "JobId": "1234",
                 "Object": "s3://bucket/path/basic.parquet",
-                "Columns": [{"Column": "customer_id", "MatchIds": ["12345", "23456"]}],
+                "QueryBucket": "query_bucket",
+                "QueryKey": "query_key",
+                "AllFiles": ["s3://bucket/path/basic.parquet"],
                 "DeleteOldVersions": False,
                 "Format": "parquet",
                 **kwargs,
@@ -18,3 +43,42 @@ def message_stub():
         )
 
     return make_message
+
+
+@pytest.fixture(autouse=True)
+def query_payload_stub(tmp_path):
+    """
+    Stub the query payload fetched from S3 by the Fargate task, isolating the
+    payloads and sessions cached by each test
+    """
+    payload = {"Columns": [{"Column": "customer_id", "MatchIds": ["12345", "23456"]}]}
+    mock_body = MagicMock()
+    mock_body.read.return_value = json.dumps(payload).encode("utf-8")
+    with patch("backend.ecs_tasks.delete_files.main.s3_client") as mock_client, patch(
+        "payload_cache.CACHE_DIR", str(tmp_path / "payloads")
+    ):
+        from backend.ecs_tasks.delete_files.main import compile_payload, sessions
+
+        mock_client.Object.return_value.e_tag = '"etag"'
+        mock_client.Object.return_value.get.return_value = {"Body": mock_body}
+        compile_payload.cache_clear()
+        sessions.clear()
+        yield mock_client
+        compile_payload.cache_clear()
+        sessions.clear()
+
+
+@pytest.fixture(autouse=True)
+def bucket_settings_cache():
+    """
+    Bucket level settings are cached per bucket name rather than per client,
+    so they would otherwise leak between tests using the same bucket names
+    """
+    from backend.ecs_tasks.delete_files import s3
+
+    caches = [s3.get_requester_payment, s3.validate_bucket_versioning]
+    for fn in caches:
+        fn.cache_clear()
+    yield
+    for fn in caches:
+        fn.cache_clear()
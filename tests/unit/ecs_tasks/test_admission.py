@@ -0,0 +1,74 @@
+import pytest
+from mock import patch, mock_open
+
+from backend.ecs_tasks.delete_files.admission import (
+    AdmissionController,
+    estimate_working_set,
+    get_memory_limit,
+    JSON_WORKING_SET,
+)
+
+pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
+
+
+def test_it_admits_objects_within_the_memory_budget():
+    controller = AdmissionController(100, 2)
+    controller.add("a", 40)
+    controller.add("b", 40)
+    controller.add("c", 40)
+    assert ["a", "b"] == controller.admit()
+    assert [] == controller.admit()
+    controller.complete("a")
+    assert ["c"] == controller.admit()
+
+
+def test_it_admits_objects_in_order():
+    controller = AdmissionController(100, 4)
+    controller.add("a", 20)
+    controller.add("b", 90)
+    controller.add("c", 10)
+    assert ["a"] == controller.admit()
+    controller.complete("a")
+    assert ["b", "c"] == controller.admit()
+
+
+def test_it_processes_one_large_object_at_a_time():
+    controller = AdmissionController(100, 4)
+    controller.add("large1", 30)
+    controller.add("large2", 30)
+    controller.add("small", 10)
+    # Small objects overtake large objects waiting for the large object slot
+    assert ["large1", "small"] == controller.admit()
+    controller.complete("large1")
+    assert ["large2"] == controller.admit()
+
+
+def test_it_admits_objects_exceeding_the_budget_when_idle():
+    controller = AdmissionController(100, 2)
+    controller.add("small", 10)
+    controller.add("huge", 500)
+    assert ["small"] == controller.admit()
+    controller.complete("small")
+    assert ["huge"] == controller.admit()
+
+
+def test_it_estimates_working_set():
+    assert 300 == estimate_working_set(100, "parquet", False)
+    assert 100 == estimate_working_set(100, "json", False)
+    assert 1000 == estimate_working_set(100, "json", True)
+    assert JSON_WORKING_SET == estimate_working_set(10 ** 12, "json", True)
+
+
+@pytest.mark.parametrize(
+    "content,expected",
+    [("2147483648\n", 2147483648), ("max\n", None), ("9223372036854771712", None)],
+)
+def test_it_reads_memory_limit_from_cgroup(content, expected):
+    with patch("builtins.open", mock_open(read_data=content)):
+        assert expected == get_memory_limit()
+
+
+@patch("builtins.open")
+def test_it_returns_no_memory_limit_without_cgroup(mock_open_file):
+    mock_open_file.side_effect = FileNotFoundError()
+    assert get_memory_limit() is None
@@ -1,12 +1,14 @@
 from mock import patch
 
 import gzip
+from io import BytesIO
 import pyarrow as pa
 import pyarrow.parquet as pq
 import pytest
 import pandas as pd
 import tempfile
 from backend.ecs_tasks.delete_files.json_handler import delete_matches_from_json_file
+from match_index import MatchIndex
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
@@ -23,7 +25,12 @@ def test_it_generates_new_json_file_without_matches():
     # Act
     out, stats = delete_matches_from_json_file(out_stream, to_delete)
     assert isinstance(out, pa.BufferOutputStream)
-    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    assert {
+        "ProcessedRows": 3,
+        "DeletedRows": 1,
+        "KeyLookups": 1,
+        "KeyLookupMisses": 1,
+    } == stats
     assert to_json_string(out) == (
         '{"customer_id": "12345", "x": 1.2, "d":"2001-01-01"}\n'
         '{"customer_id": "34567", "x": 3.4, "d":"2001-01-05"}\n'
@@ -42,7 +49,12 @@ def test_it_handles_json_with_gzip_compression():
     # Act
     out, stats = delete_matches_from_json_file(out_stream, to_delete, True)
     assert isinstance(out, pa.BufferOutputStream)
-    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    assert {
+        "ProcessedRows": 3,
+        "DeletedRows": 1,
+        "KeyLookups": 1,
+        "KeyLookupMisses": 1,
+    } == stats
     assert to_decompressed_json_string(out) == (
         '{"customer_id": "12345", "x": 7, "d":"2001-01-01"}\n'
         '{"customer_id": "34567", "x": 9, "d":"2001-01-05"}\n'
@@ -61,7 +73,12 @@ def test_delete_correct_rows_when_missing_newline_at_the_end():
     # Act
     out, stats = delete_matches_from_json_file(out_stream, to_delete)
     assert isinstance(out, pa.BufferOutputStream)
-    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    assert {
+        "ProcessedRows": 3,
+        "DeletedRows": 1,
+        "KeyLookups": 1,
+        "KeyLookupMisses": 1,
+    } == stats
     assert to_json_string(out) == (
         '{"customer_id": "12345", "x": 1.2, "d":"2001-01-01"}\n'
         '{"customer_id": "34567", "x": 3.4, "d":"2001-01-05"}\n'
@@ -81,7 +98,12 @@ def test_delete_correct_rows_containing_newlines_as_content():
     # Act
     out, stats = delete_matches_from_json_file(out_stream, to_delete)
     assert isinstance(out, pa.BufferOutputStream)
-    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    assert {
+        "ProcessedRows": 3,
+        "DeletedRows": 1,
+        "KeyLookups": 2,
+        "KeyLookupMisses": 1,
+    } == stats
     assert to_json_string(out) == (
         '{"customer_id": "23456", "d": "foo\u2028\\nbar"}\n'
         '{"customer_id": "34567", "d": "bar"}\n'
@@ -100,7 +122,12 @@ def test_delete_correct_rows_from_json_file_with_complex_types():
     # Act
     out, stats = delete_matches_from_json_file(out_stream, to_delete)
     assert isinstance(out, pa.BufferOutputStream)
-    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    assert {
+        "ProcessedRows": 3,
+        "DeletedRows": 1,
+        "KeyLookups": 2,
+        "KeyLookupMisses": 2,
+    } == stats
     assert to_json_string(out) == (
         '{"user": {"id": "12345", "name": "John"}, "d":["2001-01-01"]}\n'
         '{"user": {"id": "34567", "name": "Mary"}, "d":["2001-01-08"]}\n'
@@ -121,7 +148,12 @@ def test_delete_correct_rows_from_json_file_with_nullable_or_undefined_identifie
     # Act
     out, stats = delete_matches_from_json_file(out_stream, to_delete)
     assert isinstance(out, pa.BufferOutputStream)
-    assert {"ProcessedRows": 5, "DeletedRows": 1} == stats
+    assert {
+        "ProcessedRows": 5,
+        "DeletedRows": 1,
+        "KeyLookups": 4,
+        "KeyLookupMisses": 2,
+    } == stats
     assert to_json_string(out) == (
         '{"user": {"id": "23456", "name": "Jane"}, "parents": {"mother": null}}\n'
         '{"user": {"id": "34567", "name": "Mary"}}\n'
@@ -142,7 +174,12 @@ def test_delete_correct_rows_from_json_file_with_lower_cased_column_id():
     # Act
     out, stats = delete_matches_from_json_file(out_stream, to_delete)
     assert isinstance(out, pa.BufferOutputStream)
-    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    assert {
+        "ProcessedRows": 3,
+        "DeletedRows": 1,
+        "KeyLookups": 1,
+        "KeyLookupMisses": 1,
+    } == stats
     assert to_json_string(out) == (
         '{"userId": "12345", "fullName": "JohnDoe"}\n'
         '{"userId": "34567", "fullName": "MaryMary"}\n'
@@ -164,7 +201,12 @@ def test_delete_correct_rows_from_json_file_with_multiple_identifiers():
     # Act
     out, stats = delete_matches_from_json_file(out_stream, to_delete)
     assert isinstance(out, pa.BufferOutputStream)
-    assert {"ProcessedRows": 3, "DeletedRows": 2} == stats
+    assert {
+        "ProcessedRows": 3,
+        "DeletedRows": 2,
+        "KeyLookups": 5,
+        "KeyLookupMisses": 3,
+    } == stats
     assert to_json_string(out) == '{"user": {"id": "34567", "name": "Mary"}}\n'
 
 
@@ -186,6 +228,405 @@ def test_it_throws_meaningful_error_for_serialization_issues():
     )
 
 
+def test_it_finds_matches_hidden_by_escape_sequences():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456", "a/b"]}]
+    data = (
+        '{"customer_id": "12345"}\n'
+        '{"customer_id": "\\u0032\\u0033456"}\n'
+        '{"customer_id": "a\\/b"}\n'
+        '{"customer_id": "34567", "d": "\\"23456\\""}\n'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {
+        "ProcessedRows": 4,
+        "DeletedRows": 2,
+        "KeyLookups": 3,
+        "KeyLookupMisses": 2,
+    } == stats
+    assert to_json_string(out) == (
+        '{"customer_id": "12345"}\n'
+        '{"customer_id": "34567", "d": "\\"23456\\""}\n'
+    )
+
+
+def test_it_finds_numeric_matches_in_any_notation():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": [23456, 1, 2.5]}]
+    data = (
+        '{"customer_id": 123456}\n'
+        '{"customer_id": 23456.0}\n'
+        '{"customer_id": 2.3456e4}\n'
+        '{"customer_id": -23456}\n'
+        '{"customer_id": true}\n'
+        '{"customer_id": 2.50}\n'
+        '{"customer_id": "23456"}\n'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {
+        "ProcessedRows": 7,
+        "DeletedRows": 4,
+        "KeyLookups": 4,
+        "KeyLookupMisses": 1,
+    } == stats
+    assert to_json_string(out) == (
+        '{"customer_id": 123456}\n'
+        '{"customer_id": -23456}\n'
+        '{"customer_id": "23456"}\n'
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.MAX_COMPILED_MATCH_IDS", 0)
+def test_it_finds_matches_when_too_many_match_ids_to_compile():
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": ["23456", 34567, 2.5]},
+    ]
+    data = (
+        '{"customer_id": "12345"}\n'
+        '{"customer_id": "23456"}\n'
+        '{"customer_id": 34567.00}\n'
+        '{"customer_id": 2.50}\n'
+        '{"customer_id": 3.4567e4}\n'
+        '{"customer_id": 345678}\n'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {
+        "ProcessedRows": 6,
+        "DeletedRows": 4,
+        "KeyLookups": 4,
+        "KeyLookupMisses": 1,
+    } == stats
+    assert to_json_string(out) == (
+        '{"customer_id": "12345"}\n' '{"customer_id": 345678}\n'
+    )
+
+
+@pytest.mark.parametrize("max_compiled", [0, 1000])
+def test_it_finds_matches_after_any_whitespace(max_compiled):
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": [23456, "34567"]}]
+    data = (
+        '{"customer_id":\r23456}\n'
+        '{"customer_id":\t\r "34567"}\n'
+        '{"customer_id":\r12345}\n'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    with patch(
+        "backend.ecs_tasks.delete_files.json_handler.MAX_COMPILED_MATCH_IDS",
+        max_compiled,
+    ):
+        out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    # Assert
+    assert 2 == stats["DeletedRows"]
+    assert out.getvalue().to_pybytes() == b'{"customer_id":\r12345}\n'
+
+
+def test_it_finds_numeric_matches_with_more_digits_than_a_float_holds():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": [123, 0.1]}]
+    data = (
+        '{"customer_id": 123.0000000000000001}\n'
+        '{"customer_id": 123.000000000001}\n'
+        '{"customer_id": 0.10000000000000000001}\n'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    # Assert
+    assert 2 == stats["DeletedRows"]
+    assert to_json_string(out) == '{"customer_id": 123.000000000001}\n'
+
+
+def test_it_copies_lines_without_matches_byte_for_byte():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    data = (
+        '{ "customer_id" :"12345",\t"d": "ümlaut" }\r\n'
+        '{"customer_id": "23456"}\n'
+        '{"other": "23456", "customer_id": "34567"}'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {
+        "ProcessedRows": 3,
+        "DeletedRows": 1,
+        "KeyLookups": 2,
+        "KeyLookupMisses": 2,
+    } == stats
+    assert out.getvalue().to_pybytes() == (
+        '{ "customer_id" :"12345",\t"d": "ümlaut" }\r\n'
+        '{"other": "23456", "customer_id": "34567"}\n'
+    ).encode("utf-8")
+
+
+def test_it_handles_deleting_last_line_without_newline():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    data = '{"customer_id": "12345"}\n{"customer_id": "23456"}'
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {
+        "ProcessedRows": 2,
+        "DeletedRows": 1,
+        "KeyLookups": 1,
+        "KeyLookupMisses": 1,
+    } == stats
+    assert to_json_string(out) == '{"customer_id": "12345"}\n'
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.READ_CHUNK_SIZE", 10)
+def test_it_processes_lines_spanning_multiple_chunks():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    data = (
+        '{"customer_id": "12345"}\n'
+        '{"customer_id": "23456"}\n'
+        "\n"
+        '{"customer_id": "34567"}'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {
+        "ProcessedRows": 4,
+        "DeletedRows": 1,
+        "KeyLookups": 1,
+        "KeyLookupMisses": 1,
+    } == stats
+    assert to_json_string(out) == (
+        '{"customer_id": "12345"}\n' "\n" '{"customer_id": "34567"}\n'
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.READ_CHUNK_SIZE", 30)
+def test_it_reports_line_numbers_across_chunks():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    data = (
+        '{"customer_id": "12345"}\n'
+        '{"customer_id": "34567"}\n'
+        '{"customer_id": "23456", "d":"invalid\n'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    with pytest.raises(ValueError) as e:
+        delete_matches_from_json_file(out_stream, to_delete)
+    assert e.value.args[0] == (
+        "Serialization error when processing JSON object: "
+        "Unterminated string starting at: line 3 column 30 (char 29)"
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.READ_CHUNK_SIZE", 10)
+def test_it_streams_compressed_json_to_the_given_sink():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    data = '{"customer_id": "12345"}\n' '{"customer_id": "23456"}\n'
+    sink = BytesIO()
+    # Act
+    out, stats = delete_matches_from_json_file(
+        to_compressed_json_file(data), to_delete, True, sink
+    )
+    # Assert
+    assert out is sink
+    assert not sink.closed
+    assert {
+        "ProcessedRows": 2,
+        "DeletedRows": 1,
+        "KeyLookups": 1,
+        "KeyLookupMisses": 1,
+    } == stats
+    assert gzip.decompress(sink.getvalue()) == b'{"customer_id": "12345"}\n'
+
+
+def test_it_does_not_match_objects_or_arrays():
+    # Arrange
+    to_delete = [{"Column": "user", "MatchIds": ["23456"]}]
+    data = '{"user": {"id": "23456"}}\n' '{"user": ["23456"]}\n' '{"user": "23456"}\n'
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {
+        "ProcessedRows": 3,
+        "DeletedRows": 1,
+        "KeyLookups": 3,
+        "KeyLookupMisses": 1,
+    } == stats
+    assert to_json_string(out) == '{"user": {"id": "23456"}}\n' '{"user": ["23456"]}\n'
+
+
+def test_it_reuses_match_index_across_files():
+    # Arrange
+    match_index = MatchIndex([{"Column": "customer_id", "MatchIds": ["23456"]}])
+    data = '{"customer_id": "12345"}\n' '{"customer_id": "23456"}\n'
+    # Act
+    for misses in [1, 0]:
+        out, stats = delete_matches_from_json_file(to_json_file(data), match_index)
+        assert {
+            "ProcessedRows": 2,
+            "DeletedRows": 1,
+            "KeyLookups": 1,
+            "KeyLookupMisses": misses,
+        } == stats
+        assert to_json_string(out) == '{"customer_id": "12345"}\n'
+
+
+def test_it_caches_resolved_keys_by_object_layout():
+    # Arrange
+    to_delete = [{"Column": "user.id", "MatchIds": ["23456", "34567"]}]
+    data = (
+        '{"User": {"ID": "23456"}, "x": 1}\n'
+        '{"User": {"ID": "34567"}, "x": 2}\n'
+        '{"x": 3, "user": {"Id": "34567", "ID": "23456"}}\n'
+        '{"x": 4, "user": {"Id": "34567", "ID": "23456"}}\n'
+    )
+    # Act
+    out, stats = delete_matches_from_json_file(to_json_file(data), to_delete)
+    # Assert
+    assert {
+        "ProcessedRows": 4,
+        "DeletedRows": 4,
+        "KeyLookups": 8,
+        "KeyLookupMisses": 4,
+    } == stats
+    assert to_json_string(out) == ""
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.MAX_CACHED_KEY_LAYOUTS", 0)
+def test_it_resolves_keys_when_layout_cache_is_full():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    data = '{"Customer_Id": "23456"}\n' '{"Customer_Id": "23456"}\n'
+    # Act
+    out, stats = delete_matches_from_json_file(to_json_file(data), to_delete)
+    # Assert
+    assert {
+        "ProcessedRows": 2,
+        "DeletedRows": 2,
+        "KeyLookups": 2,
+        "KeyLookupMisses": 2,
+    } == stats
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.MIN_ARROW_CANDIDATES", 1)
+@pytest.mark.parametrize(
+    "to_delete,data",
+    [
+        (
+            [{"Column": "customer_id", "MatchIds": ["23456", 34567]}],
+            '{"customer_id": "12345", "x": 1.5}\n'
+            '{"customer_id": "23456", "x": 2.5}\n'
+            '{"customer_id": null, "x": 3.5}\n'
+            '{"x": 4.5}\n',
+        ),
+        (
+            [{"Column": "user.id", "MatchIds": [34567, 1.0]}],
+            '{"user": {"id": 12345}}\n'
+            '{"user": {"id": 34567.0}}\n'
+            '{"user": {"id": 0}}\n'
+            '{"user": null}\n'
+            '{"user": {"Id": 1}}\n',
+        ),
+        (
+            [{"Column": "user.flag", "MatchIds": [1, 0]}],
+            '{"user": {"flag": true}}\n{"user": {"flag": false}}\n',
+        ),
+        (
+            [{"Column": "customer_id", "MatchIds": [9007199254740993]}],
+            '{"customer_id": 9007199254740992.0}\n'
+            '{"customer_id": 9007199254740993}\n'
+            '{"customer_id": 1.5}\n',
+        ),
+        (
+            [{"Column": "customer_id", "MatchIds": ["23456"]}],
+            '{"customer_id": "23456", "Customer_Id": "12345"}\n'
+            '{"Customer_Id": "23456"}\n',
+        ),
+        (
+            [{"Column": "customer_id", "MatchIds": ["2001-01-01"]}],
+            '{"customer_id": "2001-01-01"}\n{"customer_id": "2001-01-02"}\n',
+        ),
+        (
+            [{"Column": "customer_id", "MatchIds": ["23456"]}],
+            '{"customer_id": "23456"}\n{"customer_id": 23456}\n \n[]\n',
+        ),
+    ],
+)
+def test_arrow_engine_matches_python_engine(to_delete, data):
+    # Act
+    results = [
+        delete_matches_from_json_file(to_json_file(data), to_delete, engine=engine)
+        for engine in ["python", "arrow"]
+    ]
+    # Assert
+    (python_out, python_stats), (arrow_out, arrow_stats) = results
+    for stat in ["ProcessedRows", "DeletedRows"]:
+        assert python_stats[stat] == arrow_stats[stat]
+    assert to_json_string(python_out) == to_json_string(arrow_out)
+
+
+def test_arrow_engine_copies_surviving_lines_byte_for_byte():
+    # Arrange
+    to_delete = [{"Column": "user.id", "MatchIds": ["23456"]}]
+    lines = [
+        '{ "USER" : {"ID": "%s"} , "x" : 1.50, "y": "\\u00e9"}\n' % i
+        for i in range(20000, 25000)
+    ]
+    out_stream = to_json_file("".join(lines))
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete, engine="arrow")
+    # Assert
+    assert {
+        "ProcessedRows": 5000,
+        "DeletedRows": 1,
+        "KeyLookups": 0,
+        "KeyLookupMisses": 0,
+    } == stats
+    assert to_json_string(out) == "".join(lines[:3456] + lines[3457:])
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.MIN_ARROW_CANDIDATES", 1)
+@patch("backend.ecs_tasks.delete_files.json_handler.find_lines_to_delete")
+def test_arrow_engine_does_not_parse_lines_one_by_one(mock_find_lines):
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    data = '{"customer_id": "12345"}\n{"customer_id": "23456"}\n'
+    # Act
+    out, stats = delete_matches_from_json_file(
+        to_json_file(data), to_delete, engine="arrow"
+    )
+    # Assert
+    mock_find_lines.assert_not_called()
+    assert {
+        "ProcessedRows": 2,
+        "DeletedRows": 1,
+        "KeyLookups": 0,
+        "KeyLookupMisses": 0,
+    } == stats
+    assert to_json_string(out) == '{"customer_id": "12345"}\n'
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.MIN_ARROW_CANDIDATES", 1)
+def test_arrow_engine_falls_back_for_serialization_errors():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    data = '{"customer_id": "12345"}\n{"customer_id": "23456"\n'
+    # Act / Assert
+    with pytest.raises(ValueError) as e:
+        delete_matches_from_json_file(to_json_file(data), to_delete, engine="arrow")
+    assert "line 2" in str(e.value)
+
+
 def to_json_file(data, compressed=False):
     mode = "wb" if compressed else "w+t"
     tmp = tempfile.NamedTemporaryFile(mode=mode)
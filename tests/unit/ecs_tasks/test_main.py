@@ -1,5 +1,7 @@
+import json
 import os
 from argparse import Namespace
+from threading import Barrier
 
 import boto3
 from botocore.exceptions import ClientError
@@ -9,12 +11,17 @@ import pyarrow as pa
 import pytest
 from pyarrow.lib import ArrowException
 
-from s3 import DeleteOldVersionsError, IntegrityCheckFailedError
+from match_index import MatchIndex
+from backend.ecs_tasks.delete_files.s3 import (
+    DeleteOldVersionsError,
+    IntegrityCheckFailedError,
+)
 
 with patch.dict(
     os.environ, {"DELETE_OBJECTS_QUEUE": "https://url/q.fifo", "DLQ": "https://url/q",}
 ):
     from backend.ecs_tasks.delete_files.main import (
+        ShutdownRequested,
         kill_handler,
         execute,
         handle_error,
@@ -22,11 +29,40 @@ with patch.dict(
         main,
         parse_args,
         delete_matches_from_file,
+        get_match_index,
+        get_session_client,
+        extend_visibility,
+        get_max_in_flight,
+        estimate_message,
+        estimate_messages,
+        get_memory_budget,
     )
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
 
+def stream_to(out_stream, new_version):
+    """
+    Emulates save_stream by invoking the write function against the given stream
+    """
+
+    def save_stream(client, write_fn, *args):
+        return new_version, write_fn(out_stream)
+
+    return save_stream
+
+
+def get_reader(version_id="abc123", size=1024):
+    """
+    Stubs RangedObjectReader, returning a reader for an object of the given size
+    """
+    reader = MagicMock()
+    reader.return_value.__enter__.return_value = MagicMock(
+        version_id=version_id, size=size
+    )
+    return reader
+
+
 def get_list_object_versions_error():
     return ClientError(
         {
@@ -48,44 +84,45 @@ def get_list_object_versions_error():
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
 @patch("backend.ecs_tasks.delete_files.main.get_session")
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 def test_happy_path_when_queue_not_empty(
     mock_save,
     mock_emit,
     mock_delete,
-    mock_s3,
+    mock_reader,
     mock_session,
     mock_verify_integrity,
     message_stub,
 ):
-    mock_s3.S3FileSystem.return_value = mock_s3
     column = {"Column": "customer_id", "MatchIds": ["12345", "23456"]}
-    mock_file = MagicMock(version_id="abc123")
-    mock_save.return_value = "new_version123"
-    mock_s3.open.return_value = mock_s3
-    mock_s3.__enter__.return_value = mock_file
-    mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
+    mock_file = MagicMock(version_id="abc123", size=1024)
+    mock_out_stream = MagicMock()
+    mock_save.side_effect = stream_to(mock_out_stream, "new_version123")
+    mock_reader.return_value.__enter__.return_value = mock_file
+    mock_delete.return_value = mock_out_stream, {"DeletedRows": 1}
     execute(
         "https://queue/url",
         message_stub(Object="s3://bucket/path/basic.parquet"),
         "receipt_handle",
     )
-    mock_s3.open.assert_called_with("s3://bucket/path/basic.parquet", "rb")
-    mock_delete.assert_called_with(mock_file, [column], "parquet", False)
+    mock_reader.assert_called_with(ANY, "bucket", "path/basic.parquet")
+    mock_delete.assert_called_with(mock_file, ANY, "parquet", False, mock_out_stream)
+    match_index = mock_delete.call_args[0][1]
+    assert isinstance(match_index, MatchIndex)
+    assert [column] == [
+        {"Column": c["Column"], "MatchIds": c["MatchIds"]} for c in match_index.columns
+    ]
     mock_save.assert_called_with(
-        ANY, ANY, ANY, "bucket", "path/basic.parquet", "abc123"
+        ANY, ANY, "bucket", "path/basic.parquet", "abc123"
     )
-    mock_emit.assert_called()
+    mock_emit.assert_called_with(ANY, {"DeletedRows": 1})
     mock_session.assert_called_with(None)
     mock_verify_integrity.assert_called_with(
         ANY, "bucket", "path/basic.parquet", "abc123", "new_version123"
     )
-    buf = mock_save.call_args[0][2]
-    assert buf.read
-    assert isinstance(buf, pa.BufferReader)  # must be BufferReader for zero-copy
 
 
 @patch.dict(os.environ, {"JobTable": "test"})
@@ -97,44 +134,41 @@ def test_happy_path_when_queue_not_empty(
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
 @patch("backend.ecs_tasks.delete_files.main.get_session")
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 def test_happy_path_when_queue_not_empty_for_compressed_json(
     mock_save,
     mock_emit,
     mock_delete,
-    mock_s3,
+    mock_reader,
     mock_session,
     mock_verify_integrity,
     message_stub,
 ):
-    mock_s3.S3FileSystem.return_value = mock_s3
     column = {"Column": "customer_id", "MatchIds": ["12345", "23456"]}
-    mock_file = MagicMock(version_id="abc123")
-    mock_save.return_value = "new_version123"
-    mock_s3.open.return_value = mock_s3
-    mock_s3.__enter__.return_value = mock_file
-    mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
+    mock_file = MagicMock(version_id="abc123", size=1024)
+    mock_out_stream = MagicMock()
+    mock_save.side_effect = stream_to(mock_out_stream, "new_version123")
+    mock_reader.return_value.__enter__.return_value = mock_file
+    mock_delete.return_value = mock_out_stream, {"DeletedRows": 1}
     execute(
         "https://queue/url",
         message_stub(Object="s3://bucket/path/basic.json.gz", Format="json"),
         "receipt_handle",
     )
-    mock_s3.open.assert_called_with("s3://bucket/path/basic.json.gz", "rb")
-    mock_delete.assert_called_with(mock_file, [column], "json", True)
+    mock_reader.assert_called_with(ANY, "bucket", "path/basic.json.gz")
+    mock_delete.assert_called_with(mock_file, ANY, "json", True, mock_out_stream)
+    assert column["MatchIds"] == mock_delete.call_args[0][1].columns[0]["MatchIds"]
     mock_save.assert_called_with(
-        ANY, ANY, ANY, "bucket", "path/basic.json.gz", "abc123"
+        ANY, ANY, "bucket", "path/basic.json.gz", "abc123"
     )
     mock_emit.assert_called()
     mock_session.assert_called_with(None)
     mock_verify_integrity.assert_called_with(
         ANY, "bucket", "path/basic.json.gz", "abc123", "new_version123"
     )
-    buf = mock_save.call_args[0][2]
-    assert buf.read
-    assert isinstance(buf, pa.BufferReader)  # must be BufferReader for zero-copy
 
 
 @patch.dict(os.environ, {"JobTable": "test"})
@@ -149,14 +183,17 @@ def test_happy_path_when_queue_not_empty_for_compressed_json(
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.save", MagicMock())
+@patch(
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=stream_to(MagicMock(), "new_version123")),
+)
 @patch("backend.ecs_tasks.delete_files.main.get_session")
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
-def test_it_assumes_role(mock_delete, mock_s3, mock_session, message_stub):
-    mock_s3.S3FileSystem.return_value = mock_s3
-    mock_s3.open.return_value = mock_s3
-    mock_s3.__enter__.return_value = MagicMock(version_id="abc123")
+def test_it_assumes_role(mock_delete, mock_reader, mock_session, message_stub):
+    mock_reader.return_value.__enter__.return_value = MagicMock(
+        version_id="abc123", size=1024
+    )
     mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
     execute(
         "https://queue/url",
@@ -182,17 +219,53 @@ def test_it_assumes_role(mock_delete, mock_s3, mock_session, message_stub):
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch(
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=stream_to(MagicMock(), "new_version123")),
+)
+@patch("backend.ecs_tasks.delete_files.main.open_input")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
+@patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
+def test_it_processes_objects_from_input_opened_by_size(
+    mock_delete, mock_reader, mock_open_input, message_stub
+):
+    # Arrange
+    mock_file = MagicMock(version_id="abc123", size=2 ** 34)
+    mock_reader.return_value.__enter__.return_value = mock_file
+    mock_spilled = MagicMock()
+    mock_open_input.return_value.__enter__.return_value = mock_spilled
+    mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
+    # Act
+    execute("https://queue/url", message_stub(), "receipt_handle")
+    # Assert
+    mock_open_input.assert_called_with(mock_file, 2 ** 34)
+    mock_delete.assert_called_with(mock_spilled, ANY, "parquet", False, ANY)
+
+
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch(
+    "backend.ecs_tasks.delete_files.main.verify_object_versions_integrity",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.delete_old_versions")
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 def test_it_removes_old_versions(
-    mock_delete, mock_s3, mock_delete_versions, mock_save, message_stub
+    mock_delete, mock_reader, mock_delete_versions, mock_save, message_stub
 ):
-    mock_s3.S3FileSystem.return_value = mock_s3
-    mock_s3.open.return_value = mock_s3
-    mock_s3.__enter__.return_value = MagicMock(version_id="abc123")
-    mock_save.return_value = "new_version123"
+    mock_reader.return_value.__enter__.return_value = MagicMock(
+        version_id="abc123", size=1024
+    )
+    mock_save.side_effect = stream_to(MagicMock(), "new_version123")
     mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
     execute(
         "https://queue/url",
@@ -219,18 +292,18 @@ def test_it_removes_old_versions(
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.delete_old_versions")
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
 def test_it_handles_old_version_delete_failures(
-    mock_handle, mock_delete, mock_s3, mock_delete_versions, mock_save, message_stub,
+    mock_handle, mock_delete, mock_reader, mock_delete_versions, mock_save, message_stub,
 ):
-    mock_s3.S3FileSystem.return_value = mock_s3
-    mock_s3.open.return_value = mock_s3
-    mock_s3.__enter__.return_value = MagicMock(version_id="abc123")
-    mock_save.return_value = "new_version123"
+    mock_reader.return_value.__enter__.return_value = MagicMock(
+        version_id="abc123", size=1024
+    )
+    mock_save.side_effect = stream_to(MagicMock(), "new_version123")
     mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
     mock_delete_versions.side_effect = DeleteOldVersionsError(errors=["access denied"])
     execute(
@@ -255,24 +328,25 @@ def test_it_handles_old_version_delete_failures(
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
 def test_it_handles_no_deletions(
-    mock_handle, mock_save, mock_emit, mock_delete, mock_s3, message_stub
+    mock_handle, mock_save, mock_emit, mock_delete, mock_reader, message_stub
 ):
-    mock_s3.S3FileSystem.return_value = mock_s3
-    column = {"Column": "customer_id", "MatchIds": ["12345", "23456"]}
-    mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 0}
+    mock_reader.return_value.__enter__.return_value = MagicMock(
+        version_id="abc123", size=1024
+    )
+    mock_save.side_effect = stream_to(MagicMock(), "new_version123")
+    mock_delete.return_value = MagicMock(), {"DeletedRows": 0}
     execute(
         "https://queue/url",
         message_stub(Object="s3://bucket/path/basic.parquet"),
         "receipt_handle",
     )
-    mock_s3.open.assert_called_with("s3://bucket/path/basic.parquet", "rb")
-    mock_save.assert_not_called()
+    mock_reader.assert_called_with(ANY, "bucket", "path/basic.parquet")
     mock_emit.assert_not_called()
     mock_handle.assert_called_with(
         ANY,
@@ -282,6 +356,226 @@ def test_it_handles_no_deletions(
     )
 
 
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
+@patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", get_reader())
+@patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
+@patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
+@patch("backend.ecs_tasks.delete_files.main.get_match_index")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_processes_grouped_objects(
+    mock_queue,
+    mock_match_index,
+    mock_save,
+    mock_emit,
+    mock_delete,
+    mock_verify_integrity,
+    message_stub,
+):
+    # Arrange
+    mock_save.side_effect = stream_to(MagicMock(), "new_version123")
+    mock_delete.return_value = MagicMock(), {"DeletedRows": 1}
+    body = json.loads(message_stub())
+    del body["Object"]
+    body["Objects"] = [
+        {"Object": "s3://bucket/a.parquet", "Size": 10},
+        {"Object": "s3://bucket/b.parquet", "Size": 20},
+    ]
+    # Act
+    execute("https://queue/url", json.dumps(body), "receipt_handle")
+    # Assert
+    assert [
+        call(ANY, ANY, "bucket", "a.parquet", "abc123"),
+        call(ANY, ANY, "bucket", "b.parquet", "abc123"),
+    ] == mock_save.call_args_list
+    assert [
+        "s3://bucket/a.parquet",
+        "s3://bucket/b.parquet",
+    ] == [c[0][0]["Object"] for c in mock_emit.call_args_list]
+    assert all("Objects" not in c[0][0] for c in mock_emit.call_args_list)
+    mock_match_index.assert_called_once_with("query_bucket", "query_key")
+    assert [mock_match_index.return_value] * 2 == [
+        c[0][1] for c in mock_delete.call_args_list
+    ]
+    msg = mock_queue.return_value.Message.return_value
+    msg.delete.assert_called_once()
+    msg.change_visibility.assert_not_called()
+
+
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
+@patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", get_reader())
+@patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
+@patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
+@patch("backend.ecs_tasks.delete_files.main.emit_failure_event")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
+@patch("backend.ecs_tasks.delete_files.main.batch_sqs_msgs")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_returns_failed_objects_of_groups_to_the_queue(
+    mock_queue,
+    mock_batch,
+    mock_save,
+    mock_emit_failure,
+    mock_emit,
+    mock_delete,
+    mock_verify_integrity,
+    message_stub,
+):
+    # Arrange
+    mock_batch.return_value = []
+    mock_save.side_effect = [
+        ("new_version123", {"DeletedRows": 1}),
+        IOError("FAIL"),
+        ("new_version123", {"DeletedRows": 1}),
+    ]
+    body = json.loads(message_stub())
+    del body["Object"]
+    body["Objects"] = [
+        {"Object": "s3://bucket/a.parquet", "Size": 10},
+        {"Object": "s3://bucket/b.parquet", "Size": 20},
+        {"Object": "s3://bucket/c.parquet", "Size": 30},
+    ]
+    # Act
+    execute("https://queue/url", json.dumps(body), "receipt_handle")
+    # Assert
+    assert 2 == mock_emit.call_count
+    mock_emit_failure.assert_called_once()
+    failed_body, err_message, _ = mock_emit_failure.call_args[0]
+    assert "s3://bucket/b.parquet" == json.loads(failed_body)["Object"]
+    assert "Unable to retrieve object: FAIL" == err_message
+    requeued = mock_batch.call_args[0][1]
+    assert ["s3://bucket/b.parquet"] == [m["Object"] for m in requeued]
+    assert all("Objects" not in m for m in requeued)
+    assert mock_queue.return_value == mock_batch.call_args[0][0]
+    msg = mock_queue.return_value.Message.return_value
+    msg.delete.assert_called_once()
+    msg.change_visibility.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "requeue_result",
+    [
+        {"return_value": [{"Id": "1", "Code": "Throttled", "SenderFault": False}]},
+        {"side_effect": ClientError({}, "SendMessageBatch")},
+    ],
+)
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch("backend.ecs_tasks.delete_files.main.process_object")
+@patch("backend.ecs_tasks.delete_files.main.emit_failure_event", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_match_index", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.batch_sqs_msgs")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_retries_group_where_failed_objects_not_returned_to_the_queue(
+    mock_queue, mock_batch, mock_process, requeue_result, message_stub
+):
+    # Arrange
+    mock_batch.configure_mock(**requeue_result)
+    mock_process.side_effect = [True, False]
+    body = json.loads(message_stub())
+    del body["Object"]
+    body["Objects"] = [
+        {"Object": "s3://bucket/a.parquet", "Size": 10},
+        {"Object": "s3://bucket/b.parquet", "Size": 20},
+    ]
+    # Act
+    execute("https://queue/url", json.dumps(body), "receipt_handle")
+    # Assert
+    mock_batch.assert_called_once()
+    msg = mock_queue.return_value.Message.return_value
+    msg.delete.assert_not_called()
+    msg.change_visibility.assert_called_with(VisibilityTimeout=0)
+
+
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch("backend.ecs_tasks.delete_files.main.process_object")
+@patch("backend.ecs_tasks.delete_files.main.emit_failure_event")
+@patch("backend.ecs_tasks.delete_files.main.get_match_index")
+@patch("backend.ecs_tasks.delete_files.main.batch_sqs_msgs")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_emits_object_failures_where_group_payload_unavailable(
+    mock_queue,
+    mock_batch,
+    mock_match_index,
+    mock_emit_failure,
+    mock_process,
+    message_stub,
+):
+    # Arrange
+    mock_batch.return_value = []
+    mock_match_index.side_effect = ClientError({}, "GetObject")
+    body = json.loads(message_stub())
+    del body["Object"]
+    body["Objects"] = [
+        {"Object": "s3://bucket/a.parquet", "Size": 10},
+        {"Object": "s3://bucket/b.parquet", "Size": 20},
+    ]
+    # Act
+    execute("https://queue/url", json.dumps(body), "receipt_handle")
+    # Assert
+    mock_process.assert_not_called()
+    failed_bodies = [json.loads(c[0][0]) for c in mock_emit_failure.call_args_list]
+    assert ["s3://bucket/a.parquet", "s3://bucket/b.parquet"] == [
+        b["Object"] for b in failed_bodies
+    ]
+    assert all("Objects" not in b for b in failed_bodies)
+    assert ["s3://bucket/a.parquet", "s3://bucket/b.parquet"] == [
+        m["Object"] for m in mock_batch.call_args[0][1]
+    ]
+    msg = mock_queue.return_value.Message.return_value
+    msg.delete.assert_called_once()
+    msg.change_visibility.assert_not_called()
+
+
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch("backend.ecs_tasks.delete_files.main.process_object")
+@patch("backend.ecs_tasks.delete_files.main.emit_failure_event")
+@patch("backend.ecs_tasks.delete_files.main.get_match_index", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.batch_sqs_msgs")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_returns_unprocessed_objects_when_stopped_during_group(
+    mock_queue, mock_batch, mock_emit_failure, mock_process, message_stub
+):
+    # Arrange
+    mock_batch.return_value = []
+    mock_process.side_effect = [True, ShutdownRequested()]
+    body = json.loads(message_stub())
+    del body["Object"]
+    body["Objects"] = [
+        {"Object": "s3://bucket/a.parquet", "Size": 10},
+        {"Object": "s3://bucket/b.parquet", "Size": 20},
+        {"Object": "s3://bucket/c.parquet", "Size": 30},
+    ]
+    # Act
+    with pytest.raises(SystemExit):
+        execute("https://queue/url", json.dumps(body), "receipt_handle")
+    # Assert
+    assert 2 == mock_process.call_count
+    assert [
+        ("s3://bucket/b.parquet", "SIGINT/SIGTERM received during processing"),
+        ("s3://bucket/c.parquet", "SIGINT/SIGTERM received during processing"),
+    ] == [
+        (json.loads(c[0][0])["Object"], c[0][1])
+        for c in mock_emit_failure.call_args_list
+    ]
+    assert ["s3://bucket/b.parquet", "s3://bucket/c.parquet"] == [
+        m["Object"] for m in mock_batch.call_args[0][1]
+    ]
+    msg = mock_queue.return_value.Message.return_value
+    msg.delete.assert_called_once()
+    msg.change_visibility.assert_not_called()
+
+
 @patch.dict(os.environ, {"JobTable": "test"})
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch(
@@ -289,7 +583,7 @@ def test_it_handles_no_deletions(
     MagicMock(return_value=True),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", get_reader())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
@@ -313,7 +607,7 @@ def test_it_handles_missing_col_exceptions(
     MagicMock(return_value=True),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", get_reader())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
@@ -362,11 +656,10 @@ def test_it_validates_messages_with_invalid_body(mock_error_handler):
     MagicMock(return_value=True),
 )
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
-def test_it_handles_s3_permission_issues(mock_error_handler, mock_s3, message_stub):
-    mock_s3.S3FileSystem.return_value = mock_s3
-    mock_s3.open.side_effect = ClientError({}, "GetObject")
+def test_it_handles_s3_permission_issues(mock_error_handler, mock_reader, message_stub):
+    mock_reader.side_effect = ClientError({}, "GetObject")
     # Act
     execute("https://queue/url", message_stub(), "receipt_handle")
     # Assert
@@ -381,12 +674,11 @@ def test_it_handles_s3_permission_issues(mock_error_handler, mock_s3, message_st
     MagicMock(return_value=True),
 )
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
-def test_it_handles_io_errors(mock_error_handler, mock_s3, message_stub):
+def test_it_handles_io_errors(mock_error_handler, mock_reader, message_stub):
     # Arrange
-    mock_s3.S3FileSystem.return_value = mock_s3
-    mock_s3.open.side_effect = IOError("an error")
+    mock_reader.side_effect = IOError("an error")
     # Act
     execute("https://queue/url", message_stub(), "receipt_handle")
     # Assert
@@ -402,12 +694,11 @@ def test_it_handles_io_errors(mock_error_handler, mock_s3, message_stub):
     MagicMock(return_value=True),
 )
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
-def test_it_handles_file_too_big(mock_error_handler, mock_s3, message_stub):
+def test_it_handles_file_too_big(mock_error_handler, mock_reader, message_stub):
     # Arrange
-    mock_s3.S3FileSystem.return_value = mock_s3
-    mock_s3.open.side_effect = MemoryError("Too big")
+    mock_reader.side_effect = MemoryError("Too big")
     # Act
     execute("https://queue/url", message_stub(), "receipt_handle")
     # Assert
@@ -423,12 +714,11 @@ def test_it_handles_file_too_big(mock_error_handler, mock_s3, message_stub):
     MagicMock(return_value=True),
 )
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
-def test_it_handles_generic_error(mock_error_handler, mock_s3, message_stub):
+def test_it_handles_generic_error(mock_error_handler, mock_reader, message_stub):
     # Arrange
-    mock_s3.S3FileSystem.return_value = mock_s3
-    mock_s3.open.side_effect = RuntimeError("Some Error")
+    mock_reader.side_effect = RuntimeError("Some Error")
     # Act
     execute("https://queue/url", message_stub(), "receipt_handle")
     # Assert
@@ -439,13 +729,12 @@ def test_it_handles_generic_error(mock_error_handler, mock_s3, message_stub):
 
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.validate_bucket_versioning")
-@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
 def test_it_handles_unversioned_buckets(
-    mock_error_handler, mock_s3, mock_versioning, message_stub
+    mock_error_handler, mock_versioning, message_stub
 ):
     # Arrange
-    mock_s3.S3FileSystem.return_value = mock_s3
     mock_versioning.side_effect = ValueError("Versioning validation Error")
     # Act
     execute("https://queue/url", message_stub(), "receipt_handle")
@@ -463,11 +752,11 @@ def test_it_handles_unversioned_buckets(
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", get_reader())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 def test_it_provides_logs_for_acl_fail(
     mock_save, mock_error_handler, mock_delete, message_stub
 ):
@@ -490,11 +779,12 @@ def test_it_provides_logs_for_acl_fail(
     MagicMock(return_value=True),
 )
 @patch(
-    "backend.ecs_tasks.delete_files.main.save", MagicMock(return_value="new_version")
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=stream_to(MagicMock(), "new_version")),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", get_reader())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.rollback_object_version")
 @patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
@@ -524,11 +814,12 @@ def test_it_provides_logs_for_failed_version_integrity_check_and_performs_rollba
     MagicMock(return_value=True),
 )
 @patch(
-    "backend.ecs_tasks.delete_files.main.save", MagicMock(return_value="new_version")
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=stream_to(MagicMock(), "new_version")),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", get_reader())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
@@ -555,10 +846,11 @@ def test_it_provides_logs_for_get_latest_version_fail(
     MagicMock(return_value=True),
 )
 @patch(
-    "backend.ecs_tasks.delete_files.main.save", MagicMock(return_value="new_version")
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=stream_to(MagicMock(), "new_version")),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", get_reader())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
@@ -594,10 +886,11 @@ def test_it_provides_logs_for_failed_rollback_client_error(
     MagicMock(return_value=True),
 )
 @patch(
-    "backend.ecs_tasks.delete_files.main.save", MagicMock(return_value="new_version")
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=stream_to(MagicMock(), "new_version")),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.s3fs", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", get_reader())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
@@ -733,6 +1026,33 @@ def test_it_gracefully_handles_cleanup_issues(mock_error_handler):
         mock_pool.terminate.assert_called()
 
 
+@patch("backend.ecs_tasks.delete_files.main.emit_failure_event")
+def test_kill_handler_emits_object_failures_for_waiting_groups(
+    mock_emit_failure, message_stub
+):
+    body = json.loads(message_stub())
+    del body["Object"]
+    body["Objects"] = [
+        {"Object": "s3://bucket/a.parquet", "Size": 10},
+        {"Object": "s3://bucket/b.parquet", "Size": 20},
+    ]
+    waiting = MagicMock(message_id="waiting", body=json.dumps(body))
+    running = MagicMock(message_id="running", body=json.dumps(body))
+    mock_pool = MagicMock()
+    mock_pool.get_running.return_value = {"running"}
+    with pytest.raises(SystemExit):
+        kill_handler([waiting, running], mock_pool)
+    mock_pool.terminate.assert_called()
+    failed_bodies = [json.loads(c[0][0]) for c in mock_emit_failure.call_args_list]
+    assert ["s3://bucket/a.parquet", "s3://bucket/b.parquet"] == [
+        b["Object"] for b in failed_bodies
+    ]
+    assert all("Objects" not in b for b in failed_bodies)
+    waiting.change_visibility.assert_called_once_with(VisibilityTimeout=0)
+    # Cleaned up by the worker processing the group
+    running.change_visibility.assert_not_called()
+
+
 @patch.dict(os.environ, {"DELETE_OBJECTS_QUEUE": "https://queue/url"})
 def test_it_inits_arg_parser_with_defaults():
     res = parse_args([])
@@ -740,9 +1060,17 @@ def test_it_inits_arg_parser_with_defaults():
     assert all(
         [
             hasattr(res, attr)
-            for attr in ["wait_time", "max_messages", "sleep_time", "queue_url"]
+            for attr in [
+                "wait_time",
+                "max_messages",
+                "sleep_time",
+                "queue_url",
+                "max_worker_rss",
+                "max_in_flight",
+            ]
         ]
     )
+    assert 1024 == res.max_worker_rss
     assert isinstance(res.wait_time, int)
     assert isinstance(res.max_messages, int)
     assert isinstance(res.sleep_time, int)
@@ -771,29 +1099,133 @@ def test_it_does_not_override_user_supplied_endpoint_url(mock_boto):
     mock_boto.resource.assert_called_with("sqs", endpoint_url="https://my/url")
 
 
+@patch("backend.ecs_tasks.delete_files.main.estimate_message", MagicMock(return_value=0))
 @patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.Pool")
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=2))
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
 @patch("backend.ecs_tasks.delete_files.main.get_queue")
 def test_it_starts_subprocesses(mock_queue, mock_pool):
     mock_queue.return_value = mock_queue
-    mock_message = MagicMock()
+    mock_message = MagicMock(message_id="id1")
     mock_queue.receive_messages.return_value = [mock_message]
     # Break out of while loop
     mock_pool.return_value = mock_pool
     mock_pool.__enter__.return_value = mock_pool
-    mock_pool.starmap.side_effect = RuntimeError("Break loop")
+    mock_pool.get_completed.side_effect = RuntimeError("Break loop")
     with pytest.raises(RuntimeError):
-        main("https://queue/url", 1, 1, 1)
-    mock_pool.assert_called_with(maxtasksperchild=1)
-    mock_pool.starmap.assert_called_with(
-        ANY, [("https://queue/url", mock_message.body, mock_message.receipt_handle)]
+        main("https://queue/url", 1, 1, 1, max_in_flight=4)
+    mock_pool.assert_called_with(2, 1024 * 1024 * 1024)
+    mock_pool.submit.assert_called_with(
+        "id1",
+        ANY,
+        ("https://queue/url", mock_message.body, mock_message.receipt_handle),
     )
     mock_queue.receive_messages.assert_called_with(
         WaitTimeSeconds=1, MaxNumberOfMessages=1
     )
 
 
-@patch("backend.ecs_tasks.delete_files.main.Pool", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.estimate_message", MagicMock(return_value=0))
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.extend_visibility", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_receives_messages_while_others_are_in_flight(mock_queue, mock_pool):
+    mock_queue.return_value = mock_queue
+    messages = [MagicMock(message_id=str(i)) for i in range(4)]
+    mock_queue.receive_messages.side_effect = [
+        messages[0:2],
+        messages[2:3],
+        messages[3:4],
+        RuntimeError("Break loop"),
+    ]
+    mock_pool.return_value = mock_pool
+    mock_pool.__enter__.return_value = mock_pool
+    mock_pool.get_completed.side_effect = [[], ["0"], ["1"]]
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 10, 20, 1, max_in_flight=3)
+    assert [
+        call(WaitTimeSeconds=20, MaxNumberOfMessages=3),
+        # Polls for the free slots are capped while messages are in flight
+        call(WaitTimeSeconds=1, MaxNumberOfMessages=1),
+        call(WaitTimeSeconds=1, MaxNumberOfMessages=1),
+        call(WaitTimeSeconds=1, MaxNumberOfMessages=1),
+    ] == mock_queue.receive_messages.call_args_list
+    # The long poll takes the time otherwise spent waiting for the workers
+    assert [call(timeout=0)] * 3 == mock_pool.get_completed.call_args_list
+    assert 4 == mock_pool.submit.call_count
+
+
+@patch("backend.ecs_tasks.delete_files.main.estimate_message", MagicMock(return_value=0))
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.extend_visibility", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_waits_for_workers_when_no_free_slots(mock_queue, mock_pool):
+    mock_queue.return_value = mock_queue
+    mock_queue.receive_messages.side_effect = [
+        [MagicMock(message_id="0")],
+        RuntimeError("Break loop"),
+    ]
+    mock_pool.return_value = mock_pool
+    mock_pool.__enter__.return_value = mock_pool
+    mock_pool.get_completed.side_effect = [[], [], ["0"]]
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 10, 0, 1, max_in_flight=1)
+    assert 2 == mock_queue.receive_messages.call_count
+    assert [
+        call(timeout=1),
+        call(timeout=1),
+        call(timeout=1),
+    ] == mock_pool.get_completed.call_args_list
+
+
+@patch("backend.ecs_tasks.delete_files.main.time")
+def test_it_extends_visibility_of_messages_in_flight(mock_time):
+    mock_time.time.return_value = 1000
+    queue = MagicMock()
+    queue.change_message_visibility_batch.return_value = {
+        "Failed": [{"Id": "2", "Message": "Receipt handle invalid"}]
+    }
+    msgs = [MagicMock(receipt_handle="handle{}".format(i)) for i in range(12)]
+    in_flight = {str(i): (msg, 0) for i, msg in enumerate(msgs)}
+    in_flight["recent"] = (msgs[0], 900)
+    extend_visibility(queue, in_flight, 300)
+    assert 2 == queue.change_message_visibility_batch.call_count
+    assert {
+        "Id": "11",
+        "ReceiptHandle": "handle11",
+        "VisibilityTimeout": 300,
+    } in queue.change_message_visibility_batch.call_args[1]["Entries"]
+    assert all(
+        extended_at == 1000
+        for message_id, (_, extended_at) in in_flight.items()
+        if message_id != "recent"
+    )
+    assert (msgs[0], 900) == in_flight["recent"]
+
+
+def test_it_handles_errors_extending_visibility():
+    queue = MagicMock()
+    queue.change_message_visibility_batch.side_effect = ClientError(
+        {}, "ChangeMessageVisibilityBatch"
+    )
+    in_flight = {"1": (MagicMock(), 0)}
+    extend_visibility(queue, in_flight, 300)
+    assert in_flight["1"][1] > 0
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_available_memory")
+def test_it_sizes_messages_in_flight_from_available_memory(mock_memory):
+    mock_memory.return_value = None
+    assert 8 == get_max_in_flight(4, 1024)
+    mock_memory.return_value = 6 * 1024
+    assert 6 == get_max_in_flight(4, 1024)
+    mock_memory.return_value = 1024
+    assert 4 == get_max_in_flight(4, 1024)
+
+
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue")
 @patch("backend.ecs_tasks.delete_files.main.time")
@@ -807,7 +1239,7 @@ def test_it_sleeps_where_no_messages(mock_time, mock_queue):
     mock_time.sleep.assert_called_with(1)
 
 
-@patch("backend.ecs_tasks.delete_files.main.Pool", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.signal")
 @patch("backend.ecs_tasks.delete_files.main.get_queue")
 def test_it_sets_kill_handlers(mock_queue, mock_signal):
@@ -826,7 +1258,7 @@ def test_it_deletes_from_json_file(mock_parquet, mock_json):
     f = MagicMock()
     cols = MagicMock()
     delete_matches_from_file(f, cols, "json", False)
-    mock_json.assert_called_with(f, cols, False)
+    mock_json.assert_called_with(f, cols, False, None)
     mock_parquet.assert_not_called()
 
 
@@ -836,5 +1268,209 @@ def test_it_deletes_from_parquet_file(mock_parquet, mock_json):
     f = MagicMock()
     cols = MagicMock()
     delete_matches_from_file(f, cols, "parquet")
-    mock_parquet.assert_called_with(f, cols)
+    mock_parquet.assert_called_with(f, cols, None)
     mock_json.assert_not_called()
+
+
+def test_it_compiles_query_payloads_once(query_payload_stub):
+    first = get_match_index("query_bucket", "query_key")
+    second = get_match_index("query_bucket", "query_key")
+    assert first is second
+    assert ["12345", "23456"] == first.columns[0]["MatchIds"]
+    assert frozenset(["12345", "23456"]) == first.columns[0]["MatchIdSet"]
+    query_payload_stub.Object.return_value.get.assert_called_once_with(
+        IfMatch='"etag"'
+    )
+
+
+def test_it_compiles_query_payloads_again_when_modified(query_payload_stub):
+    first = get_match_index("query_bucket", "query_key")
+    query_payload_stub.Object.return_value.e_tag = '"modified"'
+    second = get_match_index("query_bucket", "query_key")
+    assert first is not second
+    assert 2 == query_payload_stub.Object.return_value.get.call_count
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_session")
+def test_it_reuses_sessions_per_role(mock_session):
+    first = get_session_client("arn:aws:iam::123:role/a")
+    assert first == get_session_client("arn:aws:iam::123:role/a")
+    get_session_client(None)
+    assert [
+        call("arn:aws:iam::123:role/a"),
+        call(None),
+    ] == mock_session.call_args_list
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_session")
+def test_it_sizes_client_connection_pool_for_concurrent_transfers(mock_session):
+    get_session_client(None)
+    config = mock_session.return_value.client.call_args[1]["config"]
+    assert 12 == config.max_pool_connections
+
+
+@patch("backend.ecs_tasks.delete_files.main.time")
+@patch("backend.ecs_tasks.delete_files.main.get_session")
+def test_it_renews_sessions_after_ttl(mock_session, mock_time):
+    mock_time.time.return_value = 1000
+    get_session_client(None)
+    mock_time.time.return_value = 1000 + 15 * 60 + 1
+    get_session_client(None)
+    assert 2 == mock_session.call_count
+
+
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.extend_visibility", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=2))
+@patch("backend.ecs_tasks.delete_files.main.get_memory_budget")
+@patch("backend.ecs_tasks.delete_files.main.estimate_message")
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_admits_messages_within_memory_budget(
+    mock_queue, mock_pool, mock_estimate, mock_budget
+):
+    mock_queue.return_value = mock_queue
+    mock_budget.return_value = 100
+    mock_estimate.side_effect = {"0": 60, "1": 30, "2": 20}.get
+    messages = [MagicMock(message_id=str(i), body=str(i)) for i in range(3)]
+    mock_queue.receive_messages.side_effect = [
+        messages,
+        [],
+        RuntimeError("Break loop"),
+    ]
+    mock_pool.return_value = mock_pool
+    mock_pool.__enter__.return_value = mock_pool
+    mock_pool.get_completed.side_effect = [[], ["0"], []]
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 10, 1, 1, max_in_flight=3)
+    calls = [
+        (name, args[0] if args else None)
+        for name, args, _ in mock_pool.mock_calls
+        if name in ["submit", "get_completed"]
+    ]
+    assert [
+        ("submit", "0"),
+        ("submit", "1"),
+        ("get_completed", None),
+        ("get_completed", None),
+        # The third message only fits once the first completes
+        ("submit", "2"),
+        ("get_completed", None),
+    ] == calls
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_requester_payment")
+@patch("backend.ecs_tasks.delete_files.main.get_session_client")
+def test_it_estimates_message_memory_usage(mock_session_client, mock_payment):
+    client = MagicMock()
+    client.head_object.return_value = {"ContentLength": 100}
+    mock_session_client.return_value = MagicMock(), client
+    mock_payment.return_value = {"RequestPayer": "requester"}, {}
+    assert 300 == estimate_message(
+        '{"Object": "s3://bucket/path/basic.parquet", "Format": "parquet"}'
+    )
+    client.head_object.assert_called_with(
+        Bucket="bucket", Key="path/basic.parquet", RequestPayer="requester"
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_session_client")
+def test_it_estimates_no_memory_usage_for_unknown_objects(mock_session_client):
+    client = MagicMock()
+    client.head_object.side_effect = ClientError({}, "HeadObject")
+    mock_session_client.return_value = MagicMock(), client
+    assert 0 == estimate_message('{"Object": "s3://bucket/path/basic.parquet"}')
+    assert 0 == estimate_message("invalid")
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_requester_payment")
+@patch("backend.ecs_tasks.delete_files.main.get_session")
+def test_it_estimates_messages_with_sessions_kept_from_workers(
+    mock_session, mock_payment
+):
+    # Arrange
+    client = mock_session.return_value.client.return_value
+    client.head_object.return_value = {"ContentLength": 100}
+    mock_payment.return_value = {}, {}
+    worker_sessions = {}
+    parent_sessions = {}
+    # Act
+    with patch("backend.ecs_tasks.delete_files.main.sessions", worker_sessions):
+        with patch(
+            "backend.ecs_tasks.delete_files.main.estimate_sessions", parent_sessions
+        ):
+            estimates = estimate_messages(
+                [
+                    json.dumps({"Object": "s3://bucket/a.parquet"}),
+                    json.dumps({"Object": "s3://bucket/b.parquet"}),
+                ]
+            )
+    # Assert
+    assert [300, 300] == estimates
+    mock_session.assert_called_once_with(None)
+    assert {} == worker_sessions
+    assert [None] == list(parent_sessions)
+
+
+@patch("backend.ecs_tasks.delete_files.main.estimate_sessions", {})
+@patch("backend.ecs_tasks.delete_files.main.get_requester_payment")
+@patch("backend.ecs_tasks.delete_files.main.get_session")
+def test_it_estimates_messages_concurrently(mock_session, mock_payment):
+    # Arrange
+    # The session creations, then the HEAD requests, of the 3 messages only
+    # complete if they are made at the same time
+    barrier = Barrier(3, timeout=5)
+
+    def head_object(**kwargs):
+        barrier.wait()
+        return {"ContentLength": 100}
+
+    def get_session(role_arn):
+        barrier.wait()
+        session = MagicMock()
+        session.client.return_value.head_object.side_effect = head_object
+        return session
+
+    mock_session.side_effect = get_session
+    mock_payment.return_value = {}, {}
+    bodies = [
+        json.dumps(
+            {
+                "Object": "s3://bucket/{}.parquet".format(i),
+                "Format": "parquet",
+                "RoleArn": "arn:aws:iam::123:role/{}".format(i),
+            }
+        )
+        for i in range(3)
+    ]
+    # Act
+    estimates = estimate_messages(bodies)
+    # Assert
+    assert [300, 300, 300] == estimates
+    assert 3 == mock_session.call_count
+
+
+def test_it_estimates_grouped_messages_from_object_sizes():
+    assert 600 == estimate_message(
+        json.dumps(
+            {
+                "Objects": [
+                    {"Object": "s3://bucket/a.parquet", "Size": 100},
+                    {"Object": "s3://bucket/b.parquet", "Size": 200},
+                ],
+                "Format": "parquet",
+            }
+        )
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_available_memory")
+@patch("backend.ecs_tasks.delete_files.main.get_memory_limit")
+def test_it_sizes_memory_budget_from_container_limit(mock_limit, mock_available):
+    mock_limit.return_value = 1000
+    mock_available.return_value = 500
+    assert 750 == get_memory_budget()
+    mock_limit.return_value = None
+    assert 375 == get_memory_budget()
+    mock_available.return_value = None
+    assert float("inf") == get_memory_budget()
@@ -0,0 +1,94 @@
+import pyarrow as pa
+import pytest
+
+from match_index import MatchIndex, get_match_index
+
+pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
+
+
+def test_it_compiles_match_ids_into_sets():
+    match_index = MatchIndex(
+        [
+            {"Column": "customer_id", "MatchIds": ["12345", "23456", "12345"]},
+            {"Column": "user.id", "MatchIds": [2, 1]},
+        ]
+    )
+    assert [
+        {
+            "Column": "customer_id",
+            "MatchIds": ["12345", "23456", "12345"],
+            "MatchIdSet": frozenset(["12345", "23456"]),
+            "SortedMatchIds": ["12345", "23456"],
+        },
+        {
+            "Column": "user.id",
+            "MatchIds": [2, 1],
+            "MatchIdSet": frozenset([1, 2]),
+            "SortedMatchIds": [1, 2],
+        },
+    ] == match_index.columns
+
+
+def test_it_does_not_sort_unsortable_match_ids():
+    match_index = MatchIndex([{"Column": "customer_id", "MatchIds": ["12345", 1]}])
+    assert match_index.columns[0]["SortedMatchIds"] is None
+
+
+def test_it_converts_match_ids_to_arrow_arrays_once_per_type():
+    match_index = MatchIndex([{"Column": "customer_id", "MatchIds": [1, 2]}])
+    column = match_index.columns[0]
+    int32_array = match_index.get_array(column, pa.int32())
+    assert pa.array([1, 2], pa.int32()).equals(int32_array)
+    assert int32_array is match_index.get_array(column, pa.int32())
+    assert pa.array([1, 2], pa.int64()).equals(
+        match_index.get_array(column, pa.int64())
+    )
+
+
+def test_it_converts_match_ids_to_value_type_of_dictionaries():
+    match_index = MatchIndex([{"Column": "customer_id", "MatchIds": ["a", "b"]}])
+    column = match_index.columns[0]
+    assert pa.array(["a", "b"]).equals(
+        match_index.get_array(column, pa.dictionary(pa.int32(), pa.string()))
+    )
+
+
+def test_it_leaves_out_match_ids_of_other_types():
+    match_index = MatchIndex(
+        [{"Column": "customer_id", "MatchIds": ["1", 2, 3.5, True, 4.0]}]
+    )
+    column = match_index.columns[0]
+    assert pa.array([2, 4], pa.int64()).equals(
+        match_index.get_array(column, pa.int64())
+    )
+    assert pa.array(["1"]).equals(match_index.get_array(column, pa.string()))
+
+
+def test_it_leaves_out_match_ids_out_of_range():
+    match_index = MatchIndex(
+        [{"Column": "customer_id", "MatchIds": [1, 3000000000, 2 ** 70]}]
+    )
+    column = match_index.columns[0]
+    assert pa.array([1], pa.int32()).equals(match_index.get_array(column, pa.int32()))
+    assert pa.array([1, 3000000000], pa.int64()).equals(
+        match_index.get_array(column, pa.int64())
+    )
+
+
+def test_it_compiles_format_specific_structures_once():
+    match_index = MatchIndex([{"Column": "customer_id", "MatchIds": [1, 2]}])
+    calls = []
+
+    def compile_fn(columns):
+        calls.append(columns)
+        return "compiled"
+
+    assert "compiled" == match_index.get_compiled("test", compile_fn)
+    assert "compiled" == match_index.get_compiled("test", compile_fn)
+    assert [match_index.columns] == calls
+
+
+def test_it_accepts_compiled_and_raw_columns():
+    match_index = MatchIndex([{"Column": "customer_id", "MatchIds": [1]}])
+    assert match_index is get_match_index(match_index)
+    assert isinstance(get_match_index([{"Column": "a", "MatchIds": [1]}]), MatchIndex)
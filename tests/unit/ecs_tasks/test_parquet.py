@@ -1,5 +1,5 @@
 from io import BytesIO
-from mock import patch
+from mock import patch, call, MagicMock
 
 import pyarrow as pa
 import pyarrow.json as pj
@@ -10,8 +10,9 @@ import tempfile
 from backend.ecs_tasks.delete_files.parquet_handler import (
     delete_matches_from_parquet_file,
     delete_from_table,
+    get_writer_properties,
     load_parquet,
-    get_row_count,
+    row_group_may_contain_matches,
 )
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
@@ -32,9 +33,14 @@ def test_it_generates_new_parquet_file_without_matches(mock_delete, mock_load_pa
     mock_delete.return_value = [pa.Table.from_pandas(mock_df), 1]
     mock_load_parquet.return_value = f
     # Act
-    out, stats = delete_matches_from_parquet_file("input_file.parquet", column)
+    out, stats = delete_matches_from_parquet_file("input_file.parquet", [column])
     assert isinstance(out, pa.BufferOutputStream)
-    assert {"ProcessedRows": 2, "DeletedRows": 1} == stats
+    assert {
+        "ProcessedRows": 2,
+        "DeletedRows": 1,
+        "ProcessedRowGroups": 1,
+        "SkippedRowGroups": 0,
+    } == stats
     res = pa.BufferReader(out.getvalue())
     newf = pq.ParquetFile(res, memory_map=False)
     assert 1 == newf.read().num_rows
@@ -63,13 +69,351 @@ def test_it_handles_files_with_multiple_row_groups_and_pandas_indexes(
     # Act
     out, stats = delete_matches_from_parquet_file("input_file.parquet", columns)
     # Assert
-    assert {"ProcessedRows": 6, "DeletedRows": 3} == stats
+    assert {
+        "ProcessedRows": 6,
+        "DeletedRows": 3,
+        "ProcessedRowGroups": 3,
+        "SkippedRowGroups": 0,
+    } == stats
     res = pa.BufferReader(out.getvalue())
     newf = pq.ParquetFile(res, memory_map=False)
     assert 3 == newf.num_row_groups
     assert 3 == newf.read().num_rows
 
 
+@patch("backend.ecs_tasks.delete_files.parquet_handler.load_parquet")
+def test_it_streams_row_groups_to_given_output_stream(mock_load_parquet):
+    # Arrange
+    data = [{"customer_id": "12345"}, {"customer_id": "34567"}]
+    columns = [{"Column": "customer_id", "MatchIds": ["12345"]}]
+    table = pa.Table.from_pandas(pd.DataFrame(data))
+    buf = BytesIO()
+    with pq.ParquetWriter(buf, table.schema) as writer:
+        for i in range(3):
+            writer.write_table(table)
+    mock_load_parquet.return_value = pq.ParquetFile(
+        pa.BufferReader(buf.getvalue()), memory_map=False
+    )
+    out_stream = BytesIO()
+    # Act
+    out, stats = delete_matches_from_parquet_file(
+        "input_file.parquet", columns, out_stream
+    )
+    # Assert
+    assert out is out_stream
+    assert not out_stream.closed
+    assert {
+        "ProcessedRows": 6,
+        "DeletedRows": 3,
+        "ProcessedRowGroups": 3,
+        "SkippedRowGroups": 0,
+    } == stats
+    newf = pq.ParquetFile(pa.BufferReader(out_stream.getvalue()), memory_map=False)
+    assert 3 == newf.num_row_groups
+    assert 3 == newf.read().num_rows
+
+
+@patch("backend.ecs_tasks.delete_files.parquet_handler.load_parquet")
+@patch("backend.ecs_tasks.delete_files.parquet_handler.delete_from_table")
+def test_it_skips_row_groups_which_cannot_contain_matches(
+    mock_delete, mock_load_parquet
+):
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    schema = pa.schema([("customer_id", pa.string())])
+    buf = BytesIO()
+    with pq.ParquetWriter(buf, schema) as writer:
+        for ids in [["12345", "12399"], ["23400", "23456"], ["34567", "34599"]]:
+            writer.write_table(pa.Table.from_pydict({"customer_id": ids}, schema))
+    mock_load_parquet.return_value = pq.ParquetFile(
+        pa.BufferReader(buf.getvalue()), memory_map=False
+    )
+    mock_delete.side_effect = lambda table, *_: (table.slice(1), 1)
+    # Act
+    out, stats = delete_matches_from_parquet_file("input_file.parquet", columns)
+    # Assert
+    assert 1 == mock_delete.call_count
+    assert {
+        "ProcessedRows": 6,
+        "DeletedRows": 1,
+        "ProcessedRowGroups": 3,
+        "SkippedRowGroups": 2,
+    } == stats
+    newf = pq.ParquetFile(pa.BufferReader(out.getvalue()), memory_map=False)
+    assert 3 == newf.num_row_groups
+    assert ["12345", "12399", "23456", "34567", "34599"] == newf.read().to_pydict()[
+        "customer_id"
+    ]
+
+
+def test_it_prefetches_row_groups_from_prefetching_readers():
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    schema = pa.schema([("customer_id", pa.string()), ("score", pa.int64())])
+    buf = BytesIO()
+    with pq.ParquetWriter(buf, schema) as writer:
+        for ids in [["12345", "23456"], ["34567", "45678"]]:
+            table = pa.Table.from_pydict({"customer_id": ids, "score": [1, 2]}, schema)
+            writer.write_table(table)
+
+    class PrefetchingReader(BytesIO):
+        prefetched = []
+
+        def prefetch(self, ranges):
+            self.prefetched.append(ranges)
+
+    input_file = PrefetchingReader(buf.getvalue())
+    metadata = pq.ParquetFile(BytesIO(buf.getvalue())).metadata
+    # Act
+    _, stats = delete_matches_from_parquet_file(input_file, columns)
+    # Assert
+    assert 1 == stats["DeletedRows"]
+    # The identifier column of the first row group, the second being excluded
+    # by statistics, then the whole row groups
+    assert 3 == len(input_file.prefetched)
+    assert input_file.prefetched[0] == input_file.prefetched[1][:1]
+    for i, ranges in enumerate(input_file.prefetched[1:]):
+        assert 2 == len(ranges)
+        row_group = metadata.row_group(i)
+        for j, (start, end) in enumerate(ranges):
+            column_chunk = row_group.column(j)
+            assert start <= column_chunk.data_page_offset < end
+            assert column_chunk.total_compressed_size == end - start
+
+
+def test_it_preserves_writer_properties():
+    # Arrange
+    table = pa.Table.from_pydict(
+        {
+            "customer_id": ["12345", "23456"] * 5,
+            "score": list(range(10)),
+            "nested": [{"value": 1}] * 10,
+            "created": pa.array([0] * 10, pa.timestamp("ns")),
+        }
+    )
+    buf = BytesIO()
+    pq.write_table(
+        table,
+        buf,
+        compression={"customer_id": "zstd", "score": "none", "nested.value": "gzip"},
+        use_dictionary=["customer_id"],
+        write_statistics=["score"],
+        use_deprecated_int96_timestamps=True,
+        row_group_size=5,
+    )
+    columns = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    # Act
+    out, _ = delete_matches_from_parquet_file(BytesIO(buf.getvalue()), columns)
+    # Assert
+    source = pq.ParquetFile(BytesIO(buf.getvalue())).metadata
+    result = pq.ParquetFile(pa.BufferReader(out.getvalue())).metadata
+    assert get_writer_properties(source) == get_writer_properties(result)
+    assert {
+        "customer_id": "zstd",
+        "score": "none",
+        "nested.value": "gzip",
+        "created": "none",
+    } == get_writer_properties(result)["compression"]
+    assert ["customer_id"] == get_writer_properties(result)["use_dictionary"]
+    assert ["score"] == get_writer_properties(result)["write_statistics"]
+    assert get_writer_properties(result)["use_deprecated_int96_timestamps"]
+    assert source.format_version == result.format_version
+
+
+def test_it_writes_unsupported_codecs_as_snappy():
+    # Arrange
+    codecs = ["LZ4", "LZ4_RAW", "LZO", "GZIP"]
+    metadata = MagicMock(format_version="1.0", num_row_groups=1)
+    metadata.row_group.return_value.num_columns = len(codecs)
+    metadata.row_group.return_value.column.side_effect = [
+        MagicMock(path_in_schema=codec.lower(), compression=codec) for codec in codecs
+    ]
+    # Act
+    result = get_writer_properties(metadata)
+    # Assert
+    assert {
+        "lz4": "snappy",
+        "lz4_raw": "snappy",
+        "lzo": "snappy",
+        "gzip": "gzip",
+    } == result["compression"]
+
+
+def test_it_preserves_row_group_boundaries():
+    # Arrange
+    schema = pa.schema([("customer_id", pa.int64())])
+    buf = BytesIO()
+    with pq.ParquetWriter(buf, schema) as writer:
+        for size in [1100000, 3]:
+            ids = pa.array(range(size), pa.int64())
+            writer.write_table(pa.Table.from_arrays([ids], schema=schema), size)
+    columns = [{"Column": "customer_id", "MatchIds": [1]}]
+    # Act
+    out, _ = delete_matches_from_parquet_file(BytesIO(buf.getvalue()), columns)
+    # Assert
+    result = pq.ParquetFile(pa.BufferReader(out.getvalue())).metadata
+    assert [1099999, 2] == [
+        result.row_group(i).num_rows for i in range(result.num_row_groups)
+    ]
+
+
+@patch("backend.ecs_tasks.delete_files.parquet_handler.delete_from_table")
+def test_it_reads_only_identifier_columns_to_find_matches(mock_delete):
+    # Arrange
+    columns = [{"Column": "user.id", "MatchIds": [2]}]
+    table = pa.Table.from_pydict(
+        {
+            "user": [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}],
+            "payload": ["x", "y"],
+        }
+    )
+    buf = BytesIO()
+    pq.write_table(table, buf, row_group_size=1)
+    parquet_file = pq.ParquetFile(BytesIO(buf.getvalue()))
+    mock_delete.side_effect = lambda table, *_: (table.slice(1), 1)
+    # Act
+    with patch.object(
+        parquet_file, "read_row_group", wraps=parquet_file.read_row_group
+    ) as mock_read:
+        with patch(
+            "backend.ecs_tasks.delete_files.parquet_handler.load_parquet",
+            return_value=parquet_file,
+        ):
+            out, stats = delete_matches_from_parquet_file(BytesIO(), columns)
+    # Assert
+    # The first row group is excluded by statistics
+    assert [
+        call(1, columns=["user.id"]),
+        call(0),
+        call(1),
+    ] == mock_read.call_args_list
+    assert 1 == mock_delete.call_count
+    assert {
+        "ProcessedRows": 2,
+        "DeletedRows": 1,
+        "ProcessedRowGroups": 2,
+        "SkippedRowGroups": 1,
+    } == stats
+
+
+def test_it_writes_nothing_when_no_row_group_contains_matches():
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    table = pa.Table.from_pydict({"customer_id": ["12345", "34567"]})
+    buf = BytesIO()
+    pq.write_table(table, buf, write_statistics=False)
+    out_stream = BytesIO()
+    # Act
+    out, stats = delete_matches_from_parquet_file(
+        BytesIO(buf.getvalue()), columns, out_stream
+    )
+    # Assert
+    assert b"" == out_stream.getvalue()
+    assert {
+        "ProcessedRows": 2,
+        "DeletedRows": 0,
+        "ProcessedRowGroups": 1,
+        "SkippedRowGroups": 1,
+    } == stats
+
+
+def get_row_group_metadata(table):
+    buf = BytesIO()
+    pq.write_table(table, buf)
+    return pq.ParquetFile(
+        pa.BufferReader(buf.getvalue()), memory_map=False
+    ).metadata.row_group(0)
+
+
+def test_it_uses_min_max_statistics_to_prune_row_groups():
+    metadata = get_row_group_metadata(
+        pa.Table.from_pydict({"customer_id": [10, 20, 30]})
+    )
+    for match_ids, expected in [
+        ([5, 35], False),
+        ([5, 15], True),
+        ([10], True),
+        ([30], True),
+        ([31], False),
+    ]:
+        to_delete = [{"Column": "customer_id", "MatchIds": match_ids}]
+        assert expected == row_group_may_contain_matches(metadata, to_delete)
+
+
+def test_it_uses_null_counts_to_prune_row_groups():
+    metadata = get_row_group_metadata(
+        pa.Table.from_pydict(
+            {
+                "customer_id": pa.array([None, None], pa.string()),
+                "user_info": [{"name": "matteo"}, None],
+            }
+        )
+    )
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": ["12345"]},
+        {"Column": "user_info.name", "MatchIds": ["chris"]},
+    ]
+    assert not row_group_may_contain_matches(metadata, to_delete)
+    to_delete[1]["MatchIds"].append("matteo")
+    assert row_group_may_contain_matches(metadata, to_delete)
+
+
+def test_it_does_not_prune_row_groups_when_unsure():
+    metadata = get_row_group_metadata(
+        pa.Table.from_pydict({"customer_id": ["12345", "23456"]})
+    )
+    # Unknown column, incomparable and unsortable MatchIds
+    for to_delete in [
+        [{"Column": "unknown", "MatchIds": ["12345"]}],
+        [{"Column": "customer_id", "MatchIds": [12345]}],
+        [{"Column": "customer_id", "MatchIds": [1, "99999"]}],
+    ]:
+        assert row_group_may_contain_matches(metadata, to_delete)
+
+
+def delete_from_parquet_bytes(table, columns):
+    buf = BytesIO()
+    pq.write_table(table, buf)
+    out, stats = delete_matches_from_parquet_file(BytesIO(buf.getvalue()), columns)
+    return pq.read_table(pa.BufferReader(out.getvalue())), stats
+
+
+def test_it_deletes_from_dictionary_encoded_columns():
+    # Arrange
+    table = pa.Table.from_pydict(
+        {"customer_id": pa.array(["12345", "23456", "12345"]).dictionary_encode()}
+    )
+    columns = [{"Column": "customer_id", "MatchIds": ["12345"]}]
+    # Act
+    result, stats = delete_from_parquet_bytes(table, columns)
+    # Assert
+    assert pa.types.is_dictionary(result.schema.field("customer_id").type)
+    assert ["23456"] == result.column("customer_id").to_pylist()
+    assert 2 == stats["DeletedRows"]
+
+
+def test_it_ignores_match_ids_of_other_types():
+    # Arrange
+    table = pa.Table.from_pydict({"customer_id": pa.array([1, 2, 3], pa.int64())})
+    columns = [{"Column": "customer_id", "MatchIds": ["1", 2, 3.5]}]
+    # Act
+    result, stats = delete_from_parquet_bytes(table, columns)
+    # Assert
+    assert [1, 3] == result.column("customer_id").to_pylist()
+    assert 1 == stats["DeletedRows"]
+
+
+def test_it_ignores_match_ids_out_of_column_range():
+    # Arrange
+    table = pa.Table.from_pydict({"customer_id": pa.array([1, 2], pa.int32())})
+    columns = [{"Column": "customer_id", "MatchIds": [3000000000, 2]}]
+    # Act
+    result, stats = delete_from_parquet_bytes(table, columns)
+    # Assert
+    assert [1] == result.column("customer_id").to_pylist()
+    assert 1 == stats["DeletedRows"]
+
+
 def test_delete_correct_rows_from_table():
     data = [
         {"customer_id": "12345"},
@@ -126,14 +470,55 @@ def test_delete_correct_rows_from_parquet_table_with_complex_types():
     assert res["user_info"].values[0] == {"name": "nick", "email": "23456@test.com"}
 
 
-def test_it_gets_row_count():
-    data = [
-        {"customer_id": "12345"},
-        {"customer_id": "23456"},
-        {"customer_id": "34567"},
+def test_delete_correct_rows_from_table_with_multiple_identifiers():
+    data = {
+        "customer_id": [12345, 23456, 34567, 45678],
+        "email": ["a@test.com", "b@test.com", "c@test.com", None],
+    }
+    columns = [
+        {"Column": "customer_id", "MatchIds": [12345]},
+        {"Column": "email", "MatchIds": ["c@test.com"]},
     ]
-    df = pd.DataFrame(data)
-    assert 3 == get_row_count(df)
+    table = pa.Table.from_pydict(data)
+    table, deleted_rows = delete_from_table(table, columns, table.schema)
+    assert deleted_rows == 2
+    assert table.to_pydict() == {
+        "customer_id": [23456, 45678],
+        "email": ["b@test.com", None],
+    }
+
+
+def test_delete_correct_rows_from_table_with_nested_structs_and_nulls():
+    data = {
+        "customer_id": [1, 2, 3, 4],
+        "user": [
+            {"info": {"name": "matteo"}},
+            {"info": {"name": "nick"}},
+            {"info": None},
+            None,
+        ],
+    }
+    columns = [{"Column": "user.info.name", "MatchIds": ["matteo"]}]
+    table = pa.Table.from_pydict(data)
+    table, deleted_rows = delete_from_table(table, columns, table.schema)
+    assert deleted_rows == 1
+    assert table.to_pydict()["customer_id"] == [2, 3, 4]
+    assert table.to_pydict()["user"][0] == {"info": {"name": "nick"}}
+
+
+def test_it_preserves_schema_when_deleting_from_table():
+    schema = pa.schema([("customer_id", pa.int32()), ("score", pa.float32())])
+    table = pa.Table.from_pydict(
+        {"customer_id": [1, 2, 3], "score": [1.5, 2.5, 3.5]}, schema=schema
+    )
+    columns = [
+        {"Column": "customer_id", "MatchIds": [2]},
+        {"Column": "score", "MatchIds": []},
+    ]
+    result, deleted_rows = delete_from_table(table, columns, schema)
+    assert deleted_rows == 1
+    assert result.schema.equals(schema)
+    assert result.to_pydict() == {"customer_id": [1, 3], "score": [1.5, 3.5]}
 
 
 def test_it_loads_parquet_files():
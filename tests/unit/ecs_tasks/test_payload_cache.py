@@ -0,0 +1,65 @@
+import os
+
+import pytest
+from mock import patch, MagicMock
+
+from backend.ecs_tasks.delete_files.payload_cache import read_payload, get_cache_path
+
+pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    cache_dir = str(tmp_path / "payloads")
+    with patch("backend.ecs_tasks.delete_files.payload_cache.CACHE_DIR", cache_dir):
+        yield cache_dir
+
+
+def get_s3_resource(content):
+    s3_resource = MagicMock()
+    s3_resource.Object.return_value.get.return_value = {
+        "Body": MagicMock(read=MagicMock(return_value=content))
+    }
+    return s3_resource
+
+
+def test_it_downloads_and_caches_payloads(cache_dir):
+    s3_resource = get_s3_resource(b"payload")
+    assert b"payload" == read_payload(s3_resource, "bucket", "key", '"etag"')
+    assert b"payload" == read_payload(s3_resource, "bucket", "key", '"etag"')
+    s3_resource.Object.assert_called_once_with("bucket", "key")
+    s3_resource.Object.return_value.get.assert_called_once_with(IfMatch='"etag"')
+
+
+def test_it_downloads_modified_payloads(cache_dir):
+    s3_resource = get_s3_resource(b"payload")
+    read_payload(s3_resource, "bucket", "key", '"etag"')
+    s3_resource.Object.return_value.get.return_value["Body"].read.return_value = b"new"
+    assert b"new" == read_payload(s3_resource, "bucket", "key", '"modified"')
+    assert 2 == s3_resource.Object.return_value.get.call_count
+
+
+@patch("backend.ecs_tasks.delete_files.payload_cache.MAX_CACHE_SIZE", 10)
+def test_it_evicts_least_recently_used_payloads(cache_dir):
+    for etag in ["1", "2"]:
+        read_payload(get_s3_resource(b"abcd"), "bucket", "key", etag)
+    os.utime(get_cache_path("bucket", "key", "1"), (0, 0))
+    os.utime(get_cache_path("bucket", "key", "2"), (1, 1))
+    # Reading from the cache marks the payload as recently used
+    read_payload(get_s3_resource(b"abcd"), "bucket", "key", "1")
+    read_payload(get_s3_resource(b"abcd"), "bucket", "key", "3")
+    assert os.path.exists(get_cache_path("bucket", "key", "1"))
+    assert not os.path.exists(get_cache_path("bucket", "key", "2"))
+    assert os.path.exists(get_cache_path("bucket", "key", "3"))
+
+
+@patch("backend.ecs_tasks.delete_files.payload_cache.MAX_CACHE_SIZE", 2)
+def test_it_does_not_cache_payloads_larger_than_the_cache(cache_dir):
+    assert b"abcd" == read_payload(get_s3_resource(b"abcd"), "bucket", "key", "1")
+    assert not os.path.exists(get_cache_path("bucket", "key", "1"))
+
+
+@patch("backend.ecs_tasks.delete_files.payload_cache.os.makedirs")
+def test_it_ignores_cache_write_failures(mock_makedirs, cache_dir):
+    mock_makedirs.side_effect = PermissionError("denied")
+    assert b"payload" == read_payload(get_s3_resource(b"payload"), "b", "k", "1")
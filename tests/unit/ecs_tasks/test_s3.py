@@ -1,5 +1,8 @@
 import datetime
+import hashlib
 import json
+from concurrent.futures import Future
+from threading import Barrier
 
 from mock import patch, MagicMock, call, ANY
 from io import BytesIO
@@ -13,14 +16,19 @@ from backend.ecs_tasks.delete_files.s3 import (
     get_grantees,
     get_object_acl,
     get_object_info,
+    get_object_settings,
     get_object_tags,
     validate_bucket_versioning,
     verify_object_versions_integrity,
     delete_old_versions,
-    save,
+    save_stream,
     DeleteOldVersionsError,
     IntegrityCheckFailedError,
     rollback_object_version,
+    RangedObjectReader,
+    MultipartUploadWriter,
+    settings_executor,
+    OBJECT_SETTINGS_CONCURRENCY,
 )
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
@@ -269,6 +277,38 @@ def test_it_gets_grantees_by_type():
     assert {"id=grantee6"} == get_grantees(acl, "WRITE_ACP")
 
 
+def get_upload_client(version_id="new_version123"):
+    """
+    Emulates the multipart upload calls, returning the ETags S3 would return
+    for unencrypted objects
+    """
+    client = MagicMock()
+    client.create_multipart_upload.return_value = {"UploadId": "upload123"}
+    client.upload_part.side_effect = lambda Body, **kwargs: {
+        "ETag": '"{}"'.format(hashlib.md5(Body).hexdigest())
+    }
+    client.uploaded = lambda: b"".join(
+        c[1]["Body"]
+        for c in sorted(
+            client.upload_part.call_args_list, key=lambda c: c[1]["PartNumber"]
+        )
+    )
+
+    def complete_multipart_upload(MultipartUpload, **kwargs):
+        digests = b"".join(
+            bytes.fromhex(part["ETag"].strip('"')) for part in MultipartUpload["Parts"]
+        )
+        return {
+            "ETag": '"{}-{}"'.format(
+                hashlib.md5(digests).hexdigest(), len(MultipartUpload["Parts"])
+            ),
+            "VersionId": version_id,
+        }
+
+    client.complete_multipart_upload.side_effect = complete_multipart_upload
+    return client
+
+
 @patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_info")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_tags")
@@ -277,9 +317,7 @@ def test_it_gets_grantees_by_type():
 def test_it_applies_settings_when_saving(
     mock_grantees, mock_acl, mock_tagging, mock_standard, mock_requester
 ):
-    mock_s3 = MagicMock()
-    mock_s3.S3FileSystem.return_value = mock_s3
-    mock_client = MagicMock()
+    mock_client = get_upload_client()
     mock_requester.return_value = {"RequestPayer": "requester"}, {"Payer": "Requester"}
     mock_standard.return_value = ({"Expires": "123", "Metadata": {}}, {})
     mock_tagging.return_value = (
@@ -303,13 +341,38 @@ def test_it_applies_settings_when_saving(
         },
     )
     mock_grantees.return_value = ""
-    buf = BytesIO()
-    mock_file = MagicMock(version_id="abc123")
-    mock_s3.open.return_value = mock_s3
-    mock_s3.__enter__.return_value = mock_file
-    resp = save(mock_s3, mock_client, buf, "bucket", "key", "abc123")
-    mock_file.write.assert_called_with(b"")
-    assert "abc123" == resp
+    resp = save_stream(
+        mock_client, lambda f: f.write(b"content"), "bucket", "key", "abc123"
+    )
+    assert "new_version123" == resp[0]
+    mock_client.create_multipart_upload.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        RequestPayer="requester",
+        Expires="123",
+        Metadata={},
+        Tagging="a=b",
+        GrantFullControl="id=abc",
+        GrantRead="id=123",
+    )
+    mock_client.upload_part.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        RequestPayer="requester",
+        UploadId="upload123",
+        Body=b"content",
+        PartNumber=1,
+        ContentMD5="mgNkuembtIDdJeHwKEyFVQ==",
+    )
+    mock_client.complete_multipart_upload.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        RequestPayer="requester",
+        UploadId="upload123",
+        MultipartUpload={
+            "Parts": [{"ETag": '"9a0364b9e99bb480dd25e1f0284c8555"', "PartNumber": 1}]
+        },
+    )
     mock_client.put_object_acl.assert_not_called()
 
 
@@ -321,15 +384,13 @@ def test_it_applies_settings_when_saving(
 def test_it_passes_through_version(
     mock_grantees, mock_acl, mock_tagging, mock_standard, mock_requester
 ):
-    mock_s3 = MagicMock()
-    mock_client = MagicMock()
+    mock_client = get_upload_client()
     mock_requester.return_value = {}, {}
     mock_standard.return_value = ({}, {})
     mock_tagging.return_value = ({}, {})
     mock_acl.return_value = ({}, {})
     mock_grantees.return_value = ""
-    buf = BytesIO()
-    save(mock_s3, mock_client, buf, "bucket", "key", "abc123")
+    save_stream(mock_client, MagicMock(), "bucket", "key", "abc123")
     mock_acl.assert_called_with(mock_client, "bucket", "key", "abc123")
     mock_tagging.assert_called_with(mock_client, "bucket", "key", "abc123")
     mock_standard.assert_called_with(mock_client, "bucket", "key", "abc123")
@@ -340,36 +401,79 @@ def test_it_passes_through_version(
 @patch("backend.ecs_tasks.delete_files.s3.get_object_tags")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_acl")
 @patch("backend.ecs_tasks.delete_files.s3.get_grantees")
-def test_it_restores_write_permissions(
+def test_it_applies_settings_when_streaming(
     mock_grantees, mock_acl, mock_tagging, mock_standard, mock_requester
 ):
-    mock_s3 = MagicMock()
-    mock_s3.S3FileSystem.return_value = mock_s3
-    mock_client = MagicMock()
+    mock_client = get_upload_client()
+    mock_requester.return_value = {"RequestPayer": "requester"}, {"Payer": "Requester"}
+    mock_standard.return_value = ({"Expires": "123", "Metadata": {}}, {})
+    mock_tagging.return_value = ({"Tagging": "a=b"}, {})
+    mock_acl.return_value = ({"GrantFullControl": "id=abc"}, {})
+    mock_grantees.return_value = ""
+
+    def write_fn(f):
+        f.write(b"content")
+        return {"DeletedRows": 1}
+
+    resp = save_stream(mock_client, write_fn, "bucket", "key", "abc123")
+    assert ("new_version123", {"DeletedRows": 1}) == resp
+    mock_client.create_multipart_upload.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        RequestPayer="requester",
+        Expires="123",
+        Metadata={},
+        Tagging="a=b",
+        GrantFullControl="id=abc",
+    )
+    assert b"content" == mock_client.uploaded()
+    mock_client.abort_multipart_upload.assert_not_called()
+    mock_client.put_object_acl.assert_not_called()
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_info")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_tags")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_acl")
+@patch("backend.ecs_tasks.delete_files.s3.get_grantees")
+def test_it_aborts_streamed_upload_on_error(
+    mock_grantees, mock_acl, mock_tagging, mock_standard, mock_requester
+):
+    mock_client = get_upload_client()
     mock_requester.return_value = {}, {}
     mock_standard.return_value = ({}, {})
     mock_tagging.return_value = ({}, {})
-    mock_acl.return_value = (
-        {"GrantFullControl": "id=abc",},
-        {
-            "Owner": {"ID": "owner_id"},
-            "Grants": [
-                {
-                    "Grantee": {"ID": "abc", "Type": "CanonicalUser"},
-                    "Permission": "FULL_CONTROL",
-                },
-                {
-                    "Grantee": {"ID": "123", "Type": "CanonicalUser"},
-                    "Permission": "WRITE",
-                },
-            ],
-        },
+    mock_acl.return_value = ({}, {})
+
+    def write_fn(f):
+        f.write(b"content")
+        raise ValueError("no rows required deletion")
+
+    with patch("backend.ecs_tasks.delete_files.s3.UPLOAD_PART_SIZE", 4):
+        with pytest.raises(ValueError):
+            save_stream(mock_client, write_fn, "bucket", "key", "abc123")
+    mock_client.abort_multipart_upload.assert_called_with(
+        Bucket="bucket", Key="key", UploadId="upload123"
     )
+    mock_client.complete_multipart_upload.assert_not_called()
+    mock_client.put_object_acl.assert_not_called()
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_info")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_tags")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_acl")
+@patch("backend.ecs_tasks.delete_files.s3.get_grantees")
+def test_it_restores_write_permissions_when_streaming(
+    mock_grantees, mock_acl, mock_tagging, mock_standard, mock_requester
+):
+    mock_client = get_upload_client()
+    mock_requester.return_value = {}, {}
+    mock_standard.return_value = ({}, {})
+    mock_tagging.return_value = ({}, {})
+    mock_acl.return_value = ({"GrantFullControl": "id=abc"}, {})
     mock_grantees.return_value = {"id=123"}
-    buf = BytesIO()
-    mock_s3.open.return_value = mock_s3
-    mock_s3.__enter__.return_value = MagicMock(version_id="new_version123")
-    save(mock_s3, mock_client, buf, "bucket", "key", "abc123")
+    save_stream(mock_client, MagicMock(), "bucket", "key", "abc123")
     mock_client.put_object_acl.assert_called_with(
         Bucket="bucket",
         Key="key",
@@ -379,6 +483,81 @@ def test_it_restores_write_permissions(
     )
 
 
+def test_it_uploads_parts_concurrently():
+    client = get_upload_client()
+    writer = MultipartUploadWriter(client, "bucket", "key", {}, part_size=4)
+    writer.write(b"0123")
+    writer.write(memoryview(b"456789abc"))
+    writer.write(b"")
+    assert 13 == writer.tell()
+    writer.close()
+    assert writer.closed
+    assert "new_version123" == writer.version_id
+    assert b"0123456789abc" == client.uploaded()
+    parts = client.complete_multipart_upload.call_args[1]["MultipartUpload"]["Parts"]
+    assert [1, 2, 3, 4] == [part["PartNumber"] for part in parts]
+    with pytest.raises(ValueError):
+        writer.write(b"more")
+
+
+def test_it_uploads_empty_objects():
+    client = get_upload_client()
+    writer = MultipartUploadWriter(client, "bucket", "key", {})
+    writer.close()
+    client.upload_part.assert_called_once_with(
+        Bucket="bucket",
+        Key="key",
+        UploadId="upload123",
+        Body=b"",
+        PartNumber=1,
+        ContentMD5="1B2M2Y8AsgTpgAmY7PhCfg==",
+    )
+
+
+def test_it_aborts_uploads_when_parts_fail():
+    client = get_upload_client()
+    client.upload_part.side_effect = ClientError({}, "UploadPart")
+    writer = MultipartUploadWriter(client, "bucket", "key", {}, part_size=4)
+    writer.write(b"0123456789")
+    with pytest.raises(ClientError):
+        writer.close()
+    client.abort_multipart_upload.assert_called_with(
+        Bucket="bucket", Key="key", UploadId="upload123"
+    )
+    client.complete_multipart_upload.assert_not_called()
+
+
+def test_it_raises_for_mismatched_etags():
+    client = get_upload_client()
+    client.complete_multipart_upload.side_effect = None
+    client.complete_multipart_upload.return_value = {
+        "ETag": '"abc-1"',
+        "VersionId": "new_version123",
+    }
+    writer = MultipartUploadWriter(client, "bucket", "key", {})
+    writer.write(b"content")
+    with pytest.raises(IntegrityCheckFailedError) as e:
+        writer.close()
+    assert (client, "bucket", "key", "new_version123") == e.value.args[1:]
+
+
+def test_it_skips_etag_check_for_kms_encrypted_objects():
+    client = get_upload_client()
+    client.create_multipart_upload.return_value = {
+        "UploadId": "upload123",
+        "ServerSideEncryption": "aws:kms",
+    }
+    client.complete_multipart_upload.side_effect = None
+    client.complete_multipart_upload.return_value = {
+        "ETag": '"abc-1"',
+        "VersionId": "new_version123",
+    }
+    writer = MultipartUploadWriter(client, "bucket", "key", {})
+    writer.write(b"content")
+    writer.close()
+    assert "new_version123" == writer.version_id
+
+
 def test_it_verifies_integrity_happy_path():
     s3_mock = MagicMock()
     s3_mock.list_object_versions.return_value = {
@@ -659,3 +838,222 @@ def test_it_handles_error_for_generic_errors():
         "Unknown error: Some issue. Version rollback caused by version integrity "
         "conflict failed"
     )
+
+
+def get_ranged_client(content, version_id="v1"):
+    """
+    Emulates ranged GetObject calls against an object with the given content
+    """
+    client = MagicMock()
+    client.get_bucket_request_payment.return_value = {"Payer": "Requester"}
+
+    def get_object(Range, **kwargs):
+        start, end = Range[len("bytes=") :].split("-")
+        if not start:
+            start, end = max(0, len(content) - int(end)), len(content) - 1
+        start, end = int(start), min(int(end), len(content) - 1)
+        return {
+            "Body": BytesIO(content[start : end + 1]),
+            "ContentRange": "bytes {}-{}/{}".format(start, end, len(content)),
+            "VersionId": version_id,
+        }
+
+    client.get_object.side_effect = get_object
+    return client
+
+
+@patch("backend.ecs_tasks.delete_files.s3.FOOTER_SIZE", 4)
+@patch("backend.ecs_tasks.delete_files.s3.DOWNLOAD_PART_SIZE", 4)
+def test_it_reads_objects_with_ranged_gets_pinned_to_version():
+    content = b"0123456789abcdefghij"
+    client = get_ranged_client(content)
+    with RangedObjectReader(client, "bucket", "key") as f:
+        assert "v1" == f.version_id
+        assert 20 == f.size
+        assert b"0123456789" == f.read(10)
+        assert b"abcdefghij" == f.read()
+        assert b"" == f.read()
+        f.seek(-6, 2)
+        assert b"efgh" == f.read(4)
+    assert [
+        call(Bucket="bucket", Key="key", RequestPayer="requester", Range="bytes=-4"),
+        call(
+            Bucket="bucket",
+            Key="key",
+            RequestPayer="requester",
+            VersionId="v1",
+            Range="bytes=0-3",
+        ),
+        call(
+            Bucket="bucket",
+            Key="key",
+            RequestPayer="requester",
+            VersionId="v1",
+            Range="bytes=4-7",
+        ),
+        call(
+            Bucket="bucket",
+            Key="key",
+            RequestPayer="requester",
+            VersionId="v1",
+            Range="bytes=8-9",
+        ),
+    ] == client.get_object.call_args_list[:4]
+    # The tail of the object is served from memory
+    assert 7 == client.get_object.call_count
+
+
+def test_it_reads_given_object_versions():
+    client = get_ranged_client(b"content", version_id="abc123")
+    with RangedObjectReader(client, "bucket", "key", "abc123") as f:
+        assert b"content" == f.read()
+    client.get_object.assert_called_once_with(
+        Bucket="bucket",
+        Key="key",
+        RequestPayer="requester",
+        VersionId="abc123",
+        Range="bytes=-262144",
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.s3.FOOTER_SIZE", 4)
+def test_it_serves_reads_from_prefetched_ranges():
+    content = bytes(range(100))
+    client = get_ranged_client(content)
+    with RangedObjectReader(client, "bucket", "key") as f:
+        f.prefetch([(30, 40), (10, 20)])
+        # Close ranges are coalesced into one request
+        assert 2 == client.get_object.call_count
+        client.get_object.assert_called_with(
+            Bucket="bucket",
+            Key="key",
+            RequestPayer="requester",
+            VersionId="v1",
+            Range="bytes=10-39",
+        )
+        f.seek(15)
+        assert content[15:35] == f.read(20)
+        assert 2 == client.get_object.call_count
+        # Reads partially outside prefetched ranges fetch the rest
+        f.seek(35)
+        assert content[35:50] == f.read(15)
+        assert 3 == client.get_object.call_count
+        f.seek(98)
+        assert content[98:] == f.read()
+        assert 3 == client.get_object.call_count
+
+
+def test_it_reads_empty_objects():
+    client = MagicMock()
+    client.get_bucket_request_payment.return_value = {"Payer": "BucketOwner"}
+    client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "InvalidRange"}}, "GetObject"
+    )
+    client.head_object.return_value = {"ContentLength": 0, "VersionId": "v1"}
+    with RangedObjectReader(client, "bucket", "key") as f:
+        assert "v1" == f.version_id
+        assert b"" == f.read()
+
+
+def test_it_raises_for_get_object_errors():
+    client = MagicMock()
+    client.get_bucket_request_payment.return_value = {"Payer": "BucketOwner"}
+    client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "GetObject"
+    )
+    with pytest.raises(ClientError):
+        RangedObjectReader(client, "bucket", "key")
+
+
+def test_it_creates_uploads_on_first_part():
+    client = get_upload_client()
+    extra_args = Future()
+    writer = MultipartUploadWriter(client, "bucket", "key", extra_args, part_size=4)
+    writer.write(b"012")
+    client.create_multipart_upload.assert_not_called()
+    extra_args.set_result({"Tagging": "a=b"})
+    writer.write(b"3")
+    client.create_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="key", Tagging="a=b"
+    )
+    writer.close()
+    assert b"0123" == client.uploaded()
+
+
+def test_it_discards_uploads_never_created():
+    client = get_upload_client()
+    writer = MultipartUploadWriter(client, "bucket", "key", {})
+    writer.write(b"content")
+    writer.discard()
+    client.create_multipart_upload.assert_not_called()
+    client.abort_multipart_upload.assert_not_called()
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_object_info")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_tags")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_acl")
+def test_it_gets_object_settings_concurrently(mock_acl, mock_tagging, mock_standard):
+    client = MagicMock()
+    client.get_bucket_request_payment.return_value = {"Payer": "Requester"}
+    barrier = Barrier(3, timeout=5)
+
+    def get_settings(args):
+        def getter(*_):
+            # Only returns once all 3 getters are running
+            barrier.wait()
+            return args, {}
+
+        return getter
+
+    mock_standard.side_effect = get_settings({"Metadata": {}})
+    mock_tagging.side_effect = get_settings({"Tagging": "a=b"})
+    mock_acl.side_effect = get_settings({"GrantFullControl": "id=abc"})
+    assert {
+        "RequestPayer": "requester",
+        "Metadata": {},
+        "Tagging": "a=b",
+        "GrantFullControl": "id=abc",
+    } == get_object_settings(client, "bucket", "key", "abc123")
+    mock_standard.assert_called_with(client, "bucket", "key", "abc123")
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_object_info")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_tags")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_acl")
+@patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
+def test_it_gets_object_settings_with_every_settings_thread_busy(
+    mock_payment, mock_acl, mock_tagging, mock_standard
+):
+    barrier = Barrier(OBJECT_SETTINGS_CONCURRENCY, timeout=5)
+
+    def get_payment(*_):
+        # Only returns once every settings thread is running
+        barrier.wait()
+        return {}, {}
+
+    mock_payment.side_effect = get_payment
+    for getter in [mock_acl, mock_tagging, mock_standard]:
+        getter.return_value = {}, {}
+    futures = [
+        settings_executor.submit(get_object_settings, MagicMock(), "bucket", key)
+        for key in range(OBJECT_SETTINGS_CONCURRENCY)
+    ]
+    assert [{}] * OBJECT_SETTINGS_CONCURRENCY == [
+        f.result(timeout=5) for f in futures
+    ]
+
+
+def test_it_caches_bucket_settings_per_bucket():
+    first_client = MagicMock()
+    first_client.get_bucket_request_payment.return_value = {"Payer": "Requester"}
+    first_client.get_bucket_versioning.return_value = {"Status": "Enabled"}
+    second_client = MagicMock()
+    for client in [first_client, second_client]:
+        assert ({"RequestPayer": "requester"}, ANY) == get_requester_payment(
+            client, "bucket"
+        )
+        assert validate_bucket_versioning(client, "bucket")
+    first_client.get_bucket_request_payment.assert_called_once()
+    first_client.get_bucket_versioning.assert_called_once()
+    second_client.get_bucket_request_payment.assert_not_called()
+    second_client.get_bucket_versioning.assert_not_called()
@@ -0,0 +1,70 @@
+import os
+from collections import namedtuple
+from io import BytesIO
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from mock import patch
+
+from backend.ecs_tasks.delete_files.parquet_handler import (
+    delete_matches_from_parquet_file,
+)
+from backend.ecs_tasks.delete_files.spill import (
+    open_input,
+    should_spill,
+    spill_to_disk,
+)
+
+pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
+
+DiskUsage = namedtuple("DiskUsage", ["total", "used", "free"])
+
+
+@pytest.fixture
+def spill_dir(tmp_path):
+    spill_dir = str(tmp_path / "spill")
+    os.makedirs(spill_dir)
+    with patch("backend.ecs_tasks.delete_files.spill.SPILL_DIR", spill_dir):
+        yield spill_dir
+
+
+@patch("backend.ecs_tasks.delete_files.spill.SPILL_THRESHOLD", 10)
+@patch("backend.ecs_tasks.delete_files.spill.shutil.disk_usage")
+def test_it_spills_objects_above_threshold_which_fit_on_disk(mock_usage, spill_dir):
+    mock_usage.return_value = DiskUsage(100, 50, 50)
+    assert not should_spill(10)
+    assert should_spill(11)
+    assert should_spill(50)
+    assert not should_spill(51)
+
+
+def test_it_spills_objects_to_memory_mapped_files(spill_dir):
+    with spill_to_disk(BytesIO(b"content")) as f:
+        assert isinstance(f, pa.MemoryMappedFile)
+        assert b"content" == f.read()
+        assert 1 == len(os.listdir(spill_dir))
+    assert [] == os.listdir(spill_dir)
+
+
+@patch("backend.ecs_tasks.delete_files.spill.SPILL_THRESHOLD", 10)
+def test_it_opens_small_objects_as_is(spill_dir):
+    input_file = BytesIO(b"content")
+    with open_input(input_file, 7) as f:
+        assert f is input_file
+    assert [] == os.listdir(spill_dir)
+
+
+@patch("backend.ecs_tasks.delete_files.spill.SPILL_THRESHOLD", 10)
+def test_it_processes_spilled_parquet_files(spill_dir):
+    buf = BytesIO()
+    table = pa.Table.from_pydict({"customer_id": ["12345", "23456", "34567"]})
+    pq.write_table(table, buf, row_group_size=1)
+    size = len(buf.getvalue())
+    buf.seek(0)
+    columns = [{"Column": "customer_id", "MatchIds": ["23456"]}]
+    with open_input(buf, size) as f:
+        out, stats = delete_matches_from_parquet_file(f, columns)
+    assert 1 == stats["DeletedRows"]
+    result = pq.read_table(pa.BufferReader(out.getvalue()))
+    assert ["12345", "34567"] == result.column("customer_id").to_pylist()
@@ -0,0 +1,109 @@
+import os
+
+import pytest
+from mock import patch
+
+from backend.ecs_tasks.delete_files.worker_pool import (
+    WorkerPool,
+    get_available_memory,
+    get_rss,
+)
+
+pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
+
+
+def record_pid(path):
+    with open(path, "a") as f:
+        f.write("{}\n".format(os.getpid()))
+
+
+def crash(path):
+    os._exit(1)
+
+
+def raise_error(path):
+    raise RuntimeError("error")
+
+
+def read_pids(path):
+    with open(path) as f:
+        return f.read().split()
+
+
+def run_all(pool, fn, task_ids, path):
+    for task_id in task_ids:
+        pool.submit(task_id, fn, (path,))
+    completed = []
+    while len(completed) < len(task_ids):
+        completed += pool.get_completed(timeout=1)
+    return completed
+
+
+def test_it_reuses_workers_below_the_memory_watermark(tmp_path):
+    path = str(tmp_path / "pids")
+    with WorkerPool(1, 1024 ** 4) as pool:
+        assert ["a", "b", "c"] == run_all(pool, record_pid, ["a", "b", "c"], path)
+    pids = read_pids(path)
+    assert 3 == len(pids)
+    assert 1 == len(set(pids))
+
+
+def test_it_recycles_workers_above_the_memory_watermark(tmp_path):
+    path = str(tmp_path / "pids")
+    with WorkerPool(1, 0) as pool:
+        run_all(pool, record_pid, ["a", "b", "c"], path)
+    pids = read_pids(path)
+    assert 3 == len(pids)
+    assert 3 == len(set(pids))
+
+
+def test_it_completes_tasks_interrupted_by_crashed_workers(tmp_path):
+    path = str(tmp_path / "pids")
+    with WorkerPool(1, 1024 ** 4) as pool:
+        assert ["a"] == run_all(pool, crash, ["a"], path)
+        assert ["b"] == run_all(pool, raise_error, ["b"], path)
+        assert ["c"] == run_all(pool, record_pid, ["c"], path)
+    assert 1 == len(read_pids(path))
+
+
+def test_it_returns_no_tasks_on_timeout():
+    with WorkerPool(1, 1024 ** 4) as pool:
+        assert [] == pool.get_completed(timeout=0.1)
+
+
+def test_it_returns_running_tasks(tmp_path):
+    path = str(tmp_path / "pids")
+    with WorkerPool(1, 1024 ** 4) as pool:
+        pool.submit("a", record_pid, (path,))
+        pool.submit("b", record_pid, (path,))
+        assert {"a"} == pool.get_running()
+        while not pool.get_completed(timeout=1):
+            pass
+        assert {"b"} == pool.get_running()
+
+
+def test_it_terminates_workers():
+    pool = WorkerPool(2, 1024 ** 4)
+    processes = [worker["Process"] for worker in pool._workers]
+    pool.terminate()
+    assert all(not process.is_alive() for process in processes)
+
+
+def test_it_measures_resident_memory():
+    assert get_rss() > 0
+
+
+@patch("builtins.open")
+def test_it_falls_back_to_peak_resident_memory(mock_open):
+    mock_open.side_effect = FileNotFoundError()
+    assert get_rss() > 0
+
+
+def test_it_measures_available_memory():
+    assert get_available_memory() > 0
+
+
+@patch("builtins.open")
+def test_it_returns_no_available_memory_without_proc(mock_open):
+    mock_open.side_effect = FileNotFoundError()
+    assert get_available_memory() is None
@@ -97,6 +97,15 @@ def test_it_batches_msgs():
     )
 
 
+def test_it_returns_messages_which_failed_to_send():
+    queue = MagicMock()
+    queue.attributes = {}
+    failed = {"Id": "1", "Code": "Throttled", "SenderFault": False}
+    queue.send_messages.side_effect = [{"Successful": []}, {"Failed": [failed]}]
+    result = batch_sqs_msgs(queue, list(range(0, 15)))
+    assert [failed] == result
+
+
 def test_it_passes_through_queue_args():
     queue = MagicMock()
     queue.attributes = {}
@@ -68,6 +68,34 @@ def test_it_generates_query_with_partition():
     )
 
 
+def test_it_generates_query_for_coalesced_partitions():
+    resp = make_query(
+        {
+            "Database": "amazonreviews",
+            "Table": "amazon_reviews_parquet",
+            "DeletionQueueDb": "s3f2",
+            "DeletionQueueTableName": "deletion_queue",
+            "Columns": ["customer_id"],
+            "PartitionKeys": [],
+            "Partitions": [
+                [
+                    {"Key": "product_category", "Value": "Books"},
+                    {"Key": "year", "Value": 2020},
+                ],
+                [
+                    {"Key": "product_category", "Value": "Music"},
+                    {"Key": "year", "Value": 2021},
+                ],
+            ],
+        }
+    )
+
+    assert escape_resp(resp).endswith(
+        "WHERE (\"product_category\" = 'Books' AND \"year\" = 2020) "
+        "OR (\"product_category\" = 'Music' AND \"year\" = 2021)"
+    )
+
+
 def test_it_generates_query_with_multiple_partitions():
     resp = make_query(
         {
@@ -1,4 +1,5 @@
 import os
+from threading import Barrier
 from types import SimpleNamespace
 
 import mock
@@ -15,6 +16,10 @@ with patch.dict(os.environ, {"QueryQueue": "test"}):
         generate_athena_queries,
         get_data_mappers,
         get_inner_children,
+        get_table_schema,
+        get_column_converter,
+        column_mapper,
+        coalesce_partitions,
     )
 
 pytestmark = [pytest.mark.unit, pytest.mark.task]
@@ -87,6 +92,52 @@ def test_it_raises_for_unknown_query_executor(
         batch_sqs_msgs_mock.assert_not_called()
 
 
+@patch("backend.lambdas.tasks.generate_queries.batch_sqs_msgs")
+@patch("backend.lambdas.tasks.generate_queries.get_deletion_queue")
+@patch("backend.lambdas.tasks.generate_queries.get_data_mappers")
+@patch("backend.lambdas.tasks.generate_queries.generate_athena_queries")
+def test_it_generates_queries_for_data_mappers_concurrently(
+    gen_athena_queries, get_data_mappers, get_del_q, batch_sqs_msgs_mock
+):
+    get_del_q.return_value = "bucket", [{"MatchId": "hi"}]
+    barrier = Barrier(2, timeout=5)
+
+    def generate(data_mapper, *args):
+        # Blocks until the queries of both data mappers are being generated
+        barrier.wait()
+        return [{"DataMapperId": data_mapper["DataMapperId"]}]
+
+    gen_athena_queries.side_effect = generate
+    get_data_mappers.return_value = iter(
+        [
+            {"DataMapperId": "a", "QueryExecutor": "athena"},
+            {"DataMapperId": "b", "QueryExecutor": "athena"},
+        ]
+    )
+    handler({"ExecutionName": "test"}, SimpleNamespace())
+    assert [
+        mock.call(mock.ANY, [{"DataMapperId": "a"}]),
+        mock.call(mock.ANY, [{"DataMapperId": "b"}]),
+    ] == batch_sqs_msgs_mock.call_args_list
+
+
+@patch("backend.lambdas.tasks.generate_queries.MAX_PARTITIONS_PER_QUERY", 3)
+@patch("backend.lambdas.tasks.generate_queries.MAX_QUERY_DATA_SIZE", 100)
+def test_it_coalesces_partitions_by_count_and_size():
+    partitions = [
+        {"Values": ["a"], "Parameters": {"sizeKey": "10"}},
+        {"Values": ["b"]},
+        {"Values": ["c"], "Parameters": {"sizeKey": "invalid"}},
+        {"Values": ["d"], "Parameters": {"sizeKey": "60"}},
+        {"Values": ["e"], "Parameters": {"sizeKey": "50"}},
+        {"Values": ["f"], "Parameters": {"sizeKey": "200"}},
+    ]
+    groups = coalesce_partitions(partitions)
+    assert [["a", "b", "c"], ["d"], ["e"], ["f"]] == [
+        [p["Values"][0] for p in group] for group in groups
+    ]
+
+
 class TestAthenaQueries:
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
@@ -125,6 +176,54 @@ class TestAthenaQueries:
             }
         ]
 
+    @patch("backend.lambdas.tasks.generate_queries.MAX_PARTITIONS_PER_QUERY", 2)
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
+    @patch("backend.lambdas.tasks.generate_queries.get_table")
+    @patch("backend.lambdas.tasks.generate_queries.get_partitions")
+    def test_it_coalesces_partitions_into_queries(
+        self, get_partitions_mock, get_table_mock, s3_client_mock
+    ):
+        columns = ["customer_id"]
+        get_table_mock.return_value = table_stub(columns, ["product_category"])
+        get_partitions_mock.return_value = [
+            partition_stub([p], columns) for p in ["Books", "Music", "Games"]
+        ]
+        resp = generate_athena_queries(
+            {
+                "DataMapperId": "a",
+                "QueryExecutor": "athena",
+                "Columns": columns,
+                "Format": "parquet",
+                "DeletionQueueBucket": "bucket",
+                "DeletionQueuePrefix": "prefix/",
+                "DeletionQueueDb": "s3f2",
+                "DeletionQueueTableName": "deletion_queue",
+                "QueryExecutorParameters": {
+                    "DataCatalogProvider": "glue",
+                    "Database": "test_db",
+                    "Table": "test_table",
+                },
+            },
+            [{"MatchId": "hi"}],
+            "bucket",
+            "job123",
+        )
+        assert [
+            {
+                "Partitions": [
+                    [{"Key": "product_category", "Value": "Books"}],
+                    [{"Key": "product_category", "Value": "Music"}],
+                ],
+                "PartitionKeys": [],
+            },
+            {
+                "PartitionKeys": [{"Key": "product_category", "Value": "Games"}],
+            },
+        ] == [
+            {k: v for k, v in q.items() if k in ["Partitions", "PartitionKeys"]}
+            for q in resp
+        ]
+
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_multiple_columns(self, get_partitions_mock, get_table_mock):
@@ -622,6 +721,38 @@ class TestAthenaQueries:
                 },
             )
 
+    def test_it_compiles_column_converters_from_the_table_schema(self):
+        table = {
+            "StorageDescriptor": {
+                "Columns": [
+                    {"Name": "user", "Type": "struct<id:bigint,name:string>"},
+                    {"Name": "score", "Type": "double"},
+                ]
+            }
+        }
+        with patch(
+            "backend.lambdas.tasks.generate_queries.column_mapper",
+            wraps=column_mapper,
+        ) as column_mapper_mock:
+            schema = get_table_schema(table)
+            converters = [
+                get_column_converter(c, schema)
+                for c in ["user.id", "user.name", "score"]
+            ]
+        # Columns and struct fields are parsed once for the whole table
+        assert 4 == column_mapper_mock.call_count
+        assert [int, str, float] == converters
+        assert [1, 2] == list(map(converters[0], ["1", "2"]))
+
+    def test_it_throws_compiling_converters_for_unsupported_columns(self):
+        schema = get_table_schema(
+            {"StorageDescriptor": {"Columns": [{"Name": "test_col", "Type": "decimal"}]}}
+        )
+        with pytest.raises(ValueError):
+            get_column_converter("doesnt_exist", schema)
+        with pytest.raises(ValueError):
+            get_column_converter("test_col", schema)
+
     def test_it_throws_for_invalid_schema(self):
         with pytest.raises(ValueError):
             get_inner_children("struct<name:string", "struct<", ">")
@@ -0,0 +1,159 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from botocore.exceptions import ClientError
+from mock import patch, MagicMock
+
+from backend.lambdas.tasks.query_completion import (
+    wait_handler,
+    event_handler,
+    get_query_status,
+)
+
+pytestmark = [pytest.mark.unit, pytest.mark.task]
+
+
+def query_execution_stub(state="SUCCEEDED", **status):
+    return {
+        "QueryExecution": {
+            "Status": {"State": state, **status},
+            "Statistics": {"some": "stats"},
+        }
+    }
+
+
+def state_change_event_stub(state="SUCCEEDED"):
+    return {
+        "source": "aws.athena",
+        "detail-type": "Athena Query State Change",
+        "detail": {
+            "currentState": state,
+            "queryExecutionId": "query123",
+            "workgroupName": "primary",
+        },
+    }
+
+
+@patch("backend.lambdas.tasks.query_completion.bucket", "bucket")
+@patch("backend.lambdas.tasks.query_completion.sf_client")
+@patch("backend.lambdas.tasks.query_completion.athena_client")
+@patch("backend.lambdas.tasks.query_completion.s3")
+def test_it_stores_task_token_for_running_query(mock_s3, mock_athena, mock_sf):
+    mock_athena.get_query_execution.return_value = query_execution_stub("RUNNING")
+    wait_handler({"QueryId": "query123", "TaskToken": "token"}, SimpleNamespace())
+    mock_s3.Object.assert_called_with("bucket", "query-tokens/query123")
+    mock_s3.Object().put.assert_called_with(Body=b"token")
+    mock_sf.send_task_success.assert_not_called()
+
+
+@patch("backend.lambdas.tasks.query_completion.bucket", "bucket")
+@patch("backend.lambdas.tasks.query_completion.sf_client")
+@patch("backend.lambdas.tasks.query_completion.athena_client")
+@patch("backend.lambdas.tasks.query_completion.s3")
+def test_it_completes_task_for_query_completed_before_token_stored(
+    mock_s3, mock_athena, mock_sf
+):
+    mock_athena.get_query_execution.return_value = query_execution_stub()
+    wait_handler({"QueryId": "query123", "TaskToken": "token"}, SimpleNamespace())
+    mock_sf.send_task_success.assert_called_with(
+        taskToken="token",
+        output=json.dumps(
+            {"State": "SUCCEEDED", "Reason": "n/a", "Statistics": {"some": "stats"}}
+        ),
+    )
+    mock_s3.Object().delete.assert_called()
+
+
+@patch("backend.lambdas.tasks.query_completion.bucket", "bucket")
+@patch("backend.lambdas.tasks.query_completion.sf_client")
+@patch("backend.lambdas.tasks.query_completion.athena_client")
+@patch("backend.lambdas.tasks.query_completion.s3")
+def test_it_completes_task_on_query_state_change(mock_s3, mock_athena, mock_sf):
+    mock_s3.Object().get.return_value = {"Body": MagicMock(read=lambda: b"token")}
+    mock_athena.get_query_execution.return_value = query_execution_stub(
+        "FAILED", StateChangeReason="Some reason"
+    )
+    event_handler(state_change_event_stub("FAILED"), SimpleNamespace())
+    mock_s3.Object.assert_called_with("bucket", "query-tokens/query123")
+    mock_athena.get_query_execution.assert_called_with(QueryExecutionId="query123")
+    mock_sf.send_task_success.assert_called_with(
+        taskToken="token",
+        output=json.dumps(
+            {
+                "State": "FAILED",
+                "Reason": "Some reason",
+                "Statistics": {"some": "stats"},
+            }
+        ),
+    )
+    mock_s3.Object().delete.assert_called()
+
+
+@patch("backend.lambdas.tasks.query_completion.sf_client")
+@patch("backend.lambdas.tasks.query_completion.athena_client")
+@patch("backend.lambdas.tasks.query_completion.s3")
+def test_it_ignores_non_terminal_state_changes(mock_s3, mock_athena, mock_sf):
+    event_handler(state_change_event_stub("RUNNING"), SimpleNamespace())
+    mock_s3.Object.assert_not_called()
+    mock_sf.send_task_success.assert_not_called()
+
+
+@patch("backend.lambdas.tasks.query_completion.sf_client")
+@patch("backend.lambdas.tasks.query_completion.athena_client")
+@patch("backend.lambdas.tasks.query_completion.s3")
+def test_it_ignores_queries_without_task_token(mock_s3, mock_athena, mock_sf):
+    mock_s3.Object().get.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+    )
+    event_handler(state_change_event_stub(), SimpleNamespace())
+    mock_athena.get_query_execution.assert_not_called()
+    mock_sf.send_task_success.assert_not_called()
+
+
+@patch("backend.lambdas.tasks.query_completion.sf_client")
+@patch("backend.lambdas.tasks.query_completion.athena_client")
+@patch("backend.lambdas.tasks.query_completion.s3")
+def test_it_raises_for_token_read_errors(mock_s3, mock_athena, mock_sf):
+    mock_s3.Object().get.side_effect = ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "GetObject"
+    )
+    with pytest.raises(ClientError):
+        event_handler(state_change_event_stub(), SimpleNamespace())
+
+
+@patch("backend.lambdas.tasks.query_completion.sf_client")
+@patch("backend.lambdas.tasks.query_completion.athena_client")
+@patch("backend.lambdas.tasks.query_completion.s3")
+def test_it_tolerates_tasks_already_completed(mock_s3, mock_athena, mock_sf):
+    mock_s3.Object().get.return_value = {"Body": MagicMock(read=lambda: b"token")}
+    mock_athena.get_query_execution.return_value = query_execution_stub()
+    mock_sf.send_task_success.side_effect = ClientError(
+        {"Error": {"Code": "TaskTimedOut"}}, "SendTaskSuccess"
+    )
+    event_handler(state_change_event_stub(), SimpleNamespace())
+    mock_s3.Object().delete.assert_called()
+
+
+@patch("backend.lambdas.tasks.query_completion.sf_client")
+@patch("backend.lambdas.tasks.query_completion.athena_client")
+@patch("backend.lambdas.tasks.query_completion.s3")
+def test_it_raises_for_task_completion_errors(mock_s3, mock_athena, mock_sf):
+    mock_s3.Object().get.return_value = {"Body": MagicMock(read=lambda: b"token")}
+    mock_athena.get_query_execution.return_value = query_execution_stub()
+    mock_sf.send_task_success.side_effect = ClientError(
+        {"Error": {"Code": "ThrottlingException"}}, "SendTaskSuccess"
+    )
+    with pytest.raises(ClientError):
+        event_handler(state_change_event_stub(), SimpleNamespace())
+    mock_s3.Object().delete.assert_not_called()
+
+
+@patch("backend.lambdas.tasks.query_completion.athena_client")
+def test_it_defaults_missing_statistics(mock_athena):
+    mock_athena.get_query_execution.return_value = {
+        "QueryExecution": {"Status": {"State": "CANCELLED"}}
+    }
+    assert {"State": "CANCELLED", "Reason": "n/a", "Statistics": {}} == (
+        get_query_status("query123")
+    )
@@ -1,11 +1,15 @@
 import os
+from io import BytesIO
 from types import SimpleNamespace
 
 import pytest
 from mock import patch, ANY
 
 with patch.dict(os.environ, {"QueueUrl": "test"}):
-    from backend.lambdas.tasks.submit_query_results import handler
+    from backend.lambdas.tasks.submit_query_results import (
+        handler,
+        group_objects,
+    )
 
 pytestmark = [pytest.mark.unit, pytest.mark.task]
 
@@ -99,3 +103,121 @@ def test_it_propagates_optional_properties(paginate_mock, batch_sqs_msgs_mock):
             },
         ],
     )
+
+
+@patch("backend.lambdas.tasks.submit_query_results.STREAM_QUERY_RESULTS", False)
+@patch("backend.lambdas.tasks.submit_query_results.batch_sqs_msgs")
+@patch("backend.lambdas.tasks.submit_query_results.paginate")
+def test_it_groups_small_objects(paginate_mock, batch_sqs_msgs_mock):
+    paginate_mock.return_value = iter(
+        [
+            {"Data": [{"VarCharValue": "$path"}, {"VarCharValue": "$file_size"}]},
+            {
+                "Data": [
+                    {"VarCharValue": "s3://mybucket/mykey1"},
+                    {"VarCharValue": "10"},
+                ]
+            },
+            {
+                "Data": [
+                    {"VarCharValue": "s3://mybucket/mykey2"},
+                    {"VarCharValue": "20"},
+                ]
+            },
+            {"Data": [{"VarCharValue": "s3://mybucket/mykey3"}, {}]},
+            {
+                "Data": [
+                    {"VarCharValue": "s3://mybucket/mykey4"},
+                    {"VarCharValue": str(1024 ** 3)},
+                ]
+            },
+        ]
+    )
+
+    handler(
+        {
+            "AllFiles": False,
+            "JobId": "1234",
+            "QueryId": "123",
+            "Bucket": "query_bucket",
+            "Key": "query_key",
+            "Format": "parquet",
+        },
+        SimpleNamespace(),
+    )
+    message = {
+        "AllFiles": False,
+        "JobId": "1234",
+        "QueryBucket": "query_bucket",
+        "QueryKey": "query_key",
+        "DeleteOldVersions": True,
+        "Format": "parquet",
+    }
+    batch_sqs_msgs_mock.assert_called_with(
+        ANY,
+        [
+            {"Object": "s3://mybucket/mykey3", **message},
+            {"Object": "s3://mybucket/mykey4", **message},
+            {
+                "Objects": [
+                    {"Object": "s3://mybucket/mykey1", "Size": 10},
+                    {"Object": "s3://mybucket/mykey2", "Size": 20},
+                ],
+                **message,
+            },
+        ],
+    )
+
+
+@patch("backend.lambdas.tasks.submit_query_results.MAX_OBJECTS_PER_GROUP", 2)
+@patch("backend.lambdas.tasks.submit_query_results.MAX_GROUP_SIZE", 100)
+def test_it_bounds_groups_by_count_and_size():
+    groups = group_objects([("a", 10), ("b", 10), ("c", 10), ("d", 95), ("e", 5)])
+    groups = list(groups)
+    assert [
+        [("a", 10), ("b", 10)],
+        [("c", 10)],
+        [("d", 95), ("e", 5)],
+    ] == groups
+
+
+@patch("backend.lambdas.tasks.submit_query_results.NUM_OF_MESSAGES_IN_BATCH", 2)
+@patch("backend.lambdas.tasks.submit_query_results.batch_sqs_msgs")
+@patch("backend.lambdas.tasks.submit_query_results.s3")
+@patch("backend.lambdas.tasks.submit_query_results.athena")
+def test_it_streams_results_from_the_query_output_location(
+    athena_mock, s3_mock, batch_sqs_msgs_mock
+):
+    athena_mock.get_query_execution.return_value = {
+        "QueryExecution": {
+            "ResultConfiguration": {"OutputLocation": "s3://results/queries/123.csv"}
+        }
+    }
+    s3_mock.Object.return_value.get.return_value = {
+        "Body": BytesIO(
+            b'"$path","$file_size"\n'
+            b'"s3://mybucket/mykey1","1073741824"\n'
+            b'"s3://mybucket/my\nkey2","1073741824"\n'
+            b'"s3://mybucket/mykey3",\n'
+        )
+    }
+
+    handler(
+        {
+            "AllFiles": False,
+            "JobId": "1234",
+            "QueryId": "123",
+            "Bucket": "query_bucket",
+            "Key": "query_key",
+        },
+        SimpleNamespace(),
+    )
+    athena_mock.get_query_execution.assert_called_with(QueryExecutionId="123")
+    athena_mock.get_query_results.assert_not_called()
+    s3_mock.Object.assert_called_with("results", "queries/123.csv")
+    assert [
+        ["s3://mybucket/mykey1", "s3://mybucket/my\nkey2"],
+        ["s3://mybucket/mykey3"],
+    ] == [
+        [m["Object"] for m in c[0][1]] for c in batch_sqs_msgs_mock.call_args_list
+    ]
@@ -3,13 +3,14 @@ import os
 from types import SimpleNamespace
 
 import pytest
-from mock import patch, ANY, MagicMock
+from mock import patch, ANY
 
 
 with patch.dict(os.environ, {"QueueUrl": "someurl"}):
     from backend.lambdas.tasks.work_query_queue import (
         handler,
         load_execution,
+        load_executions,
         clear_completed,
         abandon_execution,
     )
@@ -23,10 +24,12 @@ pytestmark = [pytest.mark.unit, pytest.mark.task]
 
 @patch("backend.lambdas.tasks.work_query_queue.read_queue")
 @patch("backend.lambdas.tasks.work_query_queue.sqs")
-@patch("backend.lambdas.tasks.work_query_queue.load_execution")
+@patch("backend.lambdas.tasks.work_query_queue.load_executions")
 def test_it_skips_with_no_remaining_capacity(mock_load, sqs_mock, read_queue_mock):
     sqs_mock.Queue.return_value = sqs_mock
-    mock_load.return_value = execution_stub(status="RUNNING", ReceiptHandle="handle")
+    mock_load.return_value = [
+        execution_stub(status="RUNNING", ReceiptHandle="handle") for _ in range(0, 20)
+    ]
 
     resp = handler(
         {
@@ -160,7 +163,7 @@ def test_limits_calls_to_capacity(sqs_mock, read_queue_mock, sf_client_mock):
 @patch("backend.lambdas.tasks.work_query_queue.sf_client")
 @patch("backend.lambdas.tasks.work_query_queue.read_queue")
 @patch("backend.lambdas.tasks.work_query_queue.sqs")
-@patch("backend.lambdas.tasks.work_query_queue.load_execution")
+@patch("backend.lambdas.tasks.work_query_queue.load_executions")
 @patch("backend.lambdas.tasks.work_query_queue.clear_completed")
 def test_it_recognises_completed_executions(
     clear_mock, load_mock, sqs_mock, read_queue_mock, sf_client_mock
@@ -168,7 +171,7 @@ def test_it_recognises_completed_executions(
     sqs_mock.Queue.return_value = sqs_mock
     sf_client_mock.start_execution.return_value = execution_stub()
     read_queue_mock.return_value = []
-    load_mock.side_effect = [
+    load_mock.return_value = [
         *[execution_stub(status="SUCCEEDED") for _ in range(0, 10)],
         *[
             execution_stub(status="RUNNING", ReceiptHandle="handle")
@@ -188,12 +191,12 @@ def test_it_recognises_completed_executions(
     read_queue_mock.assert_called_with(ANY, 10)
 
 
-@patch("backend.lambdas.tasks.work_query_queue.load_execution")
+@patch("backend.lambdas.tasks.work_query_queue.load_executions")
 @patch("backend.lambdas.tasks.work_query_queue.abandon_execution")
 def test_it_abandons_when_any_query_fails_and_no_running_in_current_loop(
     mock_abandon, mock_load
 ):
-    mock_load.return_value = execution_stub(status="FAILED")
+    mock_load.return_value = [execution_stub(status="FAILED")]
     mock_abandon.side_effect = RuntimeError
     with pytest.raises(RuntimeError):
         handler(
@@ -206,13 +209,15 @@ def test_it_abandons_when_any_query_fails_and_no_running_in_current_loop(
         )
 
 
-@patch("backend.lambdas.tasks.work_query_queue.load_execution")
+@patch("backend.lambdas.tasks.work_query_queue.load_executions")
 @patch("backend.lambdas.tasks.work_query_queue.abandon_execution")
 @patch("backend.lambdas.tasks.work_query_queue.clear_completed")
 def test_it_abandons_when_previous_loop_found_failure(
     mock_clear, mock_abandon, mock_load
 ):
-    mock_load.return_value = execution_stub(status="SUCCEEDED", ReceiptHandle="handle")
+    mock_load.return_value = [
+        execution_stub(status="SUCCEEDED", ReceiptHandle="handle")
+    ]
     mock_abandon.side_effect = RuntimeError
     with pytest.raises(RuntimeError):
         handler(
@@ -242,13 +247,13 @@ def test_raises_error_for_invalid_executor(sqs_mock, read_queue_mock, sf_client_
         handler({"ExecutionId": "1234", "ExecutionName": "4231",}, SimpleNamespace())
 
 
-@patch("backend.lambdas.tasks.work_query_queue.load_execution")
+@patch("backend.lambdas.tasks.work_query_queue.load_executions")
 @patch("backend.lambdas.tasks.work_query_queue.abandon_execution")
 @patch("backend.lambdas.tasks.work_query_queue.sf_client")
 def test_it_waits_for_running_executions_before_abandoning(
     mock_sf, mock_abandon, mock_load
 ):
-    mock_load.side_effect = [
+    mock_load.return_value = [
         execution_stub(status="FAILED", ReceiptHandle="handle1"),
         execution_stub(status="RUNNING", ReceiptHandle="handle2"),
     ]
@@ -279,16 +284,93 @@ def test_it_loads_execution_from_state(sf_mock):
     assert {**execution_stub(), "ReceiptHandle": "handle"} == resp
 
 
-@patch("backend.lambdas.tasks.work_query_queue.sqs")
+@patch("backend.lambdas.tasks.work_query_queue.paginate")
+@patch("backend.lambdas.tasks.work_query_queue.sf_client")
+def test_it_loads_executions_listed_as_running(sf_mock, paginate_mock):
+    running = [
+        execution_stub(executionArn="arn1"),
+        execution_stub(executionArn="arn2"),
+    ]
+    paginate_mock.return_value = iter(running)
+    resp = load_executions(
+        [
+            {"ExecutionArn": "arn1", "ReceiptHandle": "handle1"},
+            {"ExecutionArn": "arn2", "ReceiptHandle": "handle2"},
+        ]
+    )
+    assert [
+        {**running[0], "ReceiptHandle": "handle1"},
+        {**running[1], "ReceiptHandle": "handle2"},
+    ] == resp
+    paginate_mock.assert_called_with(
+        sf_mock,
+        sf_mock.list_executions,
+        ["executions"],
+        stateMachineArn=ANY,
+        statusFilter="RUNNING",
+        PaginationConfig={"PageSize": 1000},
+    )
+    sf_mock.describe_execution.assert_not_called()
+
+
+@patch("backend.lambdas.tasks.work_query_queue.paginate")
+@patch("backend.lambdas.tasks.work_query_queue.sf_client")
+def test_it_describes_executions_no_longer_running(sf_mock, paginate_mock):
+    paginate_mock.return_value = iter([execution_stub(executionArn="arn2")])
+    sf_mock.describe_execution.side_effect = lambda executionArn: execution_stub(
+        executionArn=executionArn, status="SUCCEEDED"
+    )
+    resp = load_executions(
+        [
+            {"ExecutionArn": "arn1", "ReceiptHandle": "handle1"},
+            {"ExecutionArn": "arn2", "ReceiptHandle": "handle2"},
+            {"ExecutionArn": "arn3", "ReceiptHandle": "handle3"},
+        ]
+    )
+    assert [
+        ("arn1", "SUCCEEDED", "handle1"),
+        ("arn2", "RUNNING", "handle2"),
+        ("arn3", "SUCCEEDED", "handle3"),
+    ] == [(e["executionArn"], e["status"], e["ReceiptHandle"]) for e in resp]
+    assert 2 == sf_mock.describe_execution.call_count
+
+
+@patch("backend.lambdas.tasks.work_query_queue.paginate")
+def test_it_skips_loading_without_executions(paginate_mock):
+    assert [] == load_executions([])
+    paginate_mock.assert_not_called()
+
+
 @patch("backend.lambdas.tasks.work_query_queue.queue")
-def test_it_clears_completed_from_sqs(mock_queue, mock_sqs):
-    mock_message = MagicMock()
-    mock_queue.url = "someurl"
-    mock_sqs.Message.return_value = mock_message
+def test_it_clears_completed_from_sqs(mock_queue):
+    mock_queue.delete_messages.return_value = {"Successful": []}
     clear_completed(
         [{"ReceiptHandle": "handle1"}, {"ReceiptHandle": "handle2"},]
     )
-    assert 2 == mock_message.delete.call_count
+    mock_queue.delete_messages.assert_called_once_with(
+        Entries=[
+            {"Id": "0", "ReceiptHandle": "handle1"},
+            {"Id": "1", "ReceiptHandle": "handle2"},
+        ]
+    )
+
+
+@patch("backend.lambdas.tasks.work_query_queue.queue")
+def test_it_clears_completed_in_batches(mock_queue):
+    mock_queue.delete_messages.return_value = {"Successful": []}
+    clear_completed([{"ReceiptHandle": "handle{}".format(i)} for i in range(0, 25)])
+    assert [10, 10, 5] == [
+        len(c[1]["Entries"]) for c in mock_queue.delete_messages.call_args_list
+    ]
+
+
+@patch("backend.lambdas.tasks.work_query_queue.queue")
+def test_it_raises_for_failed_deletions(mock_queue):
+    mock_queue.delete_messages.return_value = {
+        "Failed": [{"Id": "0", "Code": "ReceiptHandleIsInvalid", "SenderFault": True}]
+    }
+    with pytest.raises(RuntimeError):
+        clear_completed([{"ReceiptHandle": "handle1"}])
 
 
 def execution_stub(**kwargs):